@@ -0,0 +1,333 @@
+"""
+Бенчмарк матчера: SetMatcher.evaluate, should_forward_message и
+matches_word_start на синтетическом корпусе постов (русский/английский,
+смешанный регистр, ссылки, длинные тексты).
+
+Работает полностью офлайн. Для каждого размера конфигурации (по умолчанию
+10 … 5000 ключевых слов, исключений и паттернов) считает сообщения/сек,
+p50/p99 задержки на сообщение и пиковую память, результат пишет в JSON,
+чтобы сравнивать прогоны между коммитами:
+
+    python bench_matcher.py --output bench/before.json
+    python bench_matcher.py --output bench/after.json --compare bench/before.json
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import telegram_monitor as tm
+
+# Словарь «реальных» основ — часть ключевых слов набора берётся отсюда,
+# чтобы совпадения в корпусе действительно случались
+RU_STEMS = [
+    'инвест', 'акци', 'облигац', 'дивиденд', 'бирж', 'рынок', 'крипт', 'биткоин',
+    'вакан', 'работ', 'зарплат', 'удалён', 'проект', 'стартап', 'финанс', 'банк',
+    'кредит', 'ипотек', 'налог', 'доход', 'прибыл', 'убыт', 'отчёт', 'компани',
+    'рост', 'паден', 'прогноз', 'аналит', 'новост', 'курс', 'валют', 'рубл',
+    'доллар', 'нефт', 'газ', 'золот', 'технолог', 'разработ', 'программ', 'данн',
+]
+EN_STEMS = [
+    'invest', 'stock', 'bond', 'dividend', 'market', 'crypto', 'bitcoin', 'hiring',
+    'job', 'salary', 'remote', 'startup', 'fund', 'bank', 'loan', 'tax', 'revenue',
+    'profit', 'report', 'growth', 'forecast', 'analyst', 'news', 'rate', 'oil',
+]
+RU_ENDINGS = ['', 'а', 'ы', 'ов', 'ами', 'ия', 'ии', 'ий', 'ный', 'ная', 'ное', 'ение', 'ать', 'ует']
+EN_ENDINGS = ['', 's', 'ed', 'ing', 'er', 'ers', 'ment']
+FILLER_RU = [
+    'и', 'в', 'на', 'с', 'по', 'для', 'это', 'что', 'как', 'уже', 'сегодня', 'вчера',
+    'очень', 'новый', 'год', 'день', 'неделя', 'канал', 'подписывайтесь', 'читать',
+]
+FILLER_EN = ['the', 'and', 'for', 'with', 'today', 'new', 'read', 'more', 'via', 'about']
+CYRILLIC = 'абвгдеёжзийклмнопрстуфхцчшщъыьэюя'
+LATIN = 'abcdefghijklmnopqrstuvwxyz'
+
+
+def random_word(rng, alphabet, min_len=4, max_len=9):
+    return ''.join(rng.choice(alphabet) for _ in range(rng.randint(min_len, max_len)))
+
+
+def random_case(rng, word):
+    """Смешанный регистр, как в реальных постах"""
+    roll = rng.random()
+    if roll < 0.1:
+        return word.upper()
+    if roll < 0.3:
+        return word.capitalize()
+    return word
+
+
+def generate_post(rng):
+    """Синтетический пост канала: от короткой строки до длинной простыни"""
+    length = rng.choice([8, 20, 40, 80, 200, 600])
+    words = []
+    for _ in range(length):
+        roll = rng.random()
+        if roll < 0.08:
+            words.append(random_case(rng, rng.choice(RU_STEMS) + rng.choice(RU_ENDINGS)))
+        elif roll < 0.12:
+            words.append(random_case(rng, rng.choice(EN_STEMS) + rng.choice(EN_ENDINGS)))
+        elif roll < 0.55:
+            words.append(random_case(rng, rng.choice(FILLER_RU)))
+        elif roll < 0.62:
+            words.append(rng.choice(FILLER_EN))
+        elif roll < 0.9:
+            words.append(random_case(rng, random_word(rng, CYRILLIC)))
+        elif roll < 0.94:
+            words.append(str(rng.randint(1, 100000)))
+        elif roll < 0.96:
+            words.append(f"https://t.me/{random_word(rng, LATIN)}/{rng.randint(1, 99999)}")
+        elif roll < 0.98:
+            words.append(rng.choice(['🔥', '🚀', '📈', '💰', '✅', '❗️']))
+        else:
+            words.append(f"#{random_word(rng, CYRILLIC + LATIN, 3, 7)}")
+        if rng.random() < 0.05:
+            words[-1] += rng.choice(['.', ',', '!', '?', ':\n', '\n\n'])
+    return ' '.join(words)
+
+
+def generate_corpus(rng, count):
+    return [generate_post(rng) for _ in range(count)]
+
+
+def generate_monitor_set(rng, size):
+    """
+    Конфигурация набора из size ключевых слов, size исключений и size
+    паттернов. Реальные основы дают совпадения, остальное — синтетические
+    термины, которые почти не встречаются (худший случай для перебора).
+    """
+    keywords = set(rng.sample(RU_STEMS + EN_STEMS, min(size, len(RU_STEMS) + len(EN_STEMS)) // 2))
+    while len(keywords) < size:
+        keywords.add(random_word(rng, rng.choice([CYRILLIC, LATIN]), 4, 10))
+
+    exclude = set()
+    while len(exclude) < size:
+        exclude.add(random_word(rng, CYRILLIC, 5, 10))
+
+    pattern_templates = [
+        r'\b{w}\w*\s+\d+',
+        r'{w}[a-zа-я]{{0,3}}\s*(?:руб|usd|\$)',
+        r'^{w}',
+        r'\b{w}(?:ый|ая|ое)\b',
+        r'#{w}\w*',
+    ]
+    patterns = set()
+    while len(patterns) < size:
+        word = random_word(rng, rng.choice([CYRILLIC, LATIN]), 4, 8)
+        patterns.add(rng.choice(pattern_templates).format(w=word))
+
+    return {
+        'keywords': sorted(keywords),
+        'exclude': sorted(exclude),
+        'patterns': sorted(patterns),
+    }
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def measure(name, size, corpus, evaluate):
+    """Прогон evaluate по корпусу: пропускная способность, задержки, память"""
+    # Прогрев (ленивые кэши, первая компиляция)
+    for text in corpus[:50]:
+        evaluate(text)
+
+    gc.collect()
+    latencies = []
+    matched = 0
+    started = time.perf_counter()
+    for text in corpus:
+        t0 = time.perf_counter_ns()
+        if evaluate(text):
+            matched += 1
+        latencies.append(time.perf_counter_ns() - t0)
+    elapsed = time.perf_counter() - started
+
+    # Память — отдельным проходом: tracemalloc сильно замедляет выполнение
+    tracemalloc.start()
+    for text in corpus:
+        evaluate(text)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies.sort()
+    return {
+        'bench': name,
+        'size': size,
+        'messages': len(corpus),
+        'matched': matched,
+        'seconds': round(elapsed, 4),
+        'messages_per_sec': round(len(corpus) / elapsed, 1) if elapsed else None,
+        'p50_us': round(percentile(latencies, 0.50) / 1000, 2),
+        'p99_us': round(percentile(latencies, 0.99) / 1000, 2),
+        'peak_memory_kb': round(peak / 1024, 1),
+    }
+
+
+def run_size(rng, size, corpus, skip=(), word_start_max_size=None, sets=1, mode=None):
+    mode = mode or tm.MATCH_MODE
+    config = generate_monitor_set(rng, size)
+    results = []
+
+    # Сборка матчера (делается один раз на набор в parse_monitor_sets)
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    matcher = tm.SetMatcher(config['keywords'], config['exclude'], config['patterns'], mode)
+    build_seconds = time.perf_counter() - t0
+    _, build_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    results.append({
+        'bench': 'matcher_build',
+        'size': size,
+        'seconds': round(build_seconds, 4),
+        'peak_memory_kb': round(build_peak / 1024, 1),
+    })
+
+    if 'matcher_evaluate' not in skip:
+        results.append(measure('matcher_evaluate', size, corpus, matcher.matches))
+
+    keywords, exclude, patterns = config['keywords'], config['exclude'], config['patterns']
+    if 'should_forward_message' not in skip:
+        results.append(measure(
+            'should_forward_message', size, corpus,
+            lambda text: tm.should_forward_message(text, keywords, exclude, patterns)
+        ))
+
+    # matches_word_start — по одному термину на сообщение, как в старом цикле
+    # исключений: size вызовов на сообщение. На больших наборах термины не
+    # помещаются в кэш re и каждый вызов перекомпилирует regex — такой прогон
+    # занимает минуты, поэтому размер ограничен --word-start-max-size
+    def word_start_loop(text):
+        text_lower = text.lower()
+        return any(tm.matches_word_start(term, text_lower) for term in exclude)
+
+    if 'matches_word_start' not in skip and (word_start_max_size is None or size <= word_start_max_size):
+        results.append(measure('matches_word_start', size, corpus, word_start_loop))
+
+    # Несколько наборов на одно сообщение (без паттернов — только ключевые
+    # слова и исключения), как в route_message: в режиме token текст
+    # разбирается один раз на все наборы
+    if 'sets_evaluate' not in skip and sets > 1:
+        matchers = []
+        for _ in range(sets):
+            extra = generate_monitor_set(rng, size)
+            matchers.append(tm.SetMatcher(extra['keywords'], extra['exclude'], [], mode))
+
+        def evaluate_sets(text):
+            index = tm.TextIndex(text) if mode == 'token' else None
+            return sum(set_matcher.matches(text, index) for set_matcher in matchers)
+
+        results.append(measure(f'sets_evaluate_x{sets}', size, corpus, evaluate_sets))
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, baseline=None):
+    baseline_index = {}
+    if baseline:
+        baseline_index = {(r['bench'], r['size']): r for r in baseline.get('results', [])}
+
+    print(f"{'bench':<24}{'size':>6}{'msg/s':>12}{'p50 µs':>10}{'p99 µs':>10}{'peak KB':>10}  vs baseline")
+    for result in results:
+        rate = result.get('messages_per_sec')
+        line = (f"{result['bench']:<24}{result['size']:>6}"
+                f"{(rate if rate is not None else '-'):>12}"
+                f"{result.get('p50_us', '-'):>10}{result.get('p99_us', '-'):>10}"
+                f"{result['peak_memory_kb']:>10}")
+        previous = baseline_index.get((result['bench'], result['size']))
+        if previous and rate and previous.get('messages_per_sec'):
+            line += f"  x{rate / previous['messages_per_sec']:.2f}"
+        elif previous and 'messages_per_sec' not in result:
+            line += f"  {result['seconds'] - previous['seconds']:+.4f} s"
+        print(line)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Бенчмарк матчера telegram_monitor")
+    parser.add_argument('--messages', type=int, default=5000, help="размер корпуса")
+    parser.add_argument('--sizes', default='10,100,1000,5000',
+                        help="размеры наборов (ключевые слова = исключения = паттерны)")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help="куда сохранить JSON с результатами")
+    parser.add_argument('--compare', help="JSON предыдущего прогона для сравнения")
+    parser.add_argument('--word-start-max-size', type=int, default=1000,
+                        help="максимальный размер набора для бенчмарка matches_word_start")
+    parser.add_argument('--sets', type=int, default=10,
+                        help="число наборов для бенчмарка sets_evaluate")
+    parser.add_argument('--match-mode', choices=['token', 'substring'], default=tm.MATCH_MODE,
+                        help="MATCH_MODE матчера")
+    parser.add_argument('--skip', default='',
+                        help="пропустить бенчмарки (через запятую), например matches_word_start")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    sizes = [int(size) for size in args.sizes.split(',') if size.strip()]
+    skip = {name.strip() for name in args.skip.split(',') if name.strip()}
+    tm.MATCH_MODE = args.match_mode
+
+    rng = random.Random(args.seed)
+    corpus = generate_corpus(rng, args.messages)
+    total_chars = sum(len(text) for text in corpus)
+    print(f"📚 Корпус: {len(corpus)} сообщений, в среднем {total_chars // max(1, len(corpus))} символов")
+
+    results = []
+    for size in sizes:
+        print(f"⏱️ Размер набора: {size}")
+        results.extend(run_size(
+            random.Random(args.seed + size), size, corpus, skip, args.word_start_max_size,
+            args.sets, args.match_mode
+        ))
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'messages': len(corpus),
+            'seed': args.seed,
+            'match_mode': args.match_mode,
+        },
+        'results': results,
+    }
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+
+    if args.output:
+        directory = os.path.dirname(args.output)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"💾 Результаты: {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,851 @@
+"""
+Офлайн-прогон всего конвейера telegram_monitor (резолв каналов, чтение
+истории, матчинг, доставка, состояние) на подменных клиентах Telegram.
+
+Источник сообщений — записи реальных прогонов (telegram_monitor.py
+--record DIR или RECORD_DIR) либо синтетические каналы. Подменный клиент
+имитирует задержку сети и FloodWaitError, подменный бот собирает
+отправленные сообщения. В конце печатается время прогона, число вызовов
+API по методам и пиковая память:
+
+    python replay_harness.py --synthetic-channels 2000 --output bench/replay.json
+    python replay_harness.py --recordings recordings/ --config sets.json \\
+        --latency-ms 80 --flood-rate 0.01 --sent-output bench/sent.jsonl
+
+Сравнение --sent-output двух прогонов показывает, что изменения
+планирования не поменяли поведение (что и кому отправлено).
+
+Регрессионные сценарии с проверками (что отправлено, где курсоры после
+сбоев доставки, FloodWait, упора в глубину, событий демона) — одной
+командой, код выхода 1 при провале:
+
+    python replay_harness.py --check
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+from telethon.errors import FloodWaitError
+from telethon.tl.types import InputPeerChannel
+
+import telegram_monitor as tm
+from bench_matcher import generate_monitor_set, generate_post, git_commit
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+
+class ReplayMessage:
+    """Минимум полей Message, которые читает telegram_monitor"""
+
+    __slots__ = ('id', 'date', 'text')
+
+    def __init__(self, message_id, date, text):
+        self.id = message_id
+        self.date = date
+        self.text = text
+
+
+class FakeNetwork:
+    """Общие для клиента и бота задержка, FloodWait и счётчики вызовов"""
+
+    def __init__(self, latency_ms=0.0, flood_rate=0.0, flood_seconds=1, seed=42):
+        self.latency = latency_ms / 1000.0
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        self.rng = random.Random(seed)
+        self.calls = Counter()
+        self.floods = Counter()
+
+    async def request(self, method, flood_sleep_threshold=0):
+        """
+        Один запрос к API: учёт, задержка, возможный FloodWaitError. Как
+        Telethon, FloodWait не длиннее ненулевого flood_sleep_threshold
+        клиента не выбрасывается, а пересыпается с повтором запроса — код
+        его не видит.
+        """
+        while True:
+            self.calls[method] += 1
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            if not (self.flood_rate and self.rng.random() < self.flood_rate):
+                return
+            self.floods[method] += 1
+            if not flood_sleep_threshold or self.flood_seconds > flood_sleep_threshold:
+                raise FloodWaitError(None, capture=self.flood_seconds)
+            await asyncio.sleep(self.flood_seconds)
+
+
+class FakeClient:
+    """
+    Пользовательский клиент: get_entity и iter_messages по каналам из
+    записей или синтетики. Сообщения канала хранятся от новых к старым,
+    iter_messages отдаёт их страницами по MESSAGES_PER_REQUEST (каждая
+    страница — отдельный запрос GetHistory, как в Telethon).
+    """
+
+    def __init__(self, channels, network):
+        # @username -> [ReplayMessage] (новые первыми)
+        self.channels = channels
+        self.network = network
+        self.flood_sleep_threshold = 60
+        self.handlers = []
+        self._connected = False
+        self._ids = {username: index + 1 for index, username in enumerate(channels)}
+        self._by_id = {channel_id: username for username, channel_id in self._ids.items()}
+
+    async def connect(self):
+        # Рукопожатие — один обмен с сервером (без учёта и FloodWait)
+        await asyncio.sleep(self.network.latency)
+        self._connected = True
+
+    async def disconnect(self):
+        self._connected = False
+
+    def is_connected(self):
+        return self._connected
+
+    async def is_user_authorized(self):
+        return True
+
+    def add_event_handler(self, callback, event=None):
+        self.handlers.append((callback, event))
+
+    async def get_entity(self, channel_username):
+        await self.network.request('get_entity', self.flood_sleep_threshold)
+        channel_id = self._ids.get(channel_username)
+        if channel_id is None:
+            raise ValueError(f'No user has "{channel_username.lstrip("@")}" as username')
+        return InputPeerChannel(channel_id=channel_id, access_hash=channel_id * 7919)
+
+    async def iter_messages(self, entity, limit=None, min_id=0, offset_id=0, search=None):
+        username = self._by_id.get(getattr(entity, 'channel_id', None))
+        if username is None:
+            raise ValueError(f"Could not find the input entity for {entity!r}")
+
+        page_size = tm.MESSAGES_PER_REQUEST
+        method = 'search' if search else 'iter_messages'
+        term = search.lower() if search else None
+        yielded = 0
+        for message in self.channels[username]:
+            if limit is not None and yielded >= limit:
+                break
+            if message.id <= min_id:
+                break
+            # offset_id — только сообщения старше него
+            if offset_id and message.id >= offset_id:
+                continue
+            # Поиск Telegram ищет по началу слов, а не по подстроке
+            if term and not tm.matches_word_start(term, (message.text or "").lower()):
+                continue
+            if yielded % page_size == 0:
+                await self.network.request(method, self.flood_sleep_threshold)
+            yielded += 1
+            yield message
+        if yielded == 0:
+            # Пустой ответ — тоже запрос
+            await self.network.request(method, self.flood_sleep_threshold)
+
+
+class FakeBot:
+    """
+    Клиент бота: собирает отправленные сообщения вместо отправки. Тексты
+    хранятся только при keep_sent (нужны для --sent-output), иначе они
+    попадали бы в замер памяти прогона.
+    """
+
+    def __init__(self, network, keep_sent=True):
+        self.network = network
+        self.keep_sent = keep_sent
+        self.sent = []
+        self.sent_count = 0
+        self.flood_sleep_threshold = 60
+        self._authorized = False
+
+    async def connect(self):
+        await asyncio.sleep(self.network.latency)
+
+    async def is_user_authorized(self):
+        return self._authorized
+
+    async def sign_in(self, bot_token=None):
+        await asyncio.sleep(self.network.latency)
+        self._authorized = True
+        return self
+
+    async def start(self, bot_token=None):
+        await self.connect()
+        return await self.sign_in(bot_token=bot_token)
+
+    async def disconnect(self):
+        pass
+
+    async def send_message(self, entity, text):
+        await self.network.request('send_message', self.flood_sleep_threshold)
+        self.sent_count += 1
+        if self.keep_sent:
+            self.sent.append({'chat_id': entity, 'text': text})
+
+
+def load_recordings(directory, keep_dates=False):
+    """
+    Читает JSONL-записи (telegram_monitor --record) в {канал: [сообщения]}.
+    Без keep_dates даты сдвигаются так, чтобы самое новое сообщение
+    записи пришлось на «сейчас» — иначе старые записи целиком выпадают из
+    окна TIME_RANGE_HOURS.
+    """
+    channels = {}
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith('.jsonl'):
+            continue
+        with open(os.path.join(directory, name), 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                date = tm.parse_timestamp(record['date']) if record.get('date') else None
+                channels.setdefault(record['channel'], {})[record['id']] = ReplayMessage(
+                    record['id'], date, record.get('text') or ""
+                )
+
+    dated = [m.date for messages in channels.values() for m in messages.values() if m.date]
+    shift = timedelta(0)
+    if dated and not keep_dates:
+        shift = datetime.now(timezone.utc) - max(dated)
+
+    result = {}
+    for channel, messages in channels.items():
+        ordered = sorted(messages.values(), key=lambda m: m.id, reverse=True)
+        for message in ordered:
+            message.date = (message.date or datetime.now(timezone.utc)) + shift
+        result[channel] = ordered
+    return result
+
+
+def generate_channels(rng, count, messages_per_channel, hours, repost_rate=0.0):
+    """
+    Синтетические каналы: посты равномерно за последние hours часов.
+    Доля repost_rate постов — копии уже сгенерированных постов других
+    каналов со своей подписью-ссылкой (как репосты анонсов).
+    """
+    now = datetime.now(timezone.utc)
+    channels = {}
+    posted = []
+    for index in range(count):
+        name = f"@synth_{index:05d}"
+        total = rng.randint(max(1, messages_per_channel // 2), messages_per_channel * 3 // 2)
+        step = timedelta(hours=hours) / total
+        first_id = rng.randint(1, 50000)
+        messages = []
+        for i in range(total):
+            if posted and rng.random() < repost_rate:
+                text = f"{rng.choice(posted)}\n\nИсточник: https://t.me/{name[1:]}"
+            else:
+                text = generate_post(rng)
+                posted.append(text)
+            messages.append(ReplayMessage(first_id + total - i, now - step * i, text))
+        channels[name] = messages
+    return channels
+
+
+def generate_sets(rng, channel_names, count, size):
+    """Синтетические наборы: каждый подписан на случайную половину каналов"""
+    monitor_sets = []
+    for index in range(count):
+        config = generate_monitor_set(rng, size)
+        config['name'] = f"synthetic_{index + 1}"
+        config['channels'] = [ch for ch in channel_names if rng.random() < 0.5] or channel_names[:1]
+        monitor_sets.append(config)
+    return monitor_sets
+
+
+def load_monitor_sets(path):
+    """Наборы в формате MONITOR_SETS — тем же парсером, что и основной скрипт"""
+    with open(path, 'r', encoding='utf-8') as f:
+        return tm.parse_monitor_sets(f.read())
+
+
+def peak_rss_kb():
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS отдаёт байты, Linux — килобайты
+    return usage // 1024 if sys.platform == 'darwin' else usage
+
+
+# Ключ отправленного уведомления: (набор, канал, ID сообщения)
+SENT_RE = re.compile(r"📢 \[(?P<set>[^\]]+)\] Пост из (?P<channel>\S+)\n\n🔗 https://t\.me/\S+/(?P<id>\d+)")
+
+# Настройки сценариев --check: без ограничений скорости, расписания и
+# адаптивной глубины, чтобы результат зависел только от логики конвейера
+CHECK_SETTINGS = {
+    'YOUR_USER_ID': 1,
+    'API_RATE_PER_SEC': 1e6, 'API_BURST': 100,
+    'BOT_RATE_PER_SEC': 1e6, 'BOT_BURST': 100,
+    'PATTERN_SANDBOX': 'off', 'MATCH_MODE': 'substring',
+    'SEARCH_PUSHDOWN': 'off', 'NEAR_DUP_MODE': 'off', 'DIGEST_MODE': False,
+    'ADAPTIVE_DEPTH': 'off', 'POLL_MAX_HOURS': 0,
+    'TIME_RANGE_HOURS': 24, 'SEARCH_DEPTH': 100,
+}
+
+
+class CheckFailed(Exception):
+    pass
+
+
+def expect(condition, message):
+    if not condition:
+        raise CheckFailed(message)
+
+
+@contextlib.contextmanager
+def overridden(**values):
+    """Временно подменяет глобальные настройки telegram_monitor"""
+    saved = {name: getattr(tm, name) for name in values}
+    for name, value in values.items():
+        setattr(tm, name, value)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(tm, name, value)
+
+
+def sent_keys(bot):
+    """Отправленное ботом как список (набор, канал, ID)"""
+    keys = []
+    for item in bot.sent:
+        match = SENT_RE.match(item['text'])
+        if match:
+            keys.append((match['set'], match['channel'], int(match['id'])))
+    return keys
+
+
+def expected_keys(channels, monitor_sets):
+    """Что должно уйти: сообщения окна, на которых срабатывает матчер набора"""
+    threshold = datetime.now(timezone.utc) - timedelta(hours=tm.TIME_RANGE_HOURS)
+    keys = set()
+    for monitor_set in monitor_sets:
+        for channel in monitor_set['channels']:
+            for message in channels.get(channel, []):
+                if message.date >= threshold and monitor_set['matcher'].evaluate(message.text)[0]:
+                    keys.add((monitor_set['name'], channel, message.id))
+    return keys
+
+
+def news_set(channels=('@ch',)):
+    """Набор, которому подходят посты «новость N» и не подходят «прочее N»"""
+    return tm.attach_matcher({'name': 'news', 'channels': list(channels), 'keywords': ['новость'],
+                              'exclude': [], 'patterns': []})
+
+
+def post_messages(messages, first_id, count, every=2):
+    """Дописывает count постов новыми (в начало), каждый every-й — совпадающий"""
+    now = datetime.now(timezone.utc)
+    for message_id in range(first_id, first_id + count):
+        kind = 'новость' if message_id % every == 0 else 'прочее'
+        messages.insert(0, ReplayMessage(message_id, now - timedelta(minutes=1), f"{kind} номер {message_id}"))
+    return first_id + count
+
+
+class FailingBot(FakeBot):
+    """Бот, у которого отправка уведомления о сообщениях из fail_ids падает"""
+
+    def __init__(self, network, fail_ids=()):
+        super().__init__(network)
+        self.fail_ids = set(fail_ids)
+
+    async def send_message(self, entity, text):
+        match = SENT_RE.match(text)
+        if match and int(match['id']) in self.fail_ids:
+            await self.network.request('send_message', self.flood_sleep_threshold)
+            raise RuntimeError("send failed")
+        await super().send_message(entity, text)
+
+
+async def check_run(channels, monitor_sets, state_path, bot=None, client=None):
+    """Один прогон run_monitor на подменных клиентах; (ctx, bot)"""
+    network = FakeNetwork()
+    client = client or FakeClient(channels, network)
+    bot = bot or FakeBot(network)
+    ctx = await tm.run_monitor(client, bot, monitor_sets, state_path=state_path)
+    return ctx, bot
+
+
+async def check_sent_set(state_path):
+    """Многоканальный прогон с FloodWait отправляет ровно то, что находит матчер"""
+    rng = random.Random(7)
+    channels = generate_channels(rng, 12, 40, tm.TIME_RANGE_HOURS)
+    monitor_sets = [tm.attach_matcher(config) for config in generate_sets(rng, list(channels), 3, 20)]
+    network = FakeNetwork(flood_rate=0.05, flood_seconds=0, seed=7)
+    with overridden(SCAN_WORKERS=4):
+        _, bot = await check_run(channels, monitor_sets, state_path,
+                                 bot=FakeBot(network), client=FakeClient(channels, network))
+    sent = sent_keys(bot)
+    expected = expected_keys(channels, monitor_sets)
+    expect(expected, "синтетика без совпадений — сценарий ничего не проверяет")
+    expect(len(sent) == len(set(sent)), f"повторные отправки: {len(sent) - len(set(sent))}")
+    expect(set(sent) == expected,
+           f"лишние {sorted(set(sent) - expected)[:5]}, пропущены {sorted(expected - set(sent))[:5]}")
+
+
+async def check_cursor_resume(state_path):
+    """Второй прогон читает только новое от курсора и не шлёт повторно"""
+    messages = []
+    next_id = post_messages(messages, 1, 20)
+    channels = {'@ch': messages}
+    _, bot = await check_run(channels, [news_set()], state_path)
+    expect(len(sent_keys(bot)) == 10, f"первый прогон: отправлено {len(sent_keys(bot))}, ожидалось 10")
+    next_id = post_messages(messages, next_id, 6)
+    ctx, bot = await check_run(channels, [news_set()], state_path)
+    expect(sorted(key[2] for key in sent_keys(bot)) == [22, 24, 26],
+           f"второй прогон: отправлено {sent_keys(bot)}")
+    expect(ctx.cursors['@ch']['news'] == next_id - 1, f"курсор {ctx.cursors['@ch']}")
+
+
+class FloodOnceClient(FakeClient):
+    """Первое чтение истории обрывается FloodWait после after сообщений"""
+
+    def __init__(self, channels, network, after):
+        super().__init__(channels, network)
+        self.after = after
+        self.flooded = False
+
+    async def iter_messages(self, entity, **kwargs):
+        count = 0
+        async for message in super().iter_messages(entity, **kwargs):
+            if not self.flooded and count == self.after:
+                self.flooded = True
+                # Запрос следующей страницы: совпадения успевают уйти в доставку
+                await asyncio.sleep(0.05)
+                raise FloodWaitError(None, capture=0)
+            count += 1
+            yield message
+
+
+async def check_failed_delivery(state_path):
+    """
+    Сбой доставки совпадения, поставленного в очередь до FloodWait и
+    повторного чтения канала, держит курсор ниже него; следующий прогон
+    досылает его без повторов.
+    """
+    messages = []
+    next_id = post_messages(messages, 1, 20)
+    channels = {'@ch': messages}
+    network = FakeNetwork()
+    ctx, bot = await check_run(channels, [news_set()], state_path,
+                               bot=FailingBot(network, fail_ids={20}),
+                               client=FloodOnceClient(channels, network, after=3))
+    expect(ctx.cursors.get('@ch', {}).get('news', 0) < 20, f"курсор перескочил сбой: {ctx.cursors}")
+    first = sent_keys(bot)
+    ctx, bot = await check_run(channels, [news_set()], state_path)
+    delivered = first + sent_keys(bot)
+    expect(sorted(key[2] for key in delivered) == list(range(2, next_id, 2)),
+           f"доставлено {sorted(key[2] for key in delivered)}")
+    expect(ctx.cursors['@ch']['news'] == next_id - 1, f"курсор {ctx.cursors['@ch']}")
+
+
+async def check_gap_paging(state_path):
+    """
+    Упор в глубину: провал под прочитанным дочитывается по частям, даже
+    когда новых постов каждый прогон больше глубины, — ничего не теряется.
+    """
+    for bursts in ([36, 6, 6, 6, 6, 6], [16] * 6 + [0] * 6):
+        if os.path.exists(state_path):
+            os.remove(state_path)
+        messages = []
+        next_id = 1
+        delivered = []
+        ctx = None
+        with overridden(SEARCH_DEPTH=10):
+            for count in bursts:
+                next_id = post_messages(messages, next_id, count, every=1)
+                ctx, bot = await check_run({'@ch': messages}, [news_set()], state_path)
+                delivered.extend(key[2] for key in sent_keys(bot))
+        expect(sorted(delivered) == list(range(1, next_id)),
+               f"{bursts}: пропущены {sorted(set(range(1, next_id)) - set(delivered))[:10]}, "
+               f"повторов {len(delivered) - len(set(delivered))}")
+        expect(ctx.cursors['@ch']['news'] == next_id - 1, f"{bursts}: курсор {ctx.cursors.get('@ch')}")
+
+
+async def check_daemon_contiguity(state_path):
+    """
+    Демон: событие двигает курсор, только примыкая к прочитанной истории;
+    если догонка канала упала, курсор не перескакивает непрочитанное.
+    """
+    for catch_up_fails in (False, True):
+        if os.path.exists(state_path):
+            os.remove(state_path)
+        messages = []
+        newest = post_messages(messages, 1, 20) - 1
+        network = FakeNetwork()
+        client = FakeClient({'@ch': messages}, network)
+        if catch_up_fails:
+            read_history = client.iter_messages
+
+            def broken(entity, **kwargs):
+                raise RuntimeError("catch-up failed")
+            client.iter_messages = broken
+        bot = FakeBot(network)
+        with overridden(DAEMON_CHECKPOINT_SECONDS=0.05):
+            task = asyncio.create_task(tm.run_monitor(client, bot, [news_set()], daemon=True,
+                                                      state_path=state_path))
+            while not client.handlers:
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(0.2)
+            handler = client.handlers[0][0]
+            chat_id = tm.telethon_utils.get_peer_id(await client.get_entity('@ch'))
+            for message_id in (newest + 2, newest + 6):
+                event = type('Event', (), {})()
+                event.chat_id = chat_id
+                event.message = ReplayMessage(message_id, datetime.now(timezone.utc), f"новость {message_id}")
+                await handler(event)
+                await asyncio.sleep(0.2)
+            await client.disconnect()
+            ctx = await task
+        if catch_up_fails:
+            client.iter_messages = read_history
+        events = {key[2] for key in sent_keys(bot)} & {newest + 2, newest + 6}
+        expect(events == {newest + 2, newest + 6}, f"события не доставлены: {sent_keys(bot)}")
+        cursor = ctx.cursors.get('@ch', {}).get('news')
+        if catch_up_fails:
+            expect(cursor is None, f"догонка упала, а курсор сдвинут до {cursor}")
+        else:
+            # newest + 1 пропущен (не пришёл событием): курсор ждёт прохода
+            expect(cursor == newest, f"курсор {cursor}, ожидался {newest}")
+
+
+async def check_bot_flood_metrics(state_path):
+    """
+    Каждый FloodWait бота доходит до очереди доставки: учтён в метриках
+    прогона (а не пересыпан Telethon молча), совпадения всё равно доставлены.
+    """
+    messages = []
+    post_messages(messages, 1, 40)
+    channels = {'@ch': messages}
+    bot_network = FakeNetwork(flood_rate=0.15, flood_seconds=0, seed=11)
+    ctx, bot = await check_run(channels, [news_set()], state_path, bot=FakeBot(bot_network),
+                               client=FakeClient(channels, FakeNetwork()))
+    floods = bot_network.floods['send_message']
+    counted = ctx.metrics.flood_waits['send_message']
+    expect(floods, "сценарий без FloodWait бота ничего не проверяет")
+    expect(counted == floods, f"FloodWait бота: в метриках {counted}, было {floods}")
+    expect(sorted(key[2] for key in sent_keys(bot)) == list(range(2, 41, 2)),
+           f"доставлено {sorted(key[2] for key in sent_keys(bot))}")
+
+
+def stored_fingerprints(state_path):
+    state = tm.StateStore(state_path)
+    try:
+        return state.load_fingerprints().size
+    finally:
+        state.close()
+
+
+async def check_near_duplicates(state_path):
+    """
+    Копия поста, отличающаяся только числами (время, цена), — почти-дубль;
+    отпечаток сохраняется только после подтверждённой доставки, и
+    отсеянная копия не теряется, когда доставка оригинала не удалась.
+    """
+    now = datetime.now(timezone.utc)
+    template = ("Главная новость дня: курс доллара вырос до {} рублей, биржа ждёт решения "
+                "регулятора по ставке в {} по московскому времени")
+    messages = [ReplayMessage(11, now - timedelta(minutes=1), template.format(93, "16:00")),
+                ReplayMessage(10, now - timedelta(minutes=2), template.format(92, "15:00"))]
+    channels = {'@ch': messages}
+    with overridden(NEAR_DUP_MODE='drop'):
+        network = FakeNetwork()
+        _, bot = await check_run(channels, [news_set()], state_path,
+                                 bot=FailingBot(network, fail_ids={10, 11}),
+                                 client=FakeClient(channels, network))
+        expect(not sent_keys(bot), f"отправлено при сбое доставки: {sent_keys(bot)}")
+        expect(stored_fingerprints(state_path) == 0, "сохранён отпечаток недоставленного поста")
+        _, bot = await check_run(channels, [news_set()], state_path)
+    expect([key[2] for key in sent_keys(bot)] == [11], f"после повтора отправлено {sent_keys(bot)}")
+    expect(stored_fingerprints(state_path) == 1,
+           f"отпечатков после доставки: {stored_fingerprints(state_path)}")
+
+
+async def check_merge_prune(state_path):
+    """
+    Слияние шардов удаляет из основного состояния (и из влитых шардов)
+    отметки и отпечатки старше PROCESSED_RETENTION_DAYS, свежие сохраняет.
+    """
+    shard_path = state_path + '.shard.db'
+    fresh = 0
+    for path, channel in ((state_path, '@ch'), (shard_path, '@other')):
+        messages = []
+        post_messages(messages, 1, 20)
+        await check_run({channel: messages}, [news_set([channel])], path)
+        state = tm.StateStore(path)
+        try:
+            fresh += state.count_processed()
+            stale = tm.day_bucket(datetime.now(timezone.utc)
+                                  - timedelta(days=tm.PROCESSED_RETENTION_DAYS + 30))
+            (channel_id,) = state.conn.execute("SELECT id FROM channels WHERE name = ?",
+                                               (channel,)).fetchone()
+            with state.conn:
+                state.conn.execute("INSERT INTO processed (channel_id, bucket, message_id, set_name) "
+                                   "VALUES (?, ?, 1000, 'news')", (channel_id, stale))
+                state.conn.execute("INSERT INTO fingerprints (set_name, bucket, simhash, channel, message_id) "
+                                   "VALUES ('news', ?, 1, ?, 1000)", (stale, channel))
+        finally:
+            state.close()
+
+    sets_json = json.dumps([{'name': 'news', 'channels': ['@ch', '@other'], 'keywords': ['новость'],
+                             'exclude': [], 'patterns': []}])
+    with overridden(MONITOR_SETS_JSON=sets_json):
+        tm.merge_shards([shard_path], state_path=state_path)
+    state = tm.StateStore(state_path)
+    try:
+        today = tm.day_bucket(datetime.now(timezone.utc))
+        buckets = [row[0] for row in state.conn.execute("SELECT bucket FROM processed")]
+        old_fingerprints = state.conn.execute("SELECT COUNT(*) FROM fingerprints WHERE bucket < ?",
+                                              (today - tm.PROCESSED_RETENTION_DAYS,)).fetchone()[0]
+        cursors = state.load_cursors()
+    finally:
+        state.close()
+    expect(len(buckets) == fresh, f"после слияния отметок {len(buckets)}, ожидалось {fresh} свежих")
+    expect(min(buckets) >= today - tm.PROCESSED_RETENTION_DAYS, "старые отметки пережили слияние")
+    expect(old_fingerprints == 0, f"старых отпечатков после слияния: {old_fingerprints}")
+    expect(set(cursors) == {'@ch', '@other'}, f"курсоры после слияния: {cursors}")
+
+
+CHECKS = (
+    check_sent_set,
+    check_cursor_resume,
+    check_failed_delivery,
+    check_gap_paging,
+    check_daemon_contiguity,
+    check_bot_flood_metrics,
+    check_near_duplicates,
+    check_merge_prune,
+)
+
+
+def run_checks():
+    """Прогоняет CHECKS; печатает итог по каждому, возвращает код выхода"""
+    failed = 0
+    for check in CHECKS:
+        log = io.StringIO()
+        started = time.perf_counter()
+        try:
+            with tempfile.TemporaryDirectory() as tmp_dir, overridden(**CHECK_SETTINGS), \
+                    overridden(PROCESSED_FILE=os.path.join(tmp_dir, 'processed.json'),
+                               CURSORS_FILE=os.path.join(tmp_dir, 'cursors.json')), \
+                    contextlib.redirect_stdout(log):
+                asyncio.run(check(os.path.join(tmp_dir, 'state.db')))
+        except CheckFailed as error:
+            failed += 1
+            print(f"❌ {check.__name__}: {error}")
+            print(''.join(log.getvalue().splitlines(keepends=True)[-30:]))
+            continue
+        print(f"✅ {check.__name__} ({time.perf_counter() - started:.2f} с)")
+    print(f"{'❌' if failed else '✅'} Сценариев: {len(CHECKS)}, провалено: {failed}")
+    return 1 if failed else 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Офлайн-прогон telegram_monitor на подменных клиентах")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--recordings', help="каталог с JSONL-записями (telegram_monitor.py --record)")
+    source.add_argument('--synthetic-channels', type=int, default=200,
+                        help="число синтетических каналов (если нет --recordings)")
+    parser.add_argument('--messages-per-channel', type=int, default=50,
+                        help="среднее число постов синтетического канала за окно")
+    parser.add_argument('--repost-rate', type=float, default=0.0,
+                        help="доля синтетических постов — копий постов других каналов")
+    parser.add_argument('--keep-dates', action='store_true',
+                        help="не сдвигать даты записей к текущему времени")
+    parser.add_argument('--config', help="JSON с наборами в формате MONITOR_SETS")
+    parser.add_argument('--sets', type=int, default=3, help="число синтетических наборов (без --config)")
+    parser.add_argument('--set-size', type=int, default=50,
+                        help="ключевых слов/исключений/паттернов в синтетическом наборе")
+    parser.add_argument('--latency-ms', type=float, default=0.0, help="задержка каждого запроса к API")
+    parser.add_argument('--flood-rate', type=float, default=0.0,
+                        help="вероятность FloodWaitError на запрос")
+    parser.add_argument('--flood-seconds', type=int, default=1, help="длительность FloodWait")
+    parser.add_argument('--workers', type=int, default=tm.SCAN_WORKERS, help="SCAN_WORKERS")
+    parser.add_argument('--api-rate', type=float, default=1e6,
+                        help="API_RATE_PER_SEC (по умолчанию фактически без ограничения, чтобы мерить конвейер)")
+    parser.add_argument('--bot-rate', type=float, default=1e6, help="BOT_RATE_PER_SEC")
+    parser.add_argument('--digest', action='store_true', help="DIGEST_MODE")
+    parser.add_argument('--pattern-sandbox', choices=['on', 'off'], default=tm.PATTERN_SANDBOX,
+                        help="PATTERN_SANDBOX")
+    parser.add_argument('--pattern-timeout-ms', type=float, default=tm.PATTERN_TIMEOUT_MS,
+                        help="PATTERN_TIMEOUT_MS")
+    parser.add_argument('--match-mode', choices=['token', 'substring'], default=tm.MATCH_MODE,
+                        help="MATCH_MODE")
+    parser.add_argument('--near-dup', choices=['off', 'drop', 'fold'], default=tm.NEAR_DUP_MODE,
+                        help="NEAR_DUP_MODE")
+    parser.add_argument('--search-pushdown', choices=['off', 'auto', 'always'], default=tm.SEARCH_PUSHDOWN,
+                        help="SEARCH_PUSHDOWN")
+    parser.add_argument('--match-workers', type=int, default=tm.MATCH_WORKERS, help="MATCH_WORKERS")
+    parser.add_argument('--match-queue', type=int, default=tm.MATCH_QUEUE_SIZE, help="MATCH_QUEUE_SIZE")
+    parser.add_argument('--delivery-workers', type=int, default=tm.DELIVERY_WORKERS,
+                        help="DELIVERY_WORKERS")
+    parser.add_argument('--delivery-queue', type=int, default=tm.DELIVERY_QUEUE_SIZE,
+                        help="DELIVERY_QUEUE_SIZE")
+    parser.add_argument('--adaptive-depth', choices=['on', 'off'], default=tm.ADAPTIVE_DEPTH,
+                        help="ADAPTIVE_DEPTH")
+    parser.add_argument('--poll-max-hours', type=float, default=tm.POLL_MAX_HOURS,
+                        help="POLL_MAX_HOURS (0 — читать все каналы в каждом прогоне)")
+    parser.add_argument('--shard', metavar='I/N', help="прогнать только каналы шарда I из N")
+    parser.add_argument('--state', help="файл состояния (по умолчанию — временный, чистый прогон)")
+    parser.add_argument('--archive', help="вести архив сообщений (ARCHIVE_DB) в этом файле")
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help="мерить пик памяти Python через tracemalloc (медленнее)")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help="куда сохранить JSON с результатами")
+    parser.add_argument('--sent-output', help="куда сохранить отправленные сообщения (JSONL)")
+    parser.add_argument('--check', action='store_true',
+                        help="прогнать регрессионные сценарии с проверками (CHECKS) и выйти")
+    return parser.parse_args()
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    if args.recordings:
+        channels = load_recordings(args.recordings, args.keep_dates)
+    else:
+        channels = generate_channels(
+            rng, args.synthetic_channels, args.messages_per_channel, tm.TIME_RANGE_HOURS,
+            args.repost_rate
+        )
+    total_messages = sum(len(messages) for messages in channels.values())
+    print(f"📚 Каналов: {len(channels)}, сообщений: {total_messages}")
+
+    if args.config:
+        monitor_sets = load_monitor_sets(args.config)
+    else:
+        monitor_sets = [
+            tm.attach_matcher(config)
+            for config in generate_sets(rng, list(channels), args.sets, args.set_size)
+        ]
+
+    if args.shard:
+        shard_index, shard_count = (int(part) for part in args.shard.split('/'))
+        monitor_sets = tm.shard_monitor_sets(monitor_sets, shard_index, shard_count)
+        print(f"🧩 Шард {shard_index + 1}/{shard_count}: каналов {len(tm.plan_channels(monitor_sets))}")
+
+    # Настройки конвейера — те же глобальные переменные, что читает main()
+    tm.SCAN_WORKERS = max(1, args.workers)
+    tm.API_RATE_PER_SEC = args.api_rate
+    tm.API_BURST = max(tm.API_BURST, tm.SCAN_WORKERS)
+    tm.BOT_RATE_PER_SEC = args.bot_rate
+    tm.DIGEST_MODE = args.digest
+    tm.SEARCH_PUSHDOWN = args.search_pushdown
+    tm.NEAR_DUP_MODE = args.near_dup
+    tm.ADAPTIVE_DEPTH = args.adaptive_depth
+    tm.MATCH_WORKERS = max(1, args.match_workers)
+    tm.MATCH_QUEUE_SIZE = max(1, args.match_queue)
+    tm.DELIVERY_WORKERS = max(1, args.delivery_workers)
+    tm.DELIVERY_QUEUE_SIZE = max(1, args.delivery_queue)
+    tm.POLL_MAX_HOURS = args.poll_max_hours
+    tm.MATCH_MODE = args.match_mode
+    tm.PATTERN_SANDBOX = args.pattern_sandbox
+    tm.PATTERN_TIMEOUT_MS = args.pattern_timeout_ms
+    tm.YOUR_USER_ID = 1
+
+    network = FakeNetwork(args.latency_ms, args.flood_rate, args.flood_seconds, args.seed)
+    client = FakeClient(channels, network)
+    bot = FakeBot(network, keep_sent=bool(args.sent_output))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        state_path = args.state or os.path.join(tmp_dir, 'replay_state.db')
+        # Легаси-JSON из рабочего каталога не должен мигрировать в состояние прогона
+        tm.PROCESSED_FILE = os.path.join(tmp_dir, tm.PROCESSED_FILE)
+        tm.CURSORS_FILE = os.path.join(tmp_dir, tm.CURSORS_FILE)
+        if args.tracemalloc:
+            tracemalloc.start()
+        started = time.perf_counter()
+        ctx = await tm.run_monitor(client, bot, monitor_sets, state_path=state_path,
+                                   archive_path=args.archive)
+        elapsed = time.perf_counter() - started
+        peak_kb = None
+        if args.tracemalloc:
+            peak_kb = tracemalloc.get_traced_memory()[1] // 1024
+            tracemalloc.stop()
+
+    fetched = network.calls['iter_messages']
+    result = {
+        'meta': {
+            'commit': git_commit(),
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'python': sys.version.split()[0],
+            'source': args.recordings or 'synthetic',
+            'channels': len(channels),
+            'messages': total_messages,
+            'sets': len(monitor_sets),
+            'latency_ms': args.latency_ms,
+            'flood_rate': args.flood_rate,
+            'workers': tm.SCAN_WORKERS,
+            'shard': args.shard,
+            'seed': args.seed,
+        },
+        'seconds': round(elapsed, 3),
+        'messages_per_sec': round(total_messages / elapsed, 1) if elapsed else None,
+        'api_calls': dict(network.calls),
+        'flood_waits': dict(network.floods),
+        'history_pages': fetched,
+        'sent_messages': bot.sent_count,
+        'stats': ctx.stats if ctx else None,
+        'errors': len(ctx.errors) if ctx else None,
+        'peak_rss_kb': peak_rss_kb(),
+        'tracemalloc_peak_kb': peak_kb,
+        # Инструментирование самого конвейера (фазы, каналы, наборы)
+        'metrics': ctx.metrics.snapshot(ctx) if ctx else None,
+    }
+    return result, bot.sent
+
+
+def main():
+    args = parse_args()
+    if args.check:
+        sys.exit(run_checks())
+    result, sent = asyncio.run(run(args))
+
+    print(f"\n{'='*60}")
+    print(f"⏱️ Прогон: {result['seconds']} с ({result['messages_per_sec']} сообщ/с)")
+    print(f"📡 Вызовы API: {result['api_calls']}")
+    if result['flood_waits']:
+        print(f"⏳ FloodWait: {result['flood_waits']}")
+    print(f"📤 Отправлено ботом: {result['sent_messages']}")
+    print(f"🧠 Пик RSS: {result['peak_rss_kb']} КБ, tracemalloc: {result['tracemalloc_peak_kb']} КБ")
+    print(f"{'='*60}")
+
+    for path, write in (
+        (args.output, lambda f: json.dump(result, f, ensure_ascii=False, indent=2)),
+        # Порядок отправки зависит от планирования — сортируем для сравнения
+        (args.sent_output, lambda f: f.writelines(
+            json.dumps(item, ensure_ascii=False, sort_keys=True) + "\n"
+            for item in sorted(sent, key=lambda item: item['text'])
+        )),
+    ):
+        if not path:
+            continue
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            write(f)
+        print(f"💾 Записано: {path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,35 @@
 import os
 import re
 from datetime import datetime, timedelta, timezone
-from telethon import TelegramClient
+from telethon import TelegramClient, events
 from telethon.sessions import StringSession
-from telethon.errors import FloodWaitError
+from telethon.errors import (
+    FloodWaitError, ChannelPrivateError, ChannelInvalidError, PeerIdInvalidError,
+)
+from telethon.crypto import AES
+from telethon.tl.types import InputPeerChannel, InputPeerChat, InputPeerUser
+from telethon import utils as telethon_utils
 import asyncio
+import argparse
+import hashlib
 import json
+import math
+import multiprocessing
+import queue
+import shutil
+import sqlite3
 import sys
+import threading
+import time
+import zlib
+from collections import Counter
+from contextlib import contextmanager
+from functools import lru_cache
+
+try:
+    from re import _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_parse
 
 # Конфигурация из переменных окружения.
 # Числовые значения парсятся в main() ПОСЛЕ проверки наличия переменных,
@@ -41,32 +64,192 @@ SEARCH_DEPTH = int(os.getenv('SEARCH_DEPTH', '100'))
 # Временной диапазон в часах (по умолчанию 24 часа)
 TIME_RANGE_HOURS = int(os.getenv('TIME_RANGE_HOURS', '24'))
 
-# Файл для хранения ID обработанных сообщений
+# Адаптивная глубина (ADAPTIVE_DEPTH=on): глубина канала — ожидаемое число
+# новых постов (постов в час × непрочитанные часы) с запасом
+# ADAPTIVE_DEPTH_HEADROOM, в пределах [ADAPTIVE_DEPTH_MIN, SEARCH_DEPTH_MAX].
+# После упора в глубину (окно прочитано не до конца) глубина канала
+# удваивается. Пока оценки нет, канал читается на SEARCH_DEPTH.
+# ADAPTIVE_DEPTH=off — всегда SEARCH_DEPTH.
+ADAPTIVE_DEPTH = os.getenv('ADAPTIVE_DEPTH', 'on').strip().lower()
+ADAPTIVE_DEPTH_MIN = max(1, int(os.getenv('ADAPTIVE_DEPTH_MIN', '20')))
+ADAPTIVE_DEPTH_HEADROOM = float(os.getenv('ADAPTIVE_DEPTH_HEADROOM', '1.5'))
+SEARCH_DEPTH_MAX = max(SEARCH_DEPTH, int(os.getenv('SEARCH_DEPTH_MAX', '1000')))
+
+# Расписание опроса при частых запусках (cron чаще окна) и в демоне: канал
+# проверяется, когда в нём ожидается POLL_TARGET_POSTS новых постов, но не
+# реже раза в POLL_MAX_HOURS часов; неактивные каналы — раз в
+# POLL_MAX_HOURS. Отложить канал можно, только если к следующему запуску
+# непрочитанное не выйдет за TIME_RANGE_HOURS. POLL_MAX_HOURS=0 — каждый
+# канал в каждом запуске.
+POLL_MAX_HOURS = float(os.getenv('POLL_MAX_HOURS', '6'))
+POLL_TARGET_POSTS = float(os.getenv('POLL_TARGET_POSTS', '1'))
+
+# Параллельное сканирование каналов: число одновременно сканируемых каналов
+SCAN_WORKERS = max(1, int(os.getenv('SCAN_WORKERS', '4')))
+
+# Общий лимит запросов к Telegram API (token bucket): средняя скорость
+# в запросах/сек и допустимый всплеск
+API_RATE_PER_SEC = float(os.getenv('API_RATE_PER_SEC', '1'))
+API_BURST = max(1, int(os.getenv('API_BURST', '5')))
+
+# Сколько раз перечитывать канал после FloodWaitError
+FLOOD_RETRIES = 3
+
+# Доставка совпадений ботом: свой лимит сообщений/сек и всплеск,
+# число попыток отправки при FloodWait
+BOT_RATE_PER_SEC = float(os.getenv('BOT_RATE_PER_SEC', '1'))
+BOT_BURST = max(1, int(os.getenv('BOT_BURST', '3')))
+SEND_RETRIES = 3
+
+# Прогон — потоковый конвейер: чтение каналов (SCAN_WORKERS) → матчинг
+# (MATCH_WORKERS) → доставка (DELIVERY_WORKERS; в режиме дайджеста — одна).
+# Стадии связаны очередями ограниченного размера: заполненная очередь
+# притормаживает предыдущую стадию, поэтому память не растёт с числом
+# каналов и глубиной чтения.
+MATCH_WORKERS = max(1, int(os.getenv('MATCH_WORKERS', '2')))
+MATCH_QUEUE_SIZE = max(1, int(os.getenv('MATCH_QUEUE_SIZE', '500')))
+DELIVERY_WORKERS = max(1, int(os.getenv('DELIVERY_WORKERS', '1')))
+DELIVERY_QUEUE_SIZE = max(1, int(os.getenv('DELIVERY_QUEUE_SIZE', '200')))
+
+# Режим дайджеста: совпадения, накопившиеся за окно, уходят одним
+# сообщением на набор (до лимита Telegram в 4096 символов)
+DIGEST_MODE = os.getenv('DIGEST_MODE', '').lower() in ('1', 'true', 'yes')
+DIGEST_WINDOW_SECONDS = float(os.getenv('DIGEST_WINDOW_SECONDS', '30'))
+DIGEST_ENTRY_CHARS = 700
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Режим демона (--daemon): как часто сохранять состояние (сек) и как часто
+# делать страховочный проход по истории (мин) — добирает то, что не пришло
+# событиями (каналы без подписки, разрывы обновлений), и ретраит неудачи
+DAEMON_CHECKPOINT_SECONDS = float(os.getenv('DAEMON_CHECKPOINT_SECONDS', '60'))
+DAEMON_RESYNC_MINUTES = float(os.getenv('DAEMON_RESYNC_MINUTES', '60'))
+
+# Размер страницы iter_messages в Telethon (один запрос GetHistory)
+MESSAGES_PER_REQUEST = 100
+
+# Поиск на стороне Telegram (iter_messages(search=...)) вместо листания
+# истории для каналов, все наборы которых состоят только из ключевых слов:
+#   off    — всегда листать историю (по умолчанию);
+#   auto   — выбирать по модели стоимости: запрос на каждое ключевое слово
+#            против страниц истории по оценке объёма канала;
+#   always — всегда искать, если канал подходит.
+# Поиск Telegram ищет по словам; с MATCH_MODE=substring локальный матчер
+# ищет по подстроке, и ключевое слово внутри слова («акци» в «транзакции»)
+# поиском не найдётся. Совпадения по основе (MATCH_MODE=token) поиск Telegram
+# находит не всегда — он сам решает, какие словоформы считать одним словом.
+SEARCH_PUSHDOWN = os.getenv('SEARCH_PUSHDOWN', 'off').strip().lower()
+
+# Состояние прогонов (обработанные сообщения, курсоры каналов) — SQLite
+STATE_DB = os.getenv('STATE_DB', 'monitor_state.db')
+
+# Сколько суток хранить отметки об обработанных сообщениях
+PROCESSED_RETENTION_DAYS = 30
+
+# Время жизни закэшированного резолва @username -> peer (часы)
+ENTITY_CACHE_TTL_HOURS = float(os.getenv('ENTITY_CACHE_TTL_HOURS', '168'))
+
+# Легаси-файлы состояния: читаются только для разовой миграции в STATE_DB
 PROCESSED_FILE = 'processed_messages.json'
+CURSORS_FILE = 'channel_cursors.json'
+
+# Запись ответов iter_messages в JSONL (по файлу на канал) для офлайн-
+# воспроизведения прогонов (replay_harness.py); пусто — не записывать
+RECORD_DIR = os.getenv('RECORD_DIR', '')
+
+# Метрики прогона: JSON и textfile для Prometheus (node_exporter textfile
+# collector); пусто — не писать. В режиме демона обновляются на чекпоинтах.
+METRICS_FILE = os.getenv('METRICS_FILE', '')
+METRICS_PROM_FILE = os.getenv('METRICS_PROM_FILE', '')
+
+# Локальный архив просканированных сообщений (SQLite + FTS5) для бэктеста
+# правил без повторного чтения каналов (--backtest); пусто — не вести.
+# Хранится ARCHIVE_RETENTION_DAYS суток.
+ARCHIVE_DB = os.getenv('ARCHIVE_DB', '')
+ARCHIVE_RETENTION_DAYS = int(os.getenv('ARCHIVE_RETENTION_DAYS', '30'))
+
+# Почти-дубли между каналами (один пост, разошедшийся по каналам):
+#   off  — не проверять (по умолчанию);
+#   drop — не отправлять копию, если набор уже получил такой пост;
+#   fold — дописать «Также в: …» к ещё не отправленному оригиналу
+#          (уже отправленный не редактируется — копия просто не уходит).
+# Похожесть — расстояние Хэмминга между SimHash текстов (из 64 бит);
+# короткие тексты (меньше NEAR_DUP_MIN_TOKENS слов) не сравниваются.
+NEAR_DUP_MODE = os.getenv('NEAR_DUP_MODE', 'off').strip().lower()
+NEAR_DUP_DISTANCE = int(os.getenv('NEAR_DUP_DISTANCE', '3'))
+NEAR_DUP_MIN_TOKENS = 8
+
+# Режим сопоставления ключевых слов и исключений:
+#   token     — текст сообщения один раз разбивается на слова (нижний регистр,
+#               ё → е), термин совпадает с началом слова или с его основой
+#               (русский стемминг): «акции» найдёт «акциях», но не «транзакции»;
+#               фразы — последовательности таких слов;
+#   substring — прежнее поведение (по умолчанию): ключевые слова по
+#               подстроке, исключения — по началу слова.
+# Переход на token меняет решения существующих наборов (пропадут совпадения
+# внутри слов, вроде «банк» в «Сбербанк»), поэтому он только явный: сверьте
+# наборы бэктестом по архиву (--backtest) в обоих режимах и лишь затем включайте.
+MATCH_MODE = os.getenv('MATCH_MODE', 'substring').strip().lower()
+
+# Паттерны (пользовательские regex) проверяются в пуле процессов с бюджетом
+# времени на каждый паттерн (без компиляции): медленный regex не держит
+# цикл событий.
+# Паттерн, превысивший бюджет PATTERN_QUARANTINE_AFTER раз, уходит в
+# карантин (не проверяется) на PATTERN_QUARANTINE_HOURS часов и попадает
+# в сводку ошибок. PATTERN_SANDBOX=off — проверять прямо в процессе.
+PATTERN_SANDBOX = os.getenv('PATTERN_SANDBOX', 'on').strip().lower()
+PATTERN_WORKERS = max(1, int(os.getenv('PATTERN_WORKERS', '2')))
+PATTERN_TIMEOUT_MS = float(os.getenv('PATTERN_TIMEOUT_MS', '250'))
+PATTERN_QUARANTINE_AFTER = max(1, int(os.getenv('PATTERN_QUARANTINE_AFTER', '3')))
+PATTERN_QUARANTINE_HOURS = float(os.getenv('PATTERN_QUARANTINE_HOURS', '168'))
+
+# Сессия бота (ключ авторизации и DC) сохраняется в базе состояния, и
+# следующий прогон стартует «тёпло»: без обмена ключами и входа по токену.
+# В базе она зашифрована ключом из BOT_TOKEN — база лежит в кэше и
+# артефактах Actions. Смена токена сбрасывает сохранённую сессию.
+# BOT_SESSION_REUSE=off — каждый раз входить заново.
+BOT_SESSION_REUSE = os.getenv('BOT_SESSION_REUSE', 'on').strip().lower()
 
 # Файл-блокировка для предотвращения параллельных запусков
 LOCK_FILE = '/tmp/telegram_search.lock'
 
+# Шардирование: каналы делятся между SHARD_COUNT воркерами по стабильному
+# хэшу имени, воркер SHARD_INDEX читает только свои. Каждый воркер пишет
+# своё состояние (monitor_state.shard-I-of-N.db, стартует с копии
+# STATE_DB), а шаг слияния (--merge-shards) собирает шарды в STATE_DB.
+# 0 — без шардирования. Лимит API_RATE_PER_SEC действует на воркер: при
+# одном аккаунте на всех делите общий бюджет на число шардов.
+# Одну сессию (ключ авторизации) нельзя держать из нескольких воркеров
+# одновременно — Telegram отзывает её (AUTH_KEY_DUPLICATED). Поэтому при
+# SHARD_COUNT > 1 у каждого шарда своя сессия пользователя
+# (SHARD_SESSION_STRING, в Actions — секрет SESSION_STRING_<I>), а бот
+# входит по токену заново, без сохранённой сессии (BOT_SESSION_REUSE
+# выключается).
+SHARD_INDEX = int(os.getenv('SHARD_INDEX', '0'))
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', '0'))
 
-def parse_monitor_sets():
+
+def parse_monitor_sets(sets_json=None):
     """
     Парсит конфигурацию наборов мониторинга
     Возвращает список наборов или None если используется старая конфигурация
+    sets_json — JSON наборов вместо MONITOR_SETS (например, для бэктеста)
     """
-    if not MONITOR_SETS_JSON:
+    if sets_json is None:
+        sets_json = MONITOR_SETS_JSON
+    if not sets_json:
         # Используем старую конфигурацию
         if CHANNELS or KEYWORDS or PATTERNS:
-            return [{
+            return [attach_matcher({
                 'name': 'default',
                 'channels': CHANNELS,
                 'keywords': KEYWORDS,
                 'exclude': EXCLUDE_KEYWORDS,
                 'patterns': PATTERNS
-            }]
+            })]
         return []
     
     try:
-        sets = json.loads(MONITOR_SETS_JSON)
+        sets = json.loads(sets_json)
         
         # Нормализуем данные
         normalized = []
@@ -76,26 +259,26 @@ def parse_monitor_sets():
                 print(f"⚠️ Пропущен некорректный набор: {s.get('name', 'unknown')}")
                 continue
                 
-            normalized.append({
+            normalized.append(attach_matcher({
                 'name': s.get('name', f'set_{len(normalized)+1}'),
                 'channels': [ch.strip() for ch in s.get('channels', []) if ch.strip()],
                 'keywords': [kw.strip().lower() for kw in s.get('keywords', []) if kw.strip()],
                 'exclude': [ex.strip().lower() for ex in s.get('exclude', []) if ex.strip()],
                 'patterns': [p.strip() for p in s.get('patterns', []) if p.strip()]
-            })
+            }))
         
         return normalized
     
     except json.JSONDecodeError as e:
         print(f"❌ Ошибка парсинга MONITOR_SETS JSON: {e}")
         print("Используется старая конфигурация")
-        return [{
+        return [attach_matcher({
             'name': 'default',
             'channels': CHANNELS,
             'keywords': KEYWORDS,
             'exclude': EXCLUDE_KEYWORDS,
             'patterns': PATTERNS
-        }]
+        })]
 
 
 def validate_monitor_set(monitor_set):
@@ -113,8 +296,31 @@ def validate_monitor_set(monitor_set):
     return True
 
 
+def parse_timestamp(timestamp):
+    """
+    ISO-строка -> aware datetime (UTC). Легаси-записи хранились без
+    таймзоны — считаем их UTC, иначе сравнение naive и aware дат бросит
+    TypeError. Некорректный timestamp — не теряем запись, считаем свежей.
+    """
+    try:
+        dt = datetime.fromisoformat(timestamp)
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=timezone.utc)
+        return dt
+    except (ValueError, TypeError):
+        return datetime.now(timezone.utc)
+
+
+def day_bucket(dt):
+    """Номер суток от эпохи (UTC) — единица хранения и очистки состояния"""
+    return int(dt.timestamp() // 86400)
+
+
 def load_processed_messages():
-    """Загружает список уже обработанных сообщений"""
+    """
+    Загружает список уже обработанных сообщений из легаси-JSON.
+    Используется только для разовой миграции в StateStore.
+    """
     if os.path.exists(PROCESSED_FILE):
         with open(PROCESSED_FILE, 'r', encoding='utf-8') as f:
             data = json.load(f)
@@ -127,28 +333,780 @@ def load_processed_messages():
     return {}
 
 
-def save_processed_messages(processed_dict):
-    """Сохраняет список обработанных сообщений с очисткой старых"""
-    # Удаляем записи старше 30 дней
-    cutoff_date = datetime.now(timezone.utc) - timedelta(days=30)
-    cleaned = {}
-    for msg_id, timestamp in processed_dict.items():
+def load_channel_cursors():
+    """
+    Загружает курсоры каналов из легаси-JSON:
+    {"@channel": {"set_name": last_message_id}}.
+    Используется только для разовой миграции в StateStore.
+    """
+    if os.path.exists(CURSORS_FILE):
+        try:
+            with open(CURSORS_FILE, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if isinstance(data, dict):
+                return data
+        except (OSError, ValueError) as e:
+            # Без курсоров просто читаем полное окно — дубли отсечёт processed
+            print(f"⚠️ Не удалось прочитать {CURSORS_FILE}: {e}")
+    return {}
+
+
+def split_processed_key(key):
+    """
+    "@channel:id[#set]" -> (канал, ID, набор). Ключ, не подходящий под
+    формат, считается каналом целиком с ID -1 — так он тоже не теряется.
+    """
+    base, _, set_name = key.partition('#')
+    channel, _, message_id = base.rpartition(':')
+    if not channel or not message_id.lstrip('-').isdigit():
+        return key, -1, ''
+    return channel, int(message_id), set_name
+
+
+class ProcessedIndex:
+    """
+    Множество обработанных ключей ("@channel:id") с dict-подобным
+    интерфейсом: `key in index` — O(1) по set в памяти, `index[key] = iso`
+    добавляет ключ и ставит его в очередь на дозапись в StateStore.
+    Ключи канала подгружаются из базы при первом обращении к нему, поэтому
+    стоимость загрузки зависит от числа затронутых каналов, а не от объёма
+    всей истории.
+    """
+
+    def __init__(self, loader):
+        self._loader = loader
+        self._keys = set()
+        self._loaded_channels = set()
+        self._pending = {}
+
+    def _ensure_loaded(self, key):
+        channel = split_processed_key(key)[0]
+        if channel not in self._loaded_channels:
+            self._loaded_channels.add(channel)
+            self._keys.update(self._loader(channel))
+
+    def __contains__(self, key):
+        self._ensure_loaded(key)
+        return key in self._keys
+
+    def __setitem__(self, key, timestamp):
+        self._ensure_loaded(key)
+        self._keys.add(key)
+        self._pending[key] = timestamp
+
+    def take_pending(self):
+        """Забирает ключи, добавленные с прошлого сохранения"""
+        pending = self._pending
+        self._pending = {}
+        return pending
+
+
+# Поля статистики канала (колонки channel_stats после имени канала)
+CHANNEL_STATS_FIELDS = ('posts_per_hour', 'scanned_at', 'checked_at', 'last_post_at',
+                        'depth', 'scans', 'cap_hits', 'truncated',
+                        'gap_min_id', 'gap_offset_id', 'read_max_id')
+
+
+def session_key(secret):
+    """Ключ шифрования сессии, выведенный из секрета клиента (токена бота)"""
+    return hashlib.sha256(b'telegram_search/session:' + secret.encode('utf-8')).digest()
+
+
+def seal_session(session_string, secret):
+    """
+    Шифрует строку сессии (AES-IGE из Telethon) ключом из секрета.
+    Перед данными — их SHA-256: по нему open_session отличает чужой ключ
+    (сменился токен) от своей сессии.
+    """
+    data = session_string.encode('utf-8')
+    payload = hashlib.sha256(data).digest() + data
+    payload += bytes(-len(payload) % 16)
+    iv = os.urandom(32)
+    return iv + AES.encrypt_ige(payload, session_key(secret), iv)
+
+
+def open_session(sealed, secret):
+    """Строка сессии из seal_session или None, если секрет не тот"""
+    if len(sealed) < 64 or len(sealed) % 16:
+        return None
+    payload = AES.decrypt_ige(sealed[32:], session_key(secret), sealed[:32])
+    digest, data = payload[:32], payload[32:].rstrip(b'\0')
+    if hashlib.sha256(data).digest() != digest:
+        return None
+    return data.decode('utf-8')
+
+
+class StateStore:
+    """
+    Состояние прогонов в одном SQLite-файле (STATE_DB) вместо полной
+    перезаписи JSON:
+      processed — отметки (канал, сутки, ID сообщения, набор). Канал
+                  хранится ссылкой на таблицу channels, ID — целым числом,
+                  время — номером суток (bucket). Новые отметки
+                  дописываются, а очистка удаляет целые старые сутки
+                  диапазоном по первичному ключу без разбора каждой даты;
+      cursors   — последний проверенный ID по каналу и набору;
+      entities  — кэш резолва @username -> peer (см. EntityCache);
+      channel_stats — статистика канала: постов в час, последний пост,
+                  глубина чтения, число проходов и упоров в глубину, время
+                  последнего чтения и последней проверки расписанием (для
+                  выбора между поиском и листанием, адаптивной глубины и
+                  расписания опроса), непрочитанный провал после упора в
+                  глубину;
+      fingerprints — SimHash отправленных совпадений по наборам для
+                  отсева почти-дублей (тот же горизонт, что и processed);
+      pattern_quarantine — превышения бюджета времени паттернами и
+                  карантин (см. PatternSandbox);
+      sessions  — зашифрованные сессии клиентов (см. BOT_SESSION_REUSE).
+    При первом открытии переносит данные из processed_messages.json
+    (словарь или старый список) и channel_cursors.json.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS channels (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE
+        );
+        CREATE TABLE IF NOT EXISTS processed (
+            channel_id INTEGER NOT NULL,
+            bucket INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            set_name TEXT NOT NULL DEFAULT '',
+            PRIMARY KEY (channel_id, bucket, message_id, set_name)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS cursors (
+            channel TEXT NOT NULL,
+            set_name TEXT NOT NULL,
+            message_id INTEGER NOT NULL,
+            PRIMARY KEY (channel, set_name)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS channel_stats (
+            channel TEXT PRIMARY KEY,
+            posts_per_hour REAL NOT NULL,
+            scanned_at TEXT NOT NULL,
+            checked_at TEXT,
+            last_post_at TEXT,
+            depth INTEGER,
+            scans INTEGER NOT NULL DEFAULT 0,
+            cap_hits INTEGER NOT NULL DEFAULT 0,
+            truncated INTEGER NOT NULL DEFAULT 0,
+            gap_min_id INTEGER,
+            gap_offset_id INTEGER,
+            read_max_id INTEGER
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS fingerprints (
+            set_name TEXT NOT NULL,
+            bucket INTEGER NOT NULL,
+            simhash INTEGER NOT NULL,
+            channel TEXT NOT NULL,
+            message_id INTEGER NOT NULL,
+            PRIMARY KEY (set_name, bucket, simhash, channel, message_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS pattern_quarantine (
+            pattern TEXT PRIMARY KEY,
+            timeouts INTEGER NOT NULL,
+            last_timeout_at TEXT NOT NULL,
+            quarantined_at TEXT
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS sessions (
+            name TEXT PRIMARY KEY,
+            sealed BLOB NOT NULL,
+            saved_at TEXT NOT NULL
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS entities (
+            username TEXT PRIMARY KEY,
+            peer_type TEXT NOT NULL,
+            peer_id INTEGER NOT NULL,
+            access_hash INTEGER,
+            resolved_at INTEGER NOT NULL
+        ) WITHOUT ROWID;
+    """
+
+    # Колонки, добавленные в таблицы после их появления: в базах прошлых
+    # версий CREATE TABLE IF NOT EXISTS их не создаст
+    ADDED_COLUMNS = {
+        'channel_stats': (
+            ('checked_at', 'TEXT'),
+            ('last_post_at', 'TEXT'),
+            ('depth', 'INTEGER'),
+            ('scans', 'INTEGER NOT NULL DEFAULT 0'),
+            ('cap_hits', 'INTEGER NOT NULL DEFAULT 0'),
+            ('truncated', 'INTEGER NOT NULL DEFAULT 0'),
+            ('gap_min_id', 'INTEGER'),
+            ('gap_offset_id', 'INTEGER'),
+            ('read_max_id', 'INTEGER'),
+        ),
+    }
+
+    # Полный VACUUM (перезапись всего файла) — только если свободные страницы
+    # занимают больше этой доли файла; обычно хватает incremental_vacuum
+    VACUUM_FREE_RATIO = 0.5
+
+    def __init__(self, path=STATE_DB):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        # Новые базы создаются с инкрементальным авто-вакуумом; уже
+        # существующие переходят на него при первом полном VACUUM
+        self.conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        self.conn.executescript(self.SCHEMA)
+        self._migrate_columns()
+        self._channel_ids = {
+            name: channel_id for channel_id, name in self.conn.execute("SELECT id, name FROM channels")
+        }
+        self._migrate_legacy()
+
+    def _channel_id(self, name):
+        """ID канала в таблице channels (создаётся при первом обращении)"""
+        channel_id = self._channel_ids.get(name)
+        if channel_id is None:
+            channel_id = self.conn.execute(
+                "INSERT INTO channels (name) VALUES (?)", (name,)
+            ).lastrowid
+            self._channel_ids[name] = channel_id
+        return channel_id
+
+    def _processed_rows(self, entries):
+        """("@channel:id[#set]", iso) -> строки таблицы processed"""
+        for key, timestamp in entries:
+            channel, message_id, set_name = split_processed_key(key)
+            yield (self._channel_id(channel), day_bucket(parse_timestamp(timestamp)),
+                   message_id, set_name)
+
+    def _migrate_columns(self):
+        with self.conn:
+            for table, columns in self.ADDED_COLUMNS.items():
+                existing = {row[1] for row in self.conn.execute(f"PRAGMA table_info({table})")}
+                for name, definition in columns:
+                    if name not in existing:
+                        self.conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+
+    def _migrate_legacy(self):
+        """Разовый перенос легаси-JSON (в одной транзакции с флагом миграции)"""
+        if self.conn.execute("SELECT 1 FROM meta WHERE key = 'migrated'").fetchone():
+            return
+
+        processed = load_processed_messages()
+        cursors = load_channel_cursors()
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO processed (channel_id, bucket, message_id, set_name) VALUES (?, ?, ?, ?)",
+                self._processed_rows(processed.items())
+            )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO cursors (channel, set_name, message_id) VALUES (?, ?, ?)",
+                ((channel, set_name, int(message_id))
+                 for channel, set_cursors in cursors.items()
+                 for set_name, message_id in set_cursors.items())
+            )
+            self.conn.execute(
+                "INSERT INTO meta (key, value) VALUES ('migrated', ?)",
+                (datetime.now(timezone.utc).isoformat(),)
+            )
+        if processed or cursors:
+            print(f"📦 Миграция состояния в {self.path}: "
+                  f"{len(processed)} обработанных, {len(cursors)} курсоров")
+
+    def count_processed(self):
+        return self.conn.execute("SELECT COUNT(*) FROM processed").fetchone()[0]
+
+    def _load_channel_keys(self, channel):
+        """Ключи processed одного канала (загрузчик для ProcessedIndex)"""
+        channel_id = self._channel_ids.get(channel)
+        if channel_id is None:
+            return []
+        rows = self.conn.execute(
+            "SELECT message_id, set_name FROM processed WHERE channel_id = ?", (channel_id,)
+        )
+        return [
+            channel if message_id == -1
+            else f"{channel}:{message_id}#{set_name}" if set_name
+            else f"{channel}:{message_id}"
+            for message_id, set_name in rows
+        ]
+
+    def load_processed(self):
+        """ProcessedIndex, подгружающий ключи канала из базы по требованию"""
+        return ProcessedIndex(self._load_channel_keys)
+
+    def save_processed(self, processed):
+        """
+        Дописывает новые ключи и удаляет сутки старше PROCESSED_RETENTION_DAYS
+        (граничные сутки сохраняются целиком — лучше лишний день, чем дубль).
+        Возвращает количество удалённых записей.
+        """
+        pending = processed.take_pending()
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO processed (channel_id, bucket, message_id, set_name) VALUES (?, ?, ?, ?)",
+                self._processed_rows(pending.items())
+            )
+            removed = self._prune_processed()
+        if removed:
+            self._reclaim_free_pages()
+        return removed
+
+    def _prune_processed(self):
+        """Удаляет сутки processed старше PROCESSED_RETENTION_DAYS (внутри транзакции вызывающего)"""
+        cutoff = day_bucket(datetime.now(timezone.utc) - timedelta(days=PROCESSED_RETENTION_DAYS))
+        removed = 0
+        # ID — из таблицы: слияние шардов добавляет каналы мимо _channel_ids
+        for (channel_id,) in self.conn.execute("SELECT id FROM channels").fetchall():
+            # Диапазон по префиксу первичного ключа (channel_id, bucket)
+            removed += self.conn.execute(
+                "DELETE FROM processed WHERE channel_id = ? AND bucket < ?", (channel_id, cutoff)
+            ).rowcount
+        return removed
+
+    def _prune_fingerprints(self):
+        """Удаляет отпечатки старше PROCESSED_RETENTION_DAYS (внутри транзакции вызывающего)"""
+        cutoff = day_bucket(datetime.now(timezone.utc) - timedelta(days=PROCESSED_RETENTION_DAYS))
+        return self.conn.execute("DELETE FROM fingerprints WHERE bucket < ?", (cutoff,)).rowcount
+
+    def prune(self):
+        """
+        Очистка по сроку хранения без новых записей — для состояния, которое
+        пишет только шаг слияния шардов: старые сутки processed и отпечатки
+        удаляются так же, как при обычном сохранении, освободившиеся
+        страницы возвращаются. Возвращает (отметок, отпечатков) удалено.
+        """
+        with self.conn:
+            removed = self._prune_processed()
+            removed_fingerprints = self._prune_fingerprints()
+        if removed or removed_fingerprints:
+            self._reclaim_free_pages()
+        return removed, removed_fingerprints
+
+    def _reclaim_free_pages(self):
+        """
+        Возвращает освободившиеся после удаления суток страницы, чтобы файл
+        в кэше не рос: incremental_vacuum отрезает только свободные страницы
+        в конце файла, не переписывая базу. Полный VACUUM — лишь для базы
+        без авто-вакуума (созданной раньше), когда свободного места много.
+        """
+        if self.conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            # executescript прогоняет прагму до конца (execute освобождает
+            # лишь одну страницу за шаг)
+            self.conn.executescript("PRAGMA incremental_vacuum")
+            return
+        free_pages = self.conn.execute("PRAGMA freelist_count").fetchone()[0]
+        total_pages = self.conn.execute("PRAGMA page_count").fetchone()[0]
+        if total_pages and free_pages / total_pages > self.VACUUM_FREE_RATIO:
+            self.conn.execute("VACUUM")
+
+    def merge_shard(self, path):
+        """
+        Вливает состояние шарда (файл StateStore другого воркера):
+          processed     — объединение отметок (ID каналов сопоставляются по имени);
+          cursors       — максимум: курсор только растёт, владелец канала
+                          всегда впереди копий из стартового состояния;
+          entities      — более свежий резолв (resolved_at);
+          channel_stats — более свежая статистика (checked_at);
+          fingerprints  — объединение отпечатков почти-дублей;
+          pattern_quarantine — максимум таймаутов, карантин — если он есть
+                          хоть в одной копии;
+          sessions      — более свежая сессия (saved_at).
+        Возвращает число добавленных отметок processed.
+        """
+        self.conn.execute("ATTACH DATABASE ? AS shard", (path,))
+        try:
+            with self.conn:
+                before = self.count_processed()
+                self.conn.execute("INSERT OR IGNORE INTO channels (name) SELECT name FROM shard.channels")
+                self.conn.execute("""
+                    INSERT OR IGNORE INTO processed (channel_id, bucket, message_id, set_name)
+                    SELECT c.id, p.bucket, p.message_id, p.set_name
+                    FROM shard.processed p
+                    JOIN shard.channels sc ON sc.id = p.channel_id
+                    JOIN channels c ON c.name = sc.name
+                """)
+                self.conn.execute("""
+                    INSERT INTO cursors (channel, set_name, message_id)
+                    SELECT channel, set_name, message_id FROM shard.cursors WHERE true
+                    ON CONFLICT (channel, set_name)
+                    DO UPDATE SET message_id = max(message_id, excluded.message_id)
+                """)
+                self.conn.execute("""
+                    INSERT INTO entities (username, peer_type, peer_id, access_hash, resolved_at)
+                    SELECT username, peer_type, peer_id, access_hash, resolved_at FROM shard.entities WHERE true
+                    ON CONFLICT (username) DO UPDATE SET
+                        peer_type = excluded.peer_type, peer_id = excluded.peer_id,
+                        access_hash = excluded.access_hash, resolved_at = excluded.resolved_at
+                    WHERE excluded.resolved_at > entities.resolved_at
+                """)
+                self.conn.execute("""
+                    INSERT INTO channel_stats (channel, posts_per_hour, scanned_at, checked_at,
+                                               last_post_at, depth, scans, cap_hits, truncated,
+                                               gap_min_id, gap_offset_id, read_max_id)
+                    SELECT channel, posts_per_hour, scanned_at, checked_at,
+                           last_post_at, depth, scans, cap_hits, truncated,
+                           gap_min_id, gap_offset_id, read_max_id
+                    FROM shard.channel_stats WHERE true
+                    ON CONFLICT (channel) DO UPDATE SET
+                        posts_per_hour = excluded.posts_per_hour, scanned_at = excluded.scanned_at,
+                        checked_at = excluded.checked_at, last_post_at = excluded.last_post_at,
+                        depth = excluded.depth, scans = excluded.scans, cap_hits = excluded.cap_hits,
+                        truncated = excluded.truncated, gap_min_id = excluded.gap_min_id,
+                        gap_offset_id = excluded.gap_offset_id, read_max_id = excluded.read_max_id
+                    WHERE coalesce(excluded.checked_at, excluded.scanned_at)
+                          > coalesce(channel_stats.checked_at, channel_stats.scanned_at)
+                """)
+                self.conn.execute(
+                    "INSERT OR IGNORE INTO fingerprints SELECT * FROM shard.fingerprints"
+                )
+                self.conn.execute("""
+                    INSERT INTO pattern_quarantine (pattern, timeouts, last_timeout_at, quarantined_at)
+                    SELECT pattern, timeouts, last_timeout_at, quarantined_at
+                    FROM shard.pattern_quarantine WHERE true
+                    ON CONFLICT (pattern) DO UPDATE SET
+                        timeouts = max(timeouts, excluded.timeouts),
+                        last_timeout_at = max(last_timeout_at, excluded.last_timeout_at),
+                        quarantined_at = coalesce(quarantined_at, excluded.quarantined_at)
+                """)
+                self.conn.execute("""
+                    INSERT INTO sessions (name, sealed, saved_at)
+                    SELECT name, sealed, saved_at FROM shard.sessions WHERE true
+                    ON CONFLICT (name) DO UPDATE SET
+                        sealed = excluded.sealed, saved_at = excluded.saved_at
+                    WHERE excluded.saved_at > sessions.saved_at
+                """)
+                # Шард уже мигрировал легаси-JSON — повторная миграция не нужна
+                self.conn.execute("INSERT OR IGNORE INTO meta (key, value) SELECT key, value FROM shard.meta")
+                added = self.count_processed() - before
+        finally:
+            self.conn.execute("DETACH DATABASE shard")
+        self._channel_ids = {
+            name: channel_id for channel_id, name in self.conn.execute("SELECT id, name FROM channels")
+        }
+        return added
+
+    def load_cursors(self):
+        """Курсоры каналов: {"@channel": {"set_name": last_message_id}}"""
+        cursors = {}
+        for channel, set_name, message_id in self.conn.execute(
+                "SELECT channel, set_name, message_id FROM cursors"):
+            cursors.setdefault(channel, {})[set_name] = message_id
+        return cursors
+
+    def save_cursors(self, cursors, monitor_sets):
+        """Сохраняет курсоры только для каналов и наборов из текущей конфигурации"""
+        rows = []
+        for channel, subscribed in plan_channels(monitor_sets).items():
+            set_cursors = cursors.get(channel, {})
+            for monitor_set in subscribed:
+                if monitor_set['name'] in set_cursors:
+                    rows.append((channel, monitor_set['name'], set_cursors[monitor_set['name']]))
+        with self.conn:
+            self.conn.execute("DELETE FROM cursors")
+            self.conn.executemany(
+                "INSERT INTO cursors (channel, set_name, message_id) VALUES (?, ?, ?)", rows
+            )
+
+    def load_channel_stats(self):
+        """
+        Статистика каналов: {"@channel": {"posts_per_hour": x, "scanned_at": iso,
+        "checked_at": iso, "last_post_at": iso|None, "depth": n|None,
+        "scans": n, "cap_hits": n, "truncated": 0|1,
+        "gap_min_id": id|None, "gap_offset_id": id|None, "read_max_id": id|None}}
+        (gap_* и read_max_id — см. channel_gap)
+        """
+        return {
+            row[0]: dict(zip(CHANNEL_STATS_FIELDS, row[1:]))
+            for row in self.conn.execute(
+                "SELECT channel, posts_per_hour, scanned_at, coalesce(checked_at, scanned_at), "
+                "last_post_at, depth, scans, cap_hits, truncated, "
+                "gap_min_id, gap_offset_id, read_max_id FROM channel_stats")
+        }
+
+    def save_channel_stats(self, channel_stats):
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO channel_stats (channel, posts_per_hour, scanned_at, checked_at, "
+                "last_post_at, depth, scans, cap_hits, truncated, gap_min_id, gap_offset_id, read_max_id) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                ((channel, *(stats.get(field) for field in CHANNEL_STATS_FIELDS))
+                 for channel, stats in channel_stats.items())
+            )
+
+    def load_fingerprints(self):
+        """Индекс почти-дублей из отпечатков за PROCESSED_RETENTION_DAYS"""
+        cutoff = day_bucket(datetime.now(timezone.utc) - timedelta(days=PROCESSED_RETENTION_DAYS))
+        rows = self.conn.execute(
+            "SELECT set_name, simhash, channel, message_id FROM fingerprints WHERE bucket >= ?", (cutoff,)
+        )
+        return NearDuplicateIndex(
+            NEAR_DUP_DISTANCE,
+            ((set_name, simhash & SIMHASH_MASK, channel, message_id)
+             for set_name, simhash, channel, message_id in rows)
+        )
+
+    def save_fingerprints(self, index):
+        """Дописывает новые отпечатки и удаляет старше PROCESSED_RETENTION_DAYS"""
+        today = day_bucket(datetime.now(timezone.utc))
+        with self.conn:
+            # SQLite INTEGER знаковый — храним 64 бита как знаковое число
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO fingerprints (set_name, bucket, simhash, channel, message_id) "
+                "VALUES (?, ?, ?, ?, ?)",
+                ((set_name, today, simhash - (1 << 64) if simhash >> 63 else simhash, channel, message_id)
+                 for set_name, simhash, channel, message_id in index.take_pending())
+            )
+            return self._prune_fingerprints()
+
+    def load_pattern_quarantine(self, patterns):
+        """
+        История таймаутов паттернов текущей конфигурации (для PatternSandbox).
+        Записи старше PATTERN_QUARANTINE_HOURS (по карантину или последнему
+        таймауту) не загружаются — паттерн получает ещё одну попытку.
+        """
+        cutoff = (datetime.now(timezone.utc) - timedelta(hours=PATTERN_QUARANTINE_HOURS)).isoformat()
+        return {
+            pattern: {'timeouts': timeouts, 'last_timeout_at': last_timeout_at,
+                      'quarantined_at': quarantined_at}
+            for pattern, timeouts, last_timeout_at, quarantined_at in self.conn.execute(
+                "SELECT pattern, timeouts, last_timeout_at, quarantined_at FROM pattern_quarantine "
+                "WHERE coalesce(quarantined_at, last_timeout_at) >= ?", (cutoff,))
+            if pattern in patterns
+        }
+
+    def save_pattern_quarantine(self, history):
+        with self.conn:
+            self.conn.execute("DELETE FROM pattern_quarantine")
+            self.conn.executemany(
+                "INSERT INTO pattern_quarantine (pattern, timeouts, last_timeout_at, quarantined_at) "
+                "VALUES (?, ?, ?, ?)",
+                ((pattern, entry['timeouts'], entry['last_timeout_at'], entry['quarantined_at'])
+                 for pattern, entry in history.items())
+            )
+
+    def load_session(self, name, secret):
+        """Сохранённая строка сессии клиента name (None — нет или другой секрет)"""
+        row = self.conn.execute("SELECT sealed FROM sessions WHERE name = ?", (name,)).fetchone()
+        return open_session(row[0], secret) if row else None
+
+    def save_session(self, name, session_string, secret):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO sessions (name, sealed, saved_at) VALUES (?, ?, ?)",
+                (name, seal_session(session_string, secret), datetime.now(timezone.utc).isoformat())
+            )
+
+    def entity_cache(self):
+        """Кэш резолва каналов поверх той же базы"""
+        return EntityCache(self.conn, ENTITY_CACHE_TTL_HOURS)
+
+    def close(self):
+        self.conn.close()
+
+
+class EntityCache:
+    """
+    Кэш резолва @username -> (peer id, access_hash) в STATE_DB.
+    С новым StringSession каждый get_entity по username — это
+    ResolveUsername, один из самых жёстко ограниченных методов Telegram.
+    Попадание в кэш отдаёт готовый InputPeer без запроса в сеть; запись
+    устаревает через ENTITY_CACHE_TTL_HOURS и сбрасывается, если работа
+    с закэшированным peer завершилась ошибкой.
+    """
+
+    PEER_TYPES = {
+        'channel': InputPeerChannel,
+        'chat': InputPeerChat,
+        'user': InputPeerUser,
+    }
+
+    def __init__(self, conn, ttl_hours):
+        self.conn = conn
+        self.ttl_seconds = ttl_hours * 3600
+        self.hits = 0
+        self.misses = 0
+        self.invalidated = 0
+
+    def get(self, username):
+        """InputPeer из кэша или None (нет записи / истёк TTL)"""
+        row = self.conn.execute(
+            "SELECT peer_type, peer_id, access_hash, resolved_at FROM entities WHERE username = ?",
+            (username,)
+        ).fetchone()
+        if row is None or time.time() - row[3] > self.ttl_seconds:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        peer_type, peer_id, access_hash, _ = row
+        if peer_type == 'chat':
+            return InputPeerChat(peer_id)
+        return self.PEER_TYPES[peer_type](peer_id, access_hash)
+
+    def put(self, username, entity):
+        """Запоминает entity, полученный от get_entity"""
+        try:
+            peer = telethon_utils.get_input_peer(entity)
+        except TypeError:
+            # Не peer (например, self/неподдерживаемый тип) — просто не кэшируем
+            return
+        if isinstance(peer, InputPeerChannel):
+            row = ('channel', peer.channel_id, peer.access_hash)
+        elif isinstance(peer, InputPeerUser):
+            row = ('user', peer.user_id, peer.access_hash)
+        elif isinstance(peer, InputPeerChat):
+            row = ('chat', peer.chat_id, None)
+        else:
+            return
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO entities (username, peer_type, peer_id, access_hash, resolved_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (username, *row, int(time.time()))
+            )
+
+    def invalidate(self, username):
+        with self.conn:
+            self.conn.execute("DELETE FROM entities WHERE username = ?", (username,))
+        self.invalidated += 1
+
+
+class MessageArchive:
+    """
+    Архив просканированных сообщений: (канал, ID, дата, текст) в SQLite.
+    Пишется в monitor_channel (сообщения из окна TIME_RANGE_HOURS) и из
+    событий демона; дозапись пачками по FLUSH_BATCH и на чекпоинтах (буфер
+    не растёт с числом каналов и глубиной чтения). Если SQLite собран с
+    FTS5, текст дополнительно индексируется для полнотекстового отбора
+    (--backtest-fts). Бэктест (backtest) прогоняет по архиву матчеры
+    кандидатной конфигурации без единого запроса к Telegram.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY,
+            channel TEXT NOT NULL,
+            message_id INTEGER NOT NULL,
+            date INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            UNIQUE (channel, message_id)
+        );
+        CREATE INDEX IF NOT EXISTS messages_date ON messages (date);
+    """
+
+    # Внешний контент: FTS хранит только индекс, текст — в messages
+    FTS_SCHEMA = """
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            text, content='messages', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 0'
+        );
+        CREATE TRIGGER IF NOT EXISTS messages_ai AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text);
+        END;
+        CREATE TRIGGER IF NOT EXISTS messages_ad AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.id, old.text);
+        END;
+        CREATE TRIGGER IF NOT EXISTS messages_au AFTER UPDATE OF text ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.id, old.text);
+            INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text);
+        END;
+    """
+
+    FLUSH_BATCH = 500
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(self.SCHEMA)
         try:
-            dt = datetime.fromisoformat(timestamp)
-            # Легаси-записи хранились без таймзоны — считаем их UTC,
-            # иначе сравнение naive и aware дат бросит TypeError.
-            if dt.tzinfo is None:
-                dt = dt.replace(tzinfo=timezone.utc)
-        except (ValueError, TypeError):
-            # Некорректный timestamp — не теряем запись, считаем свежей
-            dt = datetime.now(timezone.utc)
-        if dt > cutoff_date:
-            cleaned[msg_id] = timestamp
+            self.conn.executescript(self.FTS_SCHEMA)
+            self.fts = True
+        except sqlite3.OperationalError:
+            # SQLite без FTS5 — архив работает, но без полнотекстового отбора
+            self.fts = False
+        self._pending = []
+
+    def add(self, channel_username, message):
+        text = message.text or ""
+        if not text:
+            return
+        self._pending.append((channel_username, message.id, int(message.date.timestamp()), text))
+        if len(self._pending) >= self.FLUSH_BATCH:
+            self.flush()
+
+    def flush(self):
+        """Дописывает накопленное; изменённый текст (правка поста) обновляется"""
+        if not self._pending:
+            return 0
+        rows, self._pending = self._pending, []
+        with self.conn:
+            self.conn.executemany("""
+                INSERT INTO messages (channel, message_id, date, text) VALUES (?, ?, ?, ?)
+                ON CONFLICT (channel, message_id) DO UPDATE SET text = excluded.text
+                WHERE text != excluded.text
+            """, rows)
+        return len(rows)
+
+    def prune(self, retention_days=ARCHIVE_RETENTION_DAYS):
+        cutoff = datetime.now(timezone.utc) - timedelta(days=retention_days)
+        with self.conn:
+            return self.conn.execute(
+                "DELETE FROM messages WHERE date < ?", (int(cutoff.timestamp()),)
+            ).rowcount
+
+    def count(self):
+        return self.conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+    def iter_messages(self, since=None, channels=None, fts_query=None):
+        """(канал, ID, aware datetime, текст) от старых к новым с фильтрами"""
+        sql = "SELECT m.channel, m.message_id, m.date, m.text FROM messages m"
+        where, params = [], []
+        if fts_query:
+            if not self.fts:
+                raise RuntimeError("SQLite собран без FTS5 — полнотекстовый отбор недоступен")
+            sql += " JOIN messages_fts f ON f.rowid = m.id"
+            where.append("messages_fts MATCH ?")
+            params.append(fts_query)
+        if since is not None:
+            where.append("m.date >= ?")
+            params.append(int(since.timestamp()))
+        if channels is not None:
+            where.append(f"m.channel IN ({','.join('?' * len(channels))})")
+            params.extend(channels)
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY m.date"
+        for channel, message_id, date, text in self.conn.execute(sql, params):
+            yield channel, message_id, datetime.fromtimestamp(date, timezone.utc), text
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+# Ошибки, по которым закэшированный peer считается устаревшим (канал
+# пересоздан, сменился username, отозван доступ). ValueError — отказ
+# Telethon собрать input-entity. Прочие ошибки скана (матчинг, архив,
+# статистика) к peer отношения не имеют и кэш не сбрасывают.
+PEER_ERRORS = (ChannelPrivateError, ChannelInvalidError, PeerIdInvalidError, ValueError)
 
-    with open(PROCESSED_FILE, 'w', encoding='utf-8') as f:
-        json.dump(cleaned, f, ensure_ascii=False, indent=2)
 
-    return len(processed_dict) - len(cleaned)  # Количество удаленных
+async def resolve_channel(client, channel_username, entity_cache, limiter, metrics=None):
+    """
+    Возвращает (peer, из_кэша). Запрос get_entity (через лимитер) — только
+    при промахе кэша.
+    """
+    peer = entity_cache.get(channel_username)
+    if peer is not None:
+        return peer, True
+
+    await limiter.acquire()
+    started = time.perf_counter()
+    try:
+        entity = await client.get_entity(channel_username)
+    finally:
+        if metrics is not None:
+            metrics.api_call('get_entity', time.perf_counter() - started)
+    entity_cache.put(channel_username, entity)
+    return entity, False
 
 
 def matches_word_start(term, text_lower):
@@ -166,236 +1124,2887 @@ def matches_word_start(term, text_lower):
         return term in text_lower
 
 
-def should_forward_message(message_text, keywords, exclude_keywords, patterns):
+def build_trie_regex(terms):
     """
-    Определяет, нужно ли пересылать сообщение
-    Поддерживает поиск по основам слов (окончания игнорируются)
+    Собирает из набора строк одно регулярное выражение в виде префиксного
+    дерева (Aho-Corasick-подобный автомат): общие префиксы проверяются один
+    раз, а поиск всех терминов выполняется за один проход re по тексту.
+    Любое совпадение заканчивается в конечном узле, поэтому group(0) — это
+    всегда один из исходных терминов. Возвращает строку regex или None.
     """
-    if not message_text:
-        return False
+    trie = {}
+    for term in terms:
+        if not term:
+            continue
+        node = trie
+        for char in term:
+            node = node.setdefault(char, {})
+        node[''] = True  # маркер конца термина
 
-    text_lower = message_text.lower()
+    if not trie:
+        return None
 
-    # Проверка исключающих слов по началу слова (чтобы, например, исключение
-    # "акт" не отсекало "контакты", но продолжало ловить "акты"/"актуальный").
-    for exclude_word in exclude_keywords:
-        if matches_word_start(exclude_word, text_lower):
-            return False
+    def build(node):
+        branches = [re.escape(char) + build(child)
+                    for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        if '' in node:
+            # Термин может закончиться здесь — продолжение необязательно
+            body = '(?:' + body + ')?'
+        return body
 
-    # Проверка ключевых слов (с поддержкой окончаний).
-    # Ключевые слова ищутся по подстроке намеренно: так поведение совпадений
-    # не меняется относительно прежней версии (риск пропустить пост = 0).
-    # Например "инвест" найдет: инвестиции, инвестиция, инвестирование, инвестор
-    for keyword in keywords:
-        if keyword:
-            if keyword in text_lower:
-                return True
-    
-    # Проверка регулярных выражений
-    for pattern in patterns:
-        if pattern:
-            try:
-                if re.search(pattern, message_text, re.IGNORECASE):
-                    return True
-            except re.error:
-                print(f"⚠️ Некорректное регулярное выражение: {pattern}")
-    
-    return False
+    return build(trie)
 
 
-async def send_match(bot, channel_username, message, message_text, set_name):
+# Слова текста и терминов для MATCH_MODE=token; термин из слов (фраза —
+# через пробел) ищется по словам, остальные («c++», «бизнес-ангел») —
+# прежними regex
+MATCH_TOKEN_RE = re.compile(r'\w+')
+MATCH_TERM_RE = re.compile(r'\w+(?: \w+)*')
+
+# Основы короче этого не сравниваются: «ии» → «и» совпадало бы с союзом
+STEM_MIN_LENGTH = 3
+
+# Стеммер Портера для русского (Snowball, упрощённый: R2 не выделяется)
+STEM_RV_RE = re.compile(r'^(.*?[аеиоуыэюя])(.*)$')
+STEM_PERFECTIVE_RE = re.compile(r'((ив|ивши|ившись|ыв|ывши|ывшись)|((?<=[ая])(в|вши|вшись)))$')
+STEM_REFLEXIVE_RE = re.compile(r'(с[яь])$')
+STEM_ADJECTIVE_RE = re.compile(
+    r'(ее|ие|ые|ое|ими|ыми|ей|ий|ый|ой|ем|им|ым|ом|его|ого|ему|ому|их|ых|ую|юю|ая|яя|ою|ею)$'
+)
+STEM_PARTICIPLE_RE = re.compile(r'((ивш|ывш|ующ)|((?<=[ая])(ем|нн|вш|ющ|щ)))$')
+STEM_VERB_RE = re.compile(
+    r'((ила|ыла|ена|ейте|уйте|ите|или|ыли|ей|уй|ил|ыл|им|ым|ен|ило|ыло|ено|ят|ует|уют|ит|ыт|ены'
+    r'|ить|ыть|ишь|ую|ю)|((?<=[ая])(ла|на|ете|йте|ли|й|л|ем|н|ло|но|ет|ют|ны|ть|ешь|нно)))$'
+)
+STEM_NOUN_RE = re.compile(
+    r'(а|ев|ов|ие|ье|е|иями|ями|ами|еи|ии|и|ией|ей|ой|ий|й|иям|ям|ием|ем|ам|ом|о|у|ах|иях|ях'
+    r'|ы|ь|ию|ью|ю|ия|ья|я)$'
+)
+STEM_DERIVATIONAL_RE = re.compile(r'.*[^аеиоуыэюя]+[аеиоуыэюя].*ость?$')
+STEM_DER_RE = re.compile(r'ость?$')
+STEM_SUPERLATIVE_RE = re.compile(r'(ейше|ейш)$')
+
+
+def normalize_text(text):
+    """Нижний регистр и ё → е — общая нормализация текста и терминов"""
+    return text.lower().replace('ё', 'е')
+
+
+@lru_cache(maxsize=65536)
+def stem_word(word):
     """
-    Отправляет совпавшее сообщение пользователю текстом.
-    Возвращает True при успешной отправке, иначе False.
+    Основа нормализованного слова. Снимаются только русские окончания:
+    слова без кириллических гласных (латиница, числа) возвращаются как есть.
+    Кэшируется — в потоке постов одни и те же слова повторяются постоянно.
+    """
+    found = STEM_RV_RE.match(word)
+    if not found:
+        return word
+    head, rv = found.groups()
 
-    Пересылка через bot.forward_messages убрана намеренно: бот не имеет доступа
-    к entity канала, разрешённому пользовательским клиентом, поэтому она почти
-    всегда падала и приводила к лишнему API-вызову на каждое совпадение.
-    parse_mode не используется — текст канала произвольный и мог бы ломать
-    markdown-разметку, поэтому отправляем как обычный текст.
+    stripped = STEM_PERFECTIVE_RE.sub('', rv, 1)
+    if stripped == rv:
+        rv = STEM_REFLEXIVE_RE.sub('', rv, 1)
+        stripped = STEM_ADJECTIVE_RE.sub('', rv, 1)
+        if stripped != rv:
+            rv = STEM_PARTICIPLE_RE.sub('', stripped, 1)
+        else:
+            stripped = STEM_VERB_RE.sub('', rv, 1)
+            rv = STEM_NOUN_RE.sub('', rv, 1) if stripped == rv else stripped
+    else:
+        rv = stripped
+
+    if rv.endswith('и'):
+        rv = rv[:-1]
+    if STEM_DERIVATIONAL_RE.match(rv):
+        rv = STEM_DER_RE.sub('', rv, 1)
+    if rv.endswith('ь'):
+        rv = rv[:-1]
+    else:
+        rv = STEM_SUPERLATIVE_RE.sub('', rv, 1)
+        if rv.endswith('нн'):
+            rv = rv[:-1]
+    return head + rv
+
+
+class TextIndex:
+    """
+    Текст сообщения, разобранный один раз для всех наборов: различные слова
+    в порядке первого появления, разложенные по корзинам первых
+    STEM_MIN_LENGTH букв. Наборы находят свои термины поиском корзины в
+    хэш-таблице, поэтому цена проверки зависит от длины сообщения, а не от
+    числа терминов и наборов. Основа слова всегда его префикс (не короче
+    STEM_MIN_LENGTH), так что стеммятся только слова из корзин кандидатов.
     """
-    retry_count = 0
-    max_retries = 3
 
-    while retry_count < max_retries:
-        try:
-            channel_name = channel_username.strip('@')
+    __slots__ = ('text', 'words', '_buckets', '_short', '_tokens')
 
-            text = f"📢 [{set_name}] Пост из {channel_username}\n\n"
+    def __init__(self, message_text):
+        self.text = normalize_text(message_text or "")
+        self.words = list(dict.fromkeys(MATCH_TOKEN_RE.findall(self.text)))
+        self._buckets = None
+        self._short = {}
+        self._tokens = None
 
-            # Ссылка только для публичных каналов (не числовой -100... id)
-            if not channel_username.startswith('-'):
-                text += f"🔗 https://t.me/{channel_name}/{message.id}\n\n"
+    @property
+    def buckets(self):
+        """
+        {первые STEM_MIN_LENGTH букв: [(номер слова, слово), ...]}; короткие
+        слова попадают в корзины целиком и с терминами не пересекаются
+        """
+        if self._buckets is None:
+            buckets = self._buckets = {}
+            for item in enumerate(self.words):
+                key = item[1][:STEM_MIN_LENGTH]
+                if key in buckets:
+                    buckets[key].append(item)
+                else:
+                    buckets[key] = [item]
+        return self._buckets
 
-            if message_text:
-                text += message_text[:3000]
-                if len(message_text) > 3000:
-                    text += "\n\n... (сообщение обрезано)"
-            else:
-                text += "(Сообщение без текста — возможно, только медиа)"
+    def short_prefixes(self, length):
+        """{префикс длины length < STEM_MIN_LENGTH: номер первого слова с ним}"""
+        found = self._short.get(length)
+        if found is None:
+            found = self._short[length] = {}
+            for rank, word in enumerate(self.words):
+                if len(word) >= length:
+                    found.setdefault(word[:length], rank)
+        return found
 
-            await bot.send_message(YOUR_USER_ID, text)
-            print(f"✅ [{set_name}] Отправлено: {channel_username} / {message.id}")
-            await asyncio.sleep(1)
-            return True
+    def find_phrase(self, words):
+        """Номер первого слова первого вхождения фразы [(слово, основа), ...] или None"""
+        if self._tokens is None:
+            self._tokens = MATCH_TOKEN_RE.findall(self.text)
+        tokens = self._tokens
+        for start in range(len(tokens) - len(words) + 1):
+            if all(word_matches(tokens[start + offset], word, word_stem)
+                   for offset, (word, word_stem) in enumerate(words)):
+                return self.words.index(tokens[start])
+        return None
 
-        except FloodWaitError as flood_error:
-            wait_time = flood_error.seconds
-            print(f"⏳ [{set_name}] FloodWait: ждём {wait_time} секунд...")
-            await asyncio.sleep(wait_time)
-            retry_count += 1
 
-        except Exception as bot_error:
-            print(f"❌ [{set_name}] Не удалось отправить {message.id}: {bot_error}")
-            return False
+def word_matches(token, word, word_stem):
+    """Слово текста начинается со слова термина или имеет ту же основу"""
+    if token.startswith(word):
+        return True
+    return word_stem is not None and token.startswith(word_stem) and stem_word(token) == word_stem
 
-    print(f"❌ [{set_name}] Исчерпаны попытки отправки {message.id}")
-    return False
 
+def term_stem(word):
+    """Основа термина для сравнения или None, если она слишком короткая"""
+    word_stem = stem_word(word)
+    return word_stem if len(word_stem) >= STEM_MIN_LENGTH else None
 
-async def monitor_channel(client, bot, channel_username, keywords, exclude_keywords, patterns, processed_dict, set_name, errors):
+
+class TermIndex:
     """
-    Мониторит один канал и возвращает статистику
+    Термины одного вида (ключевые слова или исключения) набора для
+    MATCH_MODE=token: хэш-таблица корзин по первым STEM_MIN_LENGTH буквам
+    термина (они же — первые буквы его основы), короткие термины — отдельно,
+    фразы и термины со знаками — отдельными списками.
     """
-    new_processed = 0
-    forwarded = 0
-    skipped_duplicates = 0
 
-    try:
-        # Получаем канал
-        channel = await client.get_entity(channel_username)
+    def __init__(self, terms, word_start):
+        self.buckets = {}  # первые буквы -> [(слово, основа или None, термин)]
+        self.short = {}    # длина -> {короткий термин: термин}
+        self.phrases = []  # [(термин, [(слово, основа), ...])]
+        seen = set()
+        fallback = []
+        for term in terms:
+            normalized = ' '.join(normalize_text(term).split())
+            if not normalized or normalized in seen:
+                continue
+            seen.add(normalized)
+            if not MATCH_TERM_RE.fullmatch(normalized):
+                fallback.append(normalized)
+                continue
+            words = normalized.split(' ')
+            if len(words) > 1:
+                self.phrases.append((term, [(word, term_stem(word)) for word in words]))
+            elif len(normalized) < STEM_MIN_LENGTH:
+                self.short.setdefault(len(normalized), {})[normalized] = term
+            else:
+                word_stem = term_stem(normalized)
+                self.buckets.setdefault(normalized[:STEM_MIN_LENGTH], []).append(
+                    (normalized, word_stem, term)
+                )
 
-        print(f"📡 [{set_name}] Проверяю канал: {channel_username}")
+        # Термины со знаками — как в режиме substring: исключения по началу
+        # слова, ключевые слова по подстроке
+        fallback_regex = build_trie_regex(fallback)
+        if fallback_regex is None:
+            self.fallback_re = None
+        else:
+            self.fallback_re = re.compile((r'\b' if word_start else '') + fallback_regex)
 
-        # Получаем сообщения за заданный период (message.date — aware UTC)
-        time_threshold = datetime.now(timezone.utc) - timedelta(hours=TIME_RANGE_HOURS)
+    def find(self, index):
+        """Первый по тексту сработавший термин или None"""
+        first = None  # (номер слова, термин)
 
-        # Получаем сообщения с учетом глубины поиска
-        async for message in client.iter_messages(channel, limit=SEARCH_DEPTH):
-            # Пропускаем старые сообщения
-            if message.date < time_threshold:
-                break
+        if self.buckets:
+            buckets = index.buckets
+            if len(buckets) <= len(self.buckets):
+                keys = [key for key in buckets if key in self.buckets]
+            else:
+                keys = [key for key in self.buckets if key in buckets]
+            for key in keys:
+                candidates = buckets[key]
+                for word, word_stem, term in self.buckets[key]:
+                    for rank, token in candidates:
+                        if first is not None and rank >= first[0]:
+                            break
+                        if word_matches(token, word, word_stem):
+                            first = (rank, term)
+                            break
+
+        for length, terms in self.short.items():
+            prefixes = index.short_prefixes(length)
+            for prefix, term in terms.items():
+                rank = prefixes.get(prefix)
+                if rank is not None and (first is None or rank < first[0]):
+                    first = (rank, term)
+
+        for term, words in self.phrases:
+            rank = index.find_phrase(words)
+            if rank is not None and (first is None or rank < first[0]):
+                first = (rank, term)
+
+        if first is not None:
+            return first[1]
+
+        if self.fallback_re is not None:
+            match = self.fallback_re.search(index.text)
+            if match:
+                return match.group(0)
+        return None
 
-            # Создаем уникальный ID для сообщения (канал + ID сообщения)
-            unique_id = f"{channel_username}:{message.id}"
 
-            # Пропускаем уже обработанные (проверка на дубли)
-            if unique_id in processed_dict:
-                skipped_duplicates += 1
+class SetMatcher:
+    """
+    Предкомпилированный матчер одного набора мониторинга.
+    Строится один раз в parse_monitor_sets:
+      1. исключения — по началу слова или основе (MATCH_MODE=token) либо
+         по началу слова одним общим regex (substring);
+      2. ключевые слова — так же по словам (token) либо по подстроке одним
+         автоматом по префиксному дереву (substring);
+      3. паттерны — заранее скомпилированные regex с re.IGNORECASE.
+    """
+
+    def __init__(self, keywords, exclude_keywords, patterns, mode=None):
+        self.mode = mode or MATCH_MODE
+        if self.mode == 'token':
+            self.exclude_terms = TermIndex(exclude_keywords, word_start=True)
+            self.keyword_terms = TermIndex(keywords, word_start=False)
+        else:
+            exclude_regex = build_trie_regex(exclude_keywords)
+            self.exclude_re = re.compile(r'\b' + exclude_regex) if exclude_regex else None
+
+            keyword_regex = build_trie_regex(keywords)
+            self.keyword_re = re.compile(keyword_regex) if keyword_regex else None
+
+        self.patterns = []
+        for pattern in patterns:
+            if not pattern:
+                continue
+            try:
+                self.patterns.append((pattern, re.compile(pattern, re.IGNORECASE)))
+            except re.error:
+                # Раньше предупреждение печаталось на каждое сообщение,
+                # теперь — один раз при сборке; решение то же (не совпадает).
+                print(f"⚠️ Некорректное регулярное выражение: {pattern}")
                 continue
+            for risk in pattern_risks(pattern):
+                print(f"⚠️ Опасное регулярное выражение «{pattern}»: {risk}")
+        self.pattern_texts = tuple(pattern for pattern, _ in self.patterns)
 
-            # Проверяем текст сообщения
-            message_text = message.text or ""
-
-            # Проверяем, нужно ли пересылать
-            if should_forward_message(message_text, keywords, exclude_keywords, patterns):
-                # Помечаем обработанным ТОЛЬКО после успешной отправки, иначе
-                # временный сбой отправки приведёт к безвозвратной потере
-                # совпавшего сообщения. При неудаче — ретрай на следующем прогоне.
-                if await send_match(bot, channel_username, message, message_text, set_name):
-                    processed_dict[unique_id] = datetime.now(timezone.utc).isoformat()
-                    new_processed += 1
-                    forwarded += 1
-            else:
-                # Несовпавшие помечаем сразу, чтобы не проверять их повторно
-                processed_dict[unique_id] = datetime.now(timezone.utc).isoformat()
-                new_processed += 1
+    def evaluate(self, message_text, index=None, sandbox=None):
+        """
+        Возвращает кортеж (переслать, тип_правила, правило), где тип_правила —
+        'exclude', 'keyword', 'pattern' или None, если ничего не сработало.
+        index — уже разобранный TextIndex сообщения (общий для всех наборов);
+        без него текст разбирается здесь. sandbox — PatternSandbox: паттерны
+        проверяются в его процессах с бюджетом времени (вызов блокирующий).
+        """
+        if not message_text:
+            return False, None, None
 
-        return new_processed, forwarded, skipped_duplicates
+        if self.mode == 'token':
+            if index is None:
+                index = TextIndex(message_text)
+            found = self.exclude_terms.find(index)
+            if found:
+                return False, 'exclude', found
+            found = self.keyword_terms.find(index)
+            if found:
+                return True, 'keyword', found
+        else:
+            text_lower = message_text.lower()
 
-    except Exception as e:
-        # Не шлём уведомление на каждый канал (спам) — накапливаем и шлём сводку
-        print(f"❌ [{set_name}] Ошибка в канале {channel_username}: {e}")
-        errors.append(f"[{set_name}] {channel_username}: {e}")
-        return 0, 0, 0
+            if self.exclude_re is not None:
+                found = self.exclude_re.search(text_lower)
+                if found:
+                    return False, 'exclude', found.group(0)
+
+            if self.keyword_re is not None:
+                found = self.keyword_re.search(text_lower)
+                if found:
+                    return True, 'keyword', found.group(0)
+
+        if sandbox is not None:
+            pattern = sandbox.search(self.pattern_texts, message_text) if self.patterns else None
+            if pattern is not None:
+                return True, 'pattern', pattern
+            return False, None, None
+
+        for pattern, compiled in self.patterns:
+            if compiled.search(message_text):
+                return True, 'pattern', pattern
+
+        return False, None, None
+
+    def matches(self, message_text, index=None, sandbox=None):
+        """Только решение — без информации о сработавшем правиле"""
+        return self.evaluate(message_text, index, sandbox)[0]
 
 
-async def process_monitor_set(client, bot, monitor_set, processed_dict, errors):
+def pattern_risks(pattern):
     """
-    Обрабатывает один набор мониторинга
+    Статическая проверка regex на конструкции с катастрофическим возвратом
+    (backtracking). Возвращает список причин — пустой, если ничего не
+    найдено. Эвристика ловит типичные случаи, но безопасность не доказывает,
+    поэтому паттерны всё равно проверяются с бюджетом времени.
     """
-    set_name = monitor_set['name']
-    channels = monitor_set['channels']
-    keywords = monitor_set['keywords']
-    exclude_keywords = monitor_set['exclude']
-    patterns = monitor_set['patterns']
-    
-    if not channels:
-        print(f"⚠️ [{set_name}] Нет каналов для мониторинга")
-        return 0, 0, 0
-    
-    if not keywords and not patterns:
-        print(f"⚠️ [{set_name}] Нет ключевых слов или паттернов!")
-        print(f"   Будут пересылаться ВСЕ сообщения (кроме исключений)")
-    
-    print(f"\n{'='*60}")
-    print(f"🔍 Обработка набора: {set_name}")
-    print(f"📺 Каналов: {len(channels)}")
-    print(f"🔑 Ключевых слов: {len(keywords)}")
-    print(f"🚫 Слов-исключений: {len(exclude_keywords)}")
-    print(f"🔍 Регулярных выражений: {len(patterns)}")
-    print(f"{'='*60}")
-    
-    total_new = 0
-    total_forwarded = 0
-    total_skipped = 0
-    
-    for channel in channels:
-        new, forwarded, skipped = await monitor_channel(
-            client,
-            bot,
-            channel,
-            keywords,
-            exclude_keywords,
-            patterns,
-            processed_dict,
-            set_name,
-            errors
-        )
-        total_new += new
-        total_forwarded += forwarded
-        total_skipped += skipped
-        
-        # Задержка между каналами
-        await asyncio.sleep(2)
-    
-    print(f"\n📊 [{set_name}] Результаты:")
-    print(f"   Обработано новых: {total_new}")
-    print(f"   Переслано: {total_forwarded}")
-    print(f"   Пропущено дублей: {total_skipped}")
-    
-    return total_new, total_forwarded, total_skipped
+    try:
+        parsed = sre_parse.parse(pattern, re.IGNORECASE)
+    except re.error:
+        return []
+    repeats = (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT)
+    risks = []
 
+    def many(high):
+        return high == sre_parse.MAXREPEAT or high > 10
 
-async def main():
-    """Основная функция для мониторинга каналов"""
-    
-    # Проверка критичных переменных окружения
-    required_vars = ['TELEGRAM_API_ID', 'TELEGRAM_API_HASH', 'SESSION_STRING', 'BOT_TOKEN', 'YOUR_USER_ID']
-    missing = [var for var in required_vars if not os.getenv(var)]
-    if missing:
-        print(f"❌ Отсутствуют обязательные переменные: {', '.join(missing)}")
-        return
+    def walk(items, repeated):
+        previous = None
+        for op, av in items:
+            if op in repeats:
+                low, high, body = av
+                # Внутри повтора опасен любой повтор переменной длины: (\d{1,3})+
+                if repeated and (many(high) or high - low >= 2):
+                    risks.append("вложенные квантификаторы, например (a+)+")
+                if many(high):
+                    # Подряд два повтора одного и того же: \d+\d+, .*.*
+                    if previous is not None and repr(previous) == repr(list(body)):
+                        risks.append("подряд идущие повторы одного и того же, например .*.*")
+                    previous = list(body)
+                    walk(body, True)
+                else:
+                    previous = None
+                    walk(body, repeated)
+                continue
+            previous = None
+            if op == sre_parse.SUBPATTERN:
+                walk(av[-1], repeated)
+            elif op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+                walk(av[1], repeated)
+            elif op == sre_parse.BRANCH:
+                # Одна альтернатива — начало другой (или её повтор): (a|aa)+
+                branches = [repr(list(branch))[:-1] for branch in av[1]]
+                if repeated and any(first != second and branches[second].startswith(branches[first])
+                                    for first in range(len(branches))
+                                    for second in range(len(branches))):
+                    risks.append("пересекающиеся альтернативы под квантификатором, например (a|aa)+")
+                for branch in av[1]:
+                    walk(branch, repeated)
+            # Атомарные группы и притяжательные квантификаторы (3.11+) не
+            # возвращаются назад — их содержимое безопасно
 
-    # Парсим числовые переменные здесь (а не на импорте), чтобы некорректное
-    # значение давало понятное сообщение, а не TypeError/ValueError в трейсбеке.
-    global API_ID, API_HASH, SESSION_STRING, BOT_TOKEN, YOUR_USER_ID
-    try:
-        API_ID = int(os.getenv('TELEGRAM_API_ID'))
-        YOUR_USER_ID = int(os.getenv('YOUR_USER_ID'))
-    except (TypeError, ValueError):
-        print("❌ TELEGRAM_API_ID и YOUR_USER_ID должны быть целыми числами")
-        return
-    API_HASH = os.getenv('TELEGRAM_API_HASH')
-    SESSION_STRING = os.getenv('SESSION_STRING')
-    BOT_TOKEN = os.getenv('BOT_TOKEN')
+    walk(parsed, False)
+    return list(dict.fromkeys(risks))
 
-    # Проверка на параллельный запуск (только для Unix-систем)
-    lock_file = None
-    if sys.platform != 'win32':
-        try:
-            import fcntl
-            lock_file = open(LOCK_FILE, 'w')
+
+def pattern_worker(connection, current, started):
+    """
+    Процесс пула PatternSandbox: принимает (паттерны, текст), отвечает
+    индексом первого совпавшего паттерна или -1. Перед каждым паттерном
+    пишет его индекс в current, а после компиляции — момент начала поиска
+    (time.monotonic) в started; 0 — паттерн ещё компилируется. По ним
+    родитель отсчитывает бюджет каждого паттерна отдельно.
+    """
+    compiled = {}
+    # Процесс готов (импорт модуля при spawn не входит в бюджет проверки)
+    connection.send(-1)
+    while True:
+        try:
+            request = connection.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        if request is None:
+            return
+        patterns, text = request
+        found = -1
+        for position, pattern in enumerate(patterns):
+            started.value = 0.0
+            current.value = position
+            regex = compiled.get(pattern)
+            if regex is None:
+                regex = compiled[pattern] = re.compile(pattern, re.IGNORECASE)
+            started.value = time.monotonic()
+            if regex.search(text):
+                found = position
+                break
+        current.value = -1
+        connection.send(found)
+
+
+class PatternSandbox:
+    """
+    Пул процессов для проверки паттернов с бюджетом времени на паттерн:
+    отсчёт идёт от начала поиска паттерна в тексте, компиляция и запуск
+    процесса в бюджет не входят, так что много быстрых паттернов на длинном
+    посте не подставляют тот, на котором кончилось бы общее время.
+    search() блокирующий: в прогоне вызывается из потока (asyncio.to_thread),
+    в бэктесте — напрямую. Процесс, не уложившийся в бюджет, убивается и
+    заменяется новым, проверка продолжается со следующего паттерна.
+    Таймауты копятся по паттерну (history — из базы состояния); после
+    quarantine_after таймаутов паттерн уходит в карантин и не проверяется.
+    """
+
+    def __init__(self, workers=None, timeout_ms=None, quarantine_after=None, history=None):
+        self.size = workers or PATTERN_WORKERS
+        self.timeout = (timeout_ms or PATTERN_TIMEOUT_MS) / 1000
+        self.quarantine_after = quarantine_after or PATTERN_QUARANTINE_AFTER
+        # паттерн -> {'timeouts', 'last_timeout_at', 'quarantined_at' (iso или None)}
+        self.history = dict(history or {})
+        self.run_timeouts = Counter()
+        self.evaluations = 0
+        # spawn, а не fork: родитель многопоточный (asyncio.to_thread)
+        self._context = multiprocessing.get_context('spawn')
+        self._idle = queue.SimpleQueue()
+        self._workers = []
+        self._started = 0
+        self._lock = threading.Lock()
+
+    def is_quarantined(self, pattern):
+        entry = self.history.get(pattern)
+        return entry is not None and entry['quarantined_at'] is not None
+
+    @property
+    def quarantined(self):
+        return [pattern for pattern in self.history if self.is_quarantined(pattern)]
+
+    def _spawn(self):
+        connection, child = self._context.Pipe()
+        current = self._context.RawValue('i', -1)
+        started = self._context.RawValue('d', 0.0)
+        process = self._context.Process(target=pattern_worker, args=(child, current, started), daemon=True)
+        process.start()
+        child.close()
+        connection.recv()
+        worker = (process, connection, current, started)
+        with self._lock:
+            self._workers.append(worker)
+        return worker
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            spawn = self._started < self.size
+            if spawn:
+                self._started += 1
+        return self._spawn() if spawn else self._idle.get()
+
+    def _kill(self, worker):
+        """Убивает процесс; возвращает индекс паттерна, на котором он стоял (-1 — ни на каком)"""
+        process, connection, current, _ = worker
+        process.kill()
+        process.join()
+        connection.close()
+        with self._lock:
+            self._workers.remove(worker)
+        return current.value
+
+    def _timed_out(self, pattern):
+        now = datetime.now(timezone.utc).isoformat()
+        with self._lock:
+            self.run_timeouts[pattern] += 1
+            entry = self.history.setdefault(
+                pattern, {'timeouts': 0, 'last_timeout_at': now, 'quarantined_at': None}
+            )
+            entry['timeouts'] += 1
+            entry['last_timeout_at'] = now
+            quarantine = entry['quarantined_at'] is None and entry['timeouts'] >= self.quarantine_after
+            if quarantine:
+                entry['quarantined_at'] = now
+        print(f"⏱️ Паттерн «{pattern}» не уложился в {self.timeout * 1000:.0f} мс "
+              f"(таймаутов: {entry['timeouts']})")
+        if quarantine:
+            print(f"🚫 Паттерн «{pattern}» в карантине на {PATTERN_QUARANTINE_HOURS:g} ч")
+
+    def _wait(self, worker):
+        """
+        Ждёт ответа процесса: (True, индекс совпадения) или (False, индекс
+        паттерна, превысившего бюджет). Бюджет отсчитывается заново для
+        каждого паттерна с момента начала его поиска; пока паттерн
+        компилируется, отсчёт не идёт.
+        """
+        _, connection, current, started = worker
+        while True:
+            # Сначала индекс, потом момент начала (процесс пишет их в обратном
+            # порядке): если он успел перейти к следующему паттерну, время
+            # окажется меньше, а не больше — чужой паттерн не обвиняется
+            position = current.value
+            since = started.value
+            remaining = self.timeout
+            if since and position >= 0:
+                remaining = since + self.timeout - time.monotonic()
+                if remaining <= 0:
+                    return False, position
+            if connection.poll(remaining):
+                return True, connection.recv()
+
+    def search(self, patterns, text):
+        """Первый совпавший паттерн (не из карантина) или None"""
+        active = [pattern for pattern in patterns if not self.is_quarantined(pattern)]
+        if not active:
+            return None
+        self.evaluations += 1
+        worker = self._acquire()
+        retried = False
+        try:
+            while active:
+                slow = None
+                try:
+                    worker[1].send((active, text))
+                    answered, value = self._wait(worker)
+                    if answered:
+                        return active[value] if value >= 0 else None
+                    slow = value
+                except (EOFError, OSError):
+                    pass  # процесс упал — как таймаут на текущем паттерне
+                position = self._kill(worker)
+                if slow is None:
+                    slow = position
+                worker = self._spawn()
+                if slow < 0 and not retried:
+                    retried = True
+                    continue  # процесс не успел начать — повторяем один раз
+                slow = max(slow, 0)
+                self._timed_out(active[slow])
+                active = active[slow + 1:]
+            return None
+        finally:
+            self._idle.put(worker)
+
+    def report(self):
+        """Строки для сводки ошибок: таймауты прогона и паттерны в карантине"""
+        lines = []
+        budget = f"{self.timeout * 1000:.0f} мс"
+        for pattern, entry in self.history.items():
+            if entry['quarantined_at'] is not None:
+                lines.append(f"[patterns] «{pattern}» в карантине с {entry['quarantined_at'][:16]}: "
+                             f"{entry['timeouts']} превышений бюджета {budget}")
+            elif self.run_timeouts[pattern]:
+                lines.append(f"[patterns] «{pattern}»: {self.run_timeouts[pattern]} превышений "
+                             f"бюджета {budget}")
+        return lines
+
+    def close(self):
+        with self._lock:
+            workers = list(self._workers)
+        for process, connection, _, _ in workers:
+            try:
+                connection.send(None)
+            except OSError:
+                pass
+            process.join(1)
+            if process.is_alive():
+                process.kill()
+                process.join()
+            connection.close()
+
+
+def attach_matcher(monitor_set):
+    """Строит матчер набора и сохраняет его в monitor_set['matcher']"""
+    monitor_set['matcher'] = SetMatcher(
+        monitor_set['keywords'],
+        monitor_set['exclude'],
+        monitor_set['patterns']
+    )
+    return monitor_set
+
+
+@lru_cache(maxsize=64)
+def _cached_matcher(keywords, exclude_keywords, patterns, mode):
+    return SetMatcher(keywords, exclude_keywords, patterns, mode)
+
+
+def should_forward_message(message_text, keywords, exclude_keywords, patterns):
+    """
+    Определяет, нужно ли пересылать сообщение
+    Поддерживает поиск по основам слов (окончания игнорируются)
+
+    Совместимая обёртка над SetMatcher: матчер для одного и того же набора
+    правил собирается один раз и берётся из кэша.
+    """
+    matcher = _cached_matcher(tuple(keywords), tuple(exclude_keywords), tuple(patterns), MATCH_MODE)
+    return matcher.matches(message_text)
+
+
+def describe_rule(rule):
+    """Человекочитаемое описание сработавшего правила для логов и уведомлений"""
+    rule_kind, rule_value = rule
+    labels = {
+        'keyword': 'ключевое слово',
+        'pattern': 'регулярное выражение',
+        'exclude': 'исключение',
+    }
+    return f"{labels.get(rule_kind, rule_kind)} «{rule_value}»"
+
+
+def match_link(channel_username, message_id):
+    """Ссылка на пост — только для публичных каналов (не числовой -100... id)"""
+    if channel_username.startswith('-'):
+        return None
+    return f"https://t.me/{channel_username.strip('@')}/{message_id}"
+
+
+def telegram_length(text):
+    """Длина текста так, как её считает Telegram (в UTF-16 code units)"""
+    return len(text.encode('utf-16-le')) // 2
+
+
+SIMHASH_BITS = 64
+SIMHASH_MASK = (1 << SIMHASH_BITS) - 1
+# Ссылки, упоминания и числа (время, цены, номера) отличаются у копий
+# поста в разных каналах
+SIMHASH_NOISE_RE = re.compile(r'https?://\S+|t\.me/\S+|@\w+|\d+')
+SIMHASH_TOKEN_RE = re.compile(r'\w+')
+
+
+def simhash(message_text):
+    """
+    64-битный SimHash нормализованного текста (нижний регистр, без ссылок,
+    упоминаний, чисел и пунктуации) по шинглам из трёх слов. У почти одинаковых
+    текстов отпечатки отличаются в нескольких битах. None — текст слишком
+    короткий для надёжного сравнения.
+    """
+    tokens = SIMHASH_TOKEN_RE.findall(SIMHASH_NOISE_RE.sub(' ', message_text.lower()))
+    if len(tokens) < NEAR_DUP_MIN_TOKENS:
+        return None
+
+    shingles = Counter(' '.join(tokens[i:i + 3]) for i in range(len(tokens) - 2))
+    weights = [0] * SIMHASH_BITS
+    for shingle, count in shingles.items():
+        # blake2b, а не hash(): отпечатки хранятся между запусками
+        value = int.from_bytes(
+            hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'big'
+        )
+        for bit in range(SIMHASH_BITS):
+            weights[bit] += count if value >> bit & 1 else -count
+
+    fingerprint = 0
+    for bit, weight in enumerate(weights):
+        if weight > 0:
+            fingerprint |= 1 << bit
+    return fingerprint
+
+
+class NearDuplicateIndex:
+    """
+    Индекс отпечатков SimHash по наборам с поиском соседей на расстоянии
+    Хэмминга до max_distance. 64 бита делятся на полосы по 16 бит: у
+    отпечатков с расстоянием <= 3 хотя бы одна полоса совпадает целиком
+    (принцип Дирихле), поэтому сравниваются только кандидаты из тех же
+    полос — единицы записей даже при сотнях тысяч отпечатков.
+    """
+
+    BAND_BITS = 16
+
+    def __init__(self, max_distance, entries=()):
+        self.max_distance = max_distance
+        # Полос должно быть больше max_distance, иначе соседи теряются
+        self.bands = max(max_distance + 1, SIMHASH_BITS // self.BAND_BITS)
+        self.band_bits = SIMHASH_BITS // self.bands
+        self._band_mask = (1 << self.band_bits) - 1
+        self._buckets = {}
+        self._pending = []
+        self.size = 0
+        self.hits = 0
+        for set_name, fingerprint, channel, message_id in entries:
+            self._insert([set_name, fingerprint, channel, message_id, None])
+
+    def _keys(self, set_name, fingerprint):
+        for band in range(self.bands):
+            yield set_name, band, (fingerprint >> (band * self.band_bits)) & self._band_mask
+
+    def _insert(self, entry):
+        for key in self._keys(entry[0], entry[1]):
+            self._buckets.setdefault(key, []).append(entry)
+        self.size += 1
+
+    def find(self, set_name, fingerprint, channel_username, message_id):
+        """
+        Ближайший ранее учтённый пост набора (запись [набор, отпечаток,
+        канал, ID, Delivery|None]) или None. Само сообщение (тот же канал и
+        ID — повтор после неудачной доставки) дублем не считается.
+        """
+        for key in self._keys(set_name, fingerprint):
+            for entry in self._buckets.get(key, ()):
+                if entry[2] == channel_username and entry[3] == message_id:
+                    continue
+                if bin(entry[1] ^ fingerprint).count('1') <= self.max_distance:
+                    self.hits += 1
+                    return entry
+        return None
+
+    def add(self, set_name, fingerprint, channel_username, message_id, delivery=None):
+        """
+        Учитывает пост набора. С delivery запись предварительная: копии в
+        этом прогоне сравниваются с ней сразу (fold дописывает их к ещё не
+        отправленному уведомлению), а в базу отпечаток попадает только после
+        подтверждённой доставки (settle).
+        """
+        entry = [set_name, fingerprint, channel_username, message_id, delivery]
+        self._insert(entry)
+        if delivery is None:
+            self._pending.append(tuple(entry[:4]))
+        return entry
+
+    def settle(self, entry, delivered):
+        """
+        Итог доставки предварительной записи: доставленная сохраняется,
+        недоставленная убирается из индекса — следующие копии отправятся
+        сами. Уже отсеянные копии не теряются: курсор не пройдёт
+        недоставленный оригинал, и следующий прогон пришлёт его.
+        """
+        if delivered:
+            self._pending.append(tuple(entry[:4]))
+            return
+        for key in self._keys(entry[0], entry[1]):
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket[:] = [other for other in bucket if other is not entry]
+        self.size -= 1
+
+    def take_pending(self):
+        pending = self._pending
+        self._pending = []
+        return pending
+
+
+class MessageRecord:
+    """
+    Компактная проекция сообщения Telethon: всё, что нужно стадиям после
+    чтения (матчинг, архив, запись, доставка). Сообщение Telethon со всеми
+    вложенными объектами отпускается сразу после проекции; text читается
+    из него один раз.
+    """
+
+    __slots__ = ('channel', 'id', 'date', 'text')
+
+    def __init__(self, channel, message_id, date, text):
+        self.channel = channel
+        self.id = message_id
+        self.date = date
+        self.text = text
+
+    @classmethod
+    def from_message(cls, channel_username, message):
+        return cls(channel_username, message.id, message.date, message.text or "")
+
+
+class ChannelScan:
+    """
+    Проход по каналу (или одно сообщение события демона) для стадии
+    матчинга и advance_cursors: подписанные наборы, их курсоры на начало
+    прохода, максимальный просмотренный ID и совпадения, ждущие доставки.
+    failed — матчинг какого-то сообщения упал, курсоры не двигаются;
+    live — сообщение пришло событием (двигает курсор, только примыкая к
+    прочитанной истории, см. advance_cursors); truncated — проход упёрся в
+    глубину: курсоры не двигаются, недоставленное сужает прочитанную часть
+    провала (см. channel_gap).
+    """
+
+    __slots__ = ('channel_username', 'subscribed_sets', 'set_cursors', 'max_seen_id',
+                 'pending_messages', 'failed', 'live', 'truncated')
+
+    def __init__(self, channel_username, subscribed_sets, set_cursors):
+        self.channel_username = channel_username
+        self.subscribed_sets = subscribed_sets
+        self.set_cursors = set_cursors
+        self.max_seen_id = 0
+        self.pending_messages = []
+        self.failed = False
+        self.live = False
+        self.truncated = False
+
+
+class StageQueue(asyncio.Queue):
+    """
+    Очередь между стадиями конвейера ограниченного размера: put ждёт
+    свободного места, так что отстающая стадия притормаживает предыдущую.
+    Для профилирования считает пик и среднюю глубину (на момент put) и
+    время ожидания места.
+    """
+
+    def __init__(self, maxsize):
+        super().__init__(maxsize)
+        self.puts = 0
+        self.peak = 0
+        self.depth_sum = 0
+        self.put_wait_seconds = 0.0
+
+    async def put(self, item):
+        """Кладёт элемент, возвращает секунды ожидания места"""
+        started = time.perf_counter()
+        await super().put(item)
+        waited = time.perf_counter() - started
+        self.put_wait_seconds += waited
+        depth = self.qsize()
+        self.puts += 1
+        self.depth_sum += depth
+        self.peak = max(self.peak, depth)
+        return waited
+
+    def snapshot(self):
+        return {
+            'depth': self.qsize(),
+            'peak': self.peak,
+            'mean_depth': round(self.depth_sum / self.puts, 1) if self.puts else 0.0,
+            'capacity': self.maxsize,
+            'puts': self.puts,
+            'put_wait_seconds': round(self.put_wait_seconds, 3),
+        }
+
+
+class Delivery:
+    """Одно совпадение, ожидающее отправки: (канал, сообщение) x набор"""
+
+    __slots__ = ('channel_username', 'message_id', 'message_text', 'set_name', 'rule', 'pending',
+                 'also', 'dispatched', 'near_dup_entry')
+
+    def __init__(self, channel_username, message_id, message_text, set_name, rule, pending):
+        self.channel_username = channel_username
+        self.message_id = message_id
+        self.message_text = message_text
+        self.set_name = set_name
+        self.rule = rule
+        self.pending = pending
+        # Ссылки на почти-дубли из других каналов (NEAR_DUP_MODE=fold)
+        self.also = []
+        # Уже передано на отправку — дописывать «Также в» поздно
+        self.dispatched = False
+        # Предварительная запись в индексе почти-дублей (NearDuplicateIndex.settle)
+        self.near_dup_entry = None
+
+
+class PendingMessage:
+    """
+    Сообщение канала, совпавшее с одним или несколькими наборами и ждущее
+    доставки. Отметка "@channel:id" в processed ставится ТОЛЬКО когда
+    доставка каждому совпавшему набору подтверждена, иначе временный сбой
+    отправки приведёт к безвозвратной потере совпавшего сообщения. При
+    частичном сбое запоминаются наборы, которым уже доставлено
+    ("@channel:id#set"), чтобы ретрай не прислал им то же сообщение повторно.
+    """
+
+    def __init__(self, ctx, unique_id, message_id):
+        self.ctx = ctx
+        self.unique_id = unique_id
+        self.message_id = message_id
+        self.outstanding = 0
+        self.delivered_sets = []
+        self.failed_sets = set()
+
+    def resolve(self, delivery, delivered):
+        """Результат доставки одному набору"""
+        set_name = delivery.set_name
+        if delivery.near_dup_entry is not None:
+            self.ctx.near_dups.settle(delivery.near_dup_entry, delivered)
+            delivery.near_dup_entry = None
+        self.outstanding -= 1
+        if delivered:
+            self.delivered_sets.append(set_name)
+            self.ctx.set_stats[set_name]['forwarded'] += 1
+            self.ctx.stats['forwarded'] += 1
+        else:
+            self.failed_sets.add(set_name)
+
+        if self.outstanding:
+            return
+
+        self.ctx.inflight.discard(self.unique_id)
+        now_iso = datetime.now(timezone.utc).isoformat()
+        if not self.failed_sets:
+            self.ctx.processed[self.unique_id] = now_iso
+            self.ctx.stats['new'] += 1
+        else:
+            for delivered_set in self.delivered_sets:
+                self.ctx.processed[f"{self.unique_id}#{delivered_set}"] = now_iso
+
+
+def format_match(delivery):
+    """
+    Текст уведомления об одном совпадении.
+
+    Пересылка через bot.forward_messages убрана намеренно: бот не имеет доступа
+    к entity канала, разрешённому пользовательским клиентом, поэтому она почти
+    всегда падала и приводила к лишнему API-вызову на каждое совпадение.
+    parse_mode не используется — текст канала произвольный и мог бы ломать
+    markdown-разметку, поэтому отправляем как обычный текст.
+    """
+    text = f"📢 [{delivery.set_name}] Пост из {delivery.channel_username}\n\n"
+
+    link = match_link(delivery.channel_username, delivery.message_id)
+    if link:
+        text += f"🔗 {link}\n\n"
+
+    if delivery.rule and delivery.rule[0]:
+        text += f"🎯 Правило: {describe_rule(delivery.rule)}\n\n"
+
+    if delivery.also:
+        text += format_also(delivery.also) + "\n\n"
+
+    message_text = delivery.message_text
+    if message_text:
+        text += message_text[:3000]
+        if len(message_text) > 3000:
+            text += "\n\n... (сообщение обрезано)"
+    else:
+        text += "(Сообщение без текста — возможно, только медиа)"
+    return text
+
+
+def format_also(links, limit=10):
+    """Строка «Также в: …» со ссылками на почти-дубли из других каналов"""
+    text = "🔁 Также в: " + ", ".join(links[:limit])
+    if len(links) > limit:
+        text += f" и ещё {len(links) - limit}"
+    return text
+
+
+def format_digest_entry(delivery):
+    """Компактная запись о совпадении внутри дайджеста"""
+    entry = f"📢 {delivery.channel_username}"
+
+    link = match_link(delivery.channel_username, delivery.message_id)
+    if link:
+        entry += f"\n🔗 {link}"
+
+    if delivery.rule and delivery.rule[0]:
+        entry += f"\n🎯 {describe_rule(delivery.rule)}"
+
+    if delivery.also:
+        entry += "\n" + format_also(delivery.also)
+
+    message_text = delivery.message_text
+    if message_text:
+        entry += "\n" + message_text[:DIGEST_ENTRY_CHARS]
+        if len(message_text) > DIGEST_ENTRY_CHARS:
+            entry += "…"
+    else:
+        entry += "\n(без текста — возможно, только медиа)"
+    return entry
+
+
+def build_digests(set_name, deliveries):
+    """
+    Упаковывает совпадения одного набора в сообщения-дайджесты не длиннее
+    TELEGRAM_MESSAGE_LIMIT. Возвращает список (текст, [Delivery]).
+    """
+    separator = "\n\n" + "—" * 10 + "\n\n"
+    # Запас под заголовок с числом совпадений
+    header_reserve = telegram_length(f"📬 [{set_name}] Дайджест: 9999 совпадений\n\n")
+    budget = TELEGRAM_MESSAGE_LIMIT - header_reserve
+
+    digests = []
+    entries = []
+    items = []
+    size = 0
+
+    def flush():
+        header = f"📬 [{set_name}] Дайджест: {len(items)} совпадений\n\n"
+        digests.append((header + separator.join(entries), list(items)))
+
+    for delivery in deliveries:
+        entry = format_digest_entry(delivery)
+        while telegram_length(entry) > budget:
+            entry = entry[:-100]
+        extra = telegram_length(entry) + (telegram_length(separator) if entries else 0)
+        if entries and size + extra > budget:
+            flush()
+            entries, items, size = [], [], 0
+            extra = telegram_length(entry)
+        entries.append(entry)
+        items.append(delivery)
+        size += extra
+
+    if entries:
+        flush()
+    return digests
+
+
+class MatchStage:
+    """
+    Стадия матчинга между чтением каналов и доставкой. Чтение кладёт
+    MessageRecord в очередь (put) и продолжает листать канал; workers
+    обработчиков проверяют записи матчерами наборов (route_message) и
+    передают совпадения в очередь доставки. Совпадения записываются в
+    ChannelScan записи — по ним advance_cursors двигает курсоры.
+    """
+
+    def __init__(self, workers=None, maxsize=None):
+        self.workers = workers if workers is not None else MATCH_WORKERS
+        self.queue = StageQueue(maxsize if maxsize is not None else MATCH_QUEUE_SIZE)
+        self._tasks = []
+
+    def start(self, ctx):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._run(ctx)) for _ in range(self.workers)]
+
+    async def put(self, record, scan):
+        """Кладёт запись в очередь, возвращает секунды ожидания места"""
+        return await self.queue.put((record, scan))
+
+    async def flush(self):
+        """Ждёт проверки всего, что уже в очереди"""
+        await self.queue.join()
+
+    async def close(self):
+        """Проверяет остаток очереди и останавливает обработчики"""
+        if not self._tasks:
+            return
+        await self.flush()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _run(self, ctx):
+        while True:
+            record, scan = await self.queue.get()
+            try:
+                started = time.perf_counter()
+                pending, waited = await route_message(
+                    ctx, scan.subscribed_sets, scan.set_cursors, record
+                )
+                channel_metrics = ctx.metrics.channel(record.channel)
+                channel_metrics['match'] += time.perf_counter() - started - waited
+                channel_metrics['queue'] += waited
+                if pending is not None:
+                    scan.pending_messages.append(pending)
+            except Exception as e:
+                # Обработчик не должен умирать; курсоры канала не двигаем —
+                # сообщение проверится в следующий раз
+                scan.failed = True
+                print(f"❌ Ошибка стадии матчинга {record.channel}/{record.id}: {e}")
+                ctx.errors.append(f"{record.channel}/{record.id}: {e}")
+            finally:
+                self.queue.task_done()
+
+
+class DeliveryQueue:
+    """
+    Отдельная стадия доставки. Матчинг кладёт совпадения в очередь (put) и
+    продолжает работу, пока в ней есть место; workers отправителей разбирают
+    очередь под общим лимитером, так что паузы отправки и FloodWait бота не
+    тормозят скан. В режиме дайджеста совпадения, накопившиеся за
+    DIGEST_WINDOW_SECONDS, группируются по набору и уходят одним сообщением
+    (до 4096 символов) — отправитель тогда один. Результат каждой отправки
+    сообщается в Delivery.pending; текст отправленного совпадения отпускается.
+    """
+
+    def __init__(self, bot, limiter, digest=False, digest_window=0.0, metrics=None,
+                 workers=None, maxsize=None):
+        self.bot = bot
+        self.limiter = limiter
+        self.metrics = metrics or RunMetrics()
+        self.digest = digest
+        self.digest_window = digest_window
+        self.workers = 1 if digest else (workers if workers is not None else DELIVERY_WORKERS)
+        self.queue = StageQueue(maxsize if maxsize is not None else DELIVERY_QUEUE_SIZE)
+        self.sent_messages = 0
+        self._flushing = asyncio.Event()
+        self._senders = []
+
+    def start(self):
+        if not self._senders:
+            self._senders = [asyncio.create_task(self._run()) for _ in range(self.workers)]
+
+    async def put(self, delivery):
+        """Кладёт совпадение в очередь, возвращает секунды ожидания места"""
+        return await self.queue.put(delivery)
+
+    async def flush(self):
+        """Ждёт доставки всего, что уже в очереди (без ожидания окна дайджеста)"""
+        self._flushing.set()
+        try:
+            await self.queue.join()
+        finally:
+            self._flushing.clear()
+
+    async def notify(self, text, what):
+        """
+        Служебное сообщение (сводка ошибок) мимо очереди, но под тем же
+        лимитером и с тем же учётом FloodWait. True — доставлено.
+        """
+        return await self._send(text, 'монитор', what)
+
+    async def close(self):
+        """Доставляет остаток очереди и останавливает отправителя"""
+        if not self._senders:
+            return
+        await self.flush()
+        for sender in self._senders:
+            sender.cancel()
+        await asyncio.gather(*self._senders, return_exceptions=True)
+        self._senders = []
+
+    async def _run(self):
+        while True:
+            batch = [await self.queue.get()]
+            try:
+                if self.digest:
+                    await self._collect(batch)
+                    await self._deliver_digest(batch)
+                else:
+                    delivery = batch[0]
+                    delivery.dispatched = True
+                    delivered = await self._send(
+                        format_match(delivery), delivery.set_name,
+                        f"{delivery.channel_username} / {delivery.message_id}"
+                    )
+                    delivery.pending.resolve(delivery, delivered)
+            except Exception as e:
+                # Отправитель не должен умирать: несправившиеся — ретрай в след. прогон
+                print(f"❌ Ошибка стадии доставки: {e}")
+                for delivery in batch:
+                    if delivery.pending.outstanding:
+                        delivery.pending.resolve(delivery, False)
+            finally:
+                for delivery in batch:
+                    # Отправленному совпадению текст больше не нужен (в индексе
+                    # почти-дублей оно живёт до конца прогона)
+                    delivery.message_text = None
+                    self.queue.task_done()
+
+    async def _collect(self, batch):
+        """Добирает совпадения в пределах окна дайджеста (или до flush)"""
+        deadline = time.monotonic() + self.digest_window
+        while True:
+            while not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self._flushing.is_set():
+                return
+            getter = asyncio.ensure_future(self.queue.get())
+            flushing = asyncio.ensure_future(self._flushing.wait())
+            done, _ = await asyncio.wait(
+                {getter, flushing}, timeout=remaining, return_when=asyncio.FIRST_COMPLETED
+            )
+            flushing.cancel()
+            if getter in done:
+                batch.append(getter.result())
+            else:
+                getter.cancel()
+
+    async def _deliver_digest(self, batch):
+        by_set = {}
+        for delivery in batch:
+            delivery.dispatched = True
+            by_set.setdefault(delivery.set_name, []).append(delivery)
+
+        for set_name, deliveries in by_set.items():
+            for text, items in build_digests(set_name, deliveries):
+                delivered = await self._send(text, set_name, f"дайджест из {len(items)} совпадений")
+                for delivery in items:
+                    delivery.pending.resolve(delivery, delivered)
+
+    async def _send(self, text, set_name, what):
+        """Отправка под лимитером с ретраями на FloodWait. True — доставлено."""
+        for _ in range(SEND_RETRIES):
+            await self.limiter.acquire()
+            started = time.perf_counter()
+            try:
+                await self.bot.send_message(YOUR_USER_ID, text)
+                self.metrics.api_call('send_message', time.perf_counter() - started)
+                self.sent_messages += 1
+                print(f"✅ [{set_name}] Отправлено: {what}")
+                return True
+
+            except FloodWaitError as flood_error:
+                self.metrics.api_call('send_message', time.perf_counter() - started)
+                self.metrics.flood_wait('send_message', flood_error.seconds)
+                print(f"⏳ [{set_name}] FloodWait бота: ждём {flood_error.seconds} секунд...")
+                self.limiter.on_flood_wait(flood_error.seconds)
+
+            except Exception as bot_error:
+                self.metrics.api_call('send_message', time.perf_counter() - started)
+                print(f"❌ [{set_name}] Не удалось отправить {what}: {bot_error}")
+                return False
+
+        print(f"❌ [{set_name}] Исчерпаны попытки отправки {what}")
+        return False
+
+
+class TokenBucket:
+    """
+    Общий лимитер запросов к API (token bucket).
+    Ждать приходится только когда токены закончились; при FloodWaitError все
+    воркеры блокируются на указанное Telegram время, а скорость снижается
+    вдвое и затем плавно восстанавливается после успешных запросов.
+    """
+
+    # Нижняя граница скорости после серии FloodWait (доля от исходной)
+    MIN_RATE_FACTOR = 0.1
+    # Прирост скорости после каждого запроса без FloodWait (доля от исходной)
+    RECOVERY_STEP = 0.05
+
+    def __init__(self, rate, capacity):
+        self.base_rate = max(rate, 0.01)
+        self.rate = self.base_rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.waited_seconds = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        """Берёт один токен, при необходимости дожидаясь его. Возвращает секунды ожидания."""
+        started = time.monotonic()
+        # Lock держится и во время ожидания — токены выдаются по очереди
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    delay = self.blocked_until - now
+                else:
+                    self._refill(now)
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        self.rate = min(self.base_rate, self.rate + self.base_rate * self.RECOVERY_STEP)
+                        return time.monotonic() - started
+                    delay = (1 - self.tokens) / self.rate
+                self.waited_seconds += delay
+                await asyncio.sleep(delay)
+
+    def on_flood_wait(self, seconds):
+        """Реакция на FloodWaitError: пауза для всех и снижение скорости"""
+        now = time.monotonic()
+        self.blocked_until = max(self.blocked_until, now + seconds)
+        self.rate = max(self.base_rate * self.MIN_RATE_FACTOR, self.rate / 2)
+        self.tokens = 0.0
+        self.updated = now
+
+
+class ScanScheduler:
+    """
+    Планировщик сканирования: не больше workers каналов одновременно,
+    общий TokenBucket на все запросы к API.
+    """
+
+    def __init__(self, workers, limiter):
+        self.workers = workers
+        self.limiter = limiter
+        self._semaphore = asyncio.Semaphore(workers)
+
+    async def run(self, job):
+        """Выполняет job() (корутину-фабрику) в свободном слоте воркера"""
+        async with self._semaphore:
+            return await job()
+
+
+def plan_channels(monitor_sets):
+    """
+    Планирует прогон по каналам, а не по наборам: каждый уникальный канал
+    встречается один раз со списком всех наборов, которые на него подписаны.
+    Порядок — порядок первого упоминания канала в MONITOR_SETS.
+    """
+    plan = {}
+    for monitor_set in monitor_sets:
+        for channel in monitor_set['channels']:
+            subscribers = plan.setdefault(channel, [])
+            if monitor_set not in subscribers:
+                subscribers.append(monitor_set)
+    return plan
+
+
+def channel_shard(channel_username, shard_count):
+    """Номер шарда канала: стабильный между запусками хэш имени (не hash())"""
+    return zlib.crc32(channel_username.lower().encode('utf-8')) % shard_count
+
+
+def shard_monitor_sets(monitor_sets, shard_index, shard_count):
+    """
+    Наборы, урезанные до каналов шарда. Канал целиком (со всеми
+    подписанными наборами) достаётся одному шарду, поэтому отметки
+    processed и курсоры шардов не пересекаются.
+    """
+    sharded = []
+    for monitor_set in monitor_sets:
+        channels = [
+            channel for channel in monitor_set['channels']
+            if channel_shard(channel, shard_count) == shard_index
+        ]
+        if channels:
+            sharded.append(dict(monitor_set, channels=channels))
+    return sharded
+
+
+def shard_path(path, shard_index, shard_count):
+    """monitor_state.db -> monitor_state.shard-0-of-4.db"""
+    base, ext = os.path.splitext(path)
+    return f"{base}.shard-{shard_index}-of-{shard_count}{ext}"
+
+
+def merge_shards(paths, state_path=None):
+    """
+    Шаг слияния: вливает состояния шардов (файлы или каталоги с *.db) в
+    основное состояние STATE_DB. Курсоры каналов, которых больше нет в
+    конфигурации, вычищаются, как и при обычном прогоне, а старые отметки
+    и отпечатки — по сроку хранения: основное состояние пишет только этот
+    шаг, без очистки оно росло бы бесконечно.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(
+                os.path.join(path, name) for name in os.listdir(path) if name.endswith('.db')
+            ))
+        elif os.path.exists(path):
+            files.append(path)
+        else:
+            print(f"⚠️ Шард не найден: {path}")
+    if not files:
+        print("⚠️ Нет шардов для слияния")
+        return
+
+    state = StateStore(state_path or STATE_DB)
+    try:
+        for path in files:
+            if os.path.realpath(path) == os.path.realpath(state.path):
+                continue
+            added = state.merge_shard(path)
+            print(f"🧩 Шард {path}: добавлено отметок {added}")
+        monitor_sets = parse_monitor_sets()
+        if monitor_sets:
+            state.save_cursors(state.load_cursors(), monitor_sets)
+        removed, removed_fingerprints = state.prune()
+        if removed or removed_fingerprints:
+            print(f"🧹 Удалено старых записей: {removed}, отпечатков: {removed_fingerprints}")
+        print(f"💾 Состояние {state.path}: отметок {state.count_processed()}, "
+              f"курсоров каналов {len(state.load_cursors())}")
+    finally:
+        state.close()
+
+
+def backtest(config_path, archive_path, hours=None, all_channels=False, fts_query=None,
+             output=None, show=10):
+    """
+    Бэктест правил по архиву (MessageArchive) без запросов к Telegram:
+    наборы из config_path (формат MONITOR_SETS) проверяют архивные
+    сообщения своих каналов тем же матчером, что и в прогоне. Печатает
+    совпадения, сработавшие правила и исключения, а для наборов с тем же
+    именем в текущей конфигурации — какие совпадения добавятся и пропадут.
+    """
+    with open(config_path, 'r', encoding='utf-8') as f:
+        config_json = f.read()
+    try:
+        json.loads(config_json)
+    except json.JSONDecodeError as e:
+        print(f"❌ Некорректный JSON в {config_path}: {e}")
+        return
+    candidate = parse_monitor_sets(config_json)
+    if not candidate:
+        print("❌ В конфигурации нет корректных наборов")
+        return
+    if not os.path.exists(archive_path):
+        print(f"❌ Архив не найден: {archive_path}")
+        return
+
+    # Текущая конфигурация (MONITOR_SETS или старые переменные) — для сравнения
+    current = {monitor_set['name']: monitor_set for monitor_set in parse_monitor_sets()}
+    baseline_sets = [current[monitor_set['name']] for monitor_set in candidate
+                     if monitor_set['name'] in current]
+    plan = plan_channels(candidate)
+    baseline_plan = plan_channels(baseline_sets)
+    channels = None if all_channels else sorted(set(plan) | set(baseline_plan))
+
+    matches = {monitor_set['name']: [] for monitor_set in candidate}
+    rules = {name: Counter() for name in matches}
+    excluded = {name: Counter() for name in matches}
+    previous = {monitor_set['name']: set() for monitor_set in baseline_sets}
+
+    archive = MessageArchive(archive_path)
+    sandbox = open_pattern_sandbox(candidate + baseline_sets)
+    since = datetime.now(timezone.utc) - timedelta(hours=hours) if hours else None
+    evaluated = 0
+    started = time.perf_counter()
+    try:
+        for channel, message_id, date, text in archive.iter_messages(since, channels, fts_query):
+            evaluated += 1
+            # Текст разбирается один раз — для всех наборов обеих конфигураций
+            index = TextIndex(text)
+            for monitor_set in (candidate if all_channels else plan.get(channel, ())):
+                name = monitor_set['name']
+                forward, rule_kind, rule = monitor_set['matcher'].evaluate(text, index, sandbox)
+                if forward:
+                    rules[name][(rule_kind, rule)] += 1
+                    matches[name].append({
+                        'set': name, 'channel': channel, 'id': message_id,
+                        'date': date.isoformat(), 'rule_kind': rule_kind, 'rule': rule,
+                        'link': match_link(channel, message_id), 'text': text,
+                    })
+                elif rule_kind == 'exclude':
+                    excluded[name][rule] += 1
+            for monitor_set in (baseline_sets if all_channels else baseline_plan.get(channel, ())):
+                if monitor_set['matcher'].matches(text, index, sandbox):
+                    previous[monitor_set['name']].add((channel, message_id))
+    finally:
+        archive.close()
+        if sandbox is not None:
+            sandbox.close()
+    elapsed = time.perf_counter() - started
+
+    print(f"🧪 Бэктест {config_path} по архиву {archive_path}")
+    rate = f"{evaluated / elapsed:.0f}" if elapsed else "-"
+    print(f"   Проверено сообщений: {evaluated} за {elapsed:.2f} с ({rate} сообщ/с)")
+    if sandbox is not None:
+        for line in sandbox.report():
+            print(f"   ⏱️ {line}")
+
+    for name, found in matches.items():
+        print(f"\n📊 [{name}] Совпадений: {len(found)}")
+        for (rule_kind, rule), count in rules[name].most_common(5):
+            print(f"   {describe_rule((rule_kind, rule))}: {count}")
+        for rule, count in excluded[name].most_common(5):
+            print(f"   🚫 исключение «{rule}»: {count}")
+
+        if name in previous:
+            keys = {(match['channel'], match['id']) for match in found}
+            added = [match for match in found if (match['channel'], match['id']) not in previous[name]]
+            removed = sorted(previous[name] - keys)
+            print(f"   По сравнению с текущей конфигурацией: +{len(added)} / -{len(removed)}")
+            for match in added[-show:]:
+                print(f"   + {match['link']}  {match['text'][:80]!r}")
+            for channel, message_id in removed[-show:]:
+                print(f"   - {match_link(channel, message_id)}")
+        else:
+            for match in found[-show:]:
+                print(f"   • {match['date'][:16]} {match['link']}  {match['text'][:80]!r}")
+
+    if output:
+        directory = os.path.dirname(output)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(output, 'w', encoding='utf-8') as f:
+            for found in matches.values():
+                for match in found:
+                    f.write(json.dumps(match, ensure_ascii=False) + "\n")
+        print(f"\n💾 Совпадения: {output}")
+
+
+def channel_search_terms(subscribed_sets):
+    """
+    Ключевые слова для поиска на стороне Telegram или None, если канал
+    поиском не проверить: у какого-то подписанного набора есть паттерны или
+    нет ключевых слов (канал читается один раз на все наборы, так что
+    листать всё равно придётся).
+    """
+    terms = set()
+    for monitor_set in subscribed_sets:
+        if monitor_set['patterns'] or not monitor_set['keywords']:
+            return None
+        terms.update(monitor_set['keywords'])
+    return sorted(terms)
+
+
+def unread_hours(stats, has_cursor, now=None):
+    """
+    Сколько часов канала предстоит прочитать: с курсором — с прошлого
+    чтения (не больше окна), без курсора — всё окно TIME_RANGE_HOURS.
+    """
+    if not has_cursor or not stats:
+        return TIME_RANGE_HOURS
+    since = (now or datetime.now(timezone.utc)) - parse_timestamp(stats['scanned_at'])
+    return min(TIME_RANGE_HOURS, max(since.total_seconds() / 3600, 0.0))
+
+
+def channel_fetch_depth(stats, has_cursor):
+    """
+    Глубина чтения канала (limit для iter_messages). При ADAPTIVE_DEPTH —
+    ожидаемое число новых постов с запасом ADAPTIVE_DEPTH_HEADROOM, но
+    после упора в глубину — не меньше удвоенной прошлой глубины; в пределах
+    [ADAPTIVE_DEPTH_MIN, SEARCH_DEPTH_MAX]. Без оценки — SEARCH_DEPTH.
+    """
+    if ADAPTIVE_DEPTH == 'off' or not stats:
+        return SEARCH_DEPTH
+    depth = math.ceil(stats['posts_per_hour'] * unread_hours(stats, has_cursor) * ADAPTIVE_DEPTH_HEADROOM)
+    if stats.get('truncated') and stats.get('depth'):
+        depth = max(depth, stats['depth'] * 2)
+    return min(SEARCH_DEPTH_MAX, max(ADAPTIVE_DEPTH_MIN, depth))
+
+
+def poll_interval_hours(stats):
+    """Интервал опроса канала: время до POLL_TARGET_POSTS новых постов, не больше POLL_MAX_HOURS"""
+    if stats['posts_per_hour'] <= 0:
+        return POLL_MAX_HOURS
+    return min(POLL_MAX_HOURS, POLL_TARGET_POSTS / stats['posts_per_hour'])
+
+
+def channel_poll_due(stats, has_cursor, now=None):
+    """
+    Пора ли читать канал в этом запуске. Откладываются только каналы с
+    курсорами у всех наборов и с оценкой объёма, прочитанные позже своего
+    интервала опроса (poll_interval_hours), — и только если к следующему
+    запуску (ожидаемому через столько же, сколько прошло с прошлой проверки)
+    непрочитанное не выйдет за окно TIME_RANGE_HOURS.
+    """
+    if POLL_MAX_HOURS <= 0 or not has_cursor or not stats or stats.get('truncated'):
+        return True
+    now = now or datetime.now(timezone.utc)
+    since_scan = (now - parse_timestamp(stats['scanned_at'])).total_seconds() / 3600
+    if since_scan >= poll_interval_hours(stats):
+        return True
+    run_period = (now - parse_timestamp(stats['checked_at'])).total_seconds() / 3600
+    return since_scan + run_period >= TIME_RANGE_HOURS
+
+
+def choose_fetch_mode(channel_username, subscribed_sets, channel_stats, has_cursor, depth=None):
+    """
+    Модель стоимости чтения канала в запросах к API. Возвращает
+    ('history', None) или ('search', ключевые_слова).
+      листание — страниц по MESSAGES_PER_REQUEST на ожидаемое число
+                 постов (posts_per_hour × непроверенные часы, не больше
+                 глубины канала depth), минимум один запрос;
+      поиск    — по запросу на каждое ключевое слово.
+    Пока объём канала неизвестен (первый прогон), канал листается — заодно
+    появляется оценка.
+    """
+    if SEARCH_PUSHDOWN not in ('auto', 'always'):
+        return 'history', None
+    terms = channel_search_terms(subscribed_sets)
+    if not terms:
+        return 'history', None
+    if SEARCH_PUSHDOWN == 'always':
+        return 'search', terms
+
+    stats = channel_stats.get(channel_username)
+    if not stats:
+        return 'history', None
+    depth = depth if depth is not None else SEARCH_DEPTH
+    expected = min(depth, stats['posts_per_hour'] * unread_hours(stats, has_cursor))
+    history_requests = max(1, math.ceil(expected / MESSAGES_PER_REQUEST))
+    if len(terms) < history_requests:
+        return 'search', terms
+    return 'history', None
+
+
+def estimate_posts_per_hour(previous, in_window, span_hours):
+    """Постов в час по проходу истории, сглаженно с прошлой оценкой"""
+    rate = in_window / max(span_hours, 1 / 60)
+    if previous:
+        rate = (previous['posts_per_hour'] + rate) / 2
+    return round(rate, 3)
+
+
+def channel_gap(stats, min_id):
+    """
+    Непрочитанный провал прошлого прохода, упёршегося в глубину:
+    (offset_id, read_max_id) или None. Сообщения между min_id и offset_id
+    ещё не прочитаны, от offset_id до read_max_id — прочитаны. Провал
+    действителен только при тех же курсорах (gap_min_id == min_id): новый
+    набор или сдвинутый курсор требуют чтения заново.
+    """
+    if not stats or not stats.get('gap_offset_id') or stats.get('gap_min_id') != min_id:
+        return None
+    return stats['gap_offset_id'], stats['read_max_id']
+
+
+def update_channel_stats(previous, now, depth, truncated, posts_per_hour=None, last_post_at=None,
+                         gap=None):
+    """
+    Статистика канала после прохода. posts_per_hour и last_post_at — None,
+    если проход их не уточнил (поиск, нет новых постов): остаются прежними.
+    gap — (min_id, offset_id, read_max_id) провала, оставшегося после упора
+    в глубину (см. channel_gap), None — провала нет.
+    """
+    previous = previous or {}
+    gap_min_id, gap_offset_id, read_max_id = gap or (None, None, None)
+    return {
+        'posts_per_hour': posts_per_hour if posts_per_hour is not None else previous['posts_per_hour'],
+        'scanned_at': now.isoformat(),
+        'checked_at': now.isoformat(),
+        'last_post_at': last_post_at.isoformat() if last_post_at else previous.get('last_post_at'),
+        'depth': depth,
+        'scans': (previous.get('scans') or 0) + 1,
+        'cap_hits': (previous.get('cap_hits') or 0) + int(truncated),
+        'truncated': int(truncated),
+        'gap_min_id': gap_min_id,
+        'gap_offset_id': gap_offset_id,
+        'read_max_id': read_max_id,
+    }
+
+
+def new_set_stats(monitor_sets):
+    """Пустая статистика по каждому набору"""
+    return {
+        monitor_set['name']: {'checked': 0, 'forwarded': 0, 'skipped': 0, 'near_duplicates': 0}
+        for monitor_set in monitor_sets
+    }
+
+
+class RunMetrics:
+    """
+    Инструментирование прогона: время фаз прогона, фаз каждого канала
+    (резолв, чтение истории, ожидание лимитера, ожидание места в очередях
+    конвейера, матчинг) и матчинга каждого набора, число и время вызовов API
+    по методам, секунды FloodWait, глубина очередей между стадиями.
+    Итог — snapshot(), который пишется в JSON и в textfile для Prometheus.
+    """
+
+    CHANNEL_PHASES = ('resolve', 'fetch', 'throttle', 'queue', 'match')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = Counter()
+        self.api_calls = Counter()
+        self.api_seconds = Counter()
+        self.flood_wait_seconds = Counter()
+        self.flood_waits = Counter()
+        self.channels = {}
+        self.sets = {}
+        self.startup = {}
+        self.deferred_channels = 0
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] += time.perf_counter() - started
+
+    def api_call(self, method, seconds, calls=1):
+        self.api_calls[method] += calls
+        self.api_seconds[method] += seconds
+
+    def flood_wait(self, method, seconds):
+        self.flood_waits[method] += 1
+        self.flood_wait_seconds[method] += seconds
+
+    def channel(self, channel_username):
+        metrics = self.channels.get(channel_username)
+        if metrics is None:
+            metrics = dict.fromkeys(self.CHANNEL_PHASES, 0.0)
+            metrics.update(messages=0, pages=0, flood_waits=0, depth=0, truncated=0)
+            self.channels[channel_username] = metrics
+        return metrics
+
+    def set_match(self, set_name, seconds):
+        metrics = self.sets.setdefault(set_name, {'match': 0.0, 'evaluated': 0})
+        metrics['match'] += seconds
+        metrics['evaluated'] += 1
+
+    def snapshot(self, ctx):
+        """Все метрики прогона одним словарём (для JSON и Prometheus)"""
+        elapsed = time.perf_counter() - self.started
+        messages = sum(channel['messages'] for channel in self.channels.values())
+        sets = {}
+        for set_name, stats in ctx.set_stats.items():
+            timing = self.sets.get(set_name, {'match': 0.0, 'evaluated': 0})
+            sets[set_name] = dict(stats, match_seconds=round(timing['match'], 6))
+        return {
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'run_seconds': round(elapsed, 3),
+            'phases': {name: round(seconds, 3) for name, seconds in self.phases.items()},
+            'startup': {key: round(value, 3) for key, value in self.startup.items()},
+            'messages_scanned': messages,
+            'channels_deferred': self.deferred_channels,
+            'truncated_scans': sum(channel['truncated'] for channel in self.channels.values()),
+            'messages_per_sec': round(messages / elapsed, 1) if elapsed else 0.0,
+            'matcher_seconds': round(sum(timing['match'] for timing in self.sets.values()), 6),
+            'messages': dict(ctx.stats),
+            'errors': len(ctx.errors),
+            'api_calls': dict(self.api_calls),
+            'api_seconds': {method: round(seconds, 3) for method, seconds in self.api_seconds.items()},
+            'flood_waits': dict(self.flood_waits),
+            'flood_wait_seconds': dict(self.flood_wait_seconds),
+            'throttle_seconds': {
+                'api': round(ctx.limiter.waited_seconds, 3),
+                'bot': round(ctx.delivery.limiter.waited_seconds, 3),
+            },
+            'entity_cache': {
+                'hits': ctx.entity_cache.hits,
+                'misses': ctx.entity_cache.misses,
+                'invalidated': ctx.entity_cache.invalidated,
+            },
+            'sent_messages': ctx.delivery.sent_messages,
+            'queues': {
+                'match': ctx.matching.queue.snapshot(),
+                'delivery': ctx.delivery.queue.snapshot(),
+            },
+            'patterns': {
+                'evaluations': ctx.patterns.evaluations if ctx.patterns else 0,
+                'timeouts': sum(ctx.patterns.run_timeouts.values()) if ctx.patterns else 0,
+                'quarantined': len(ctx.patterns.quarantined) if ctx.patterns else 0,
+            },
+            'channels': {
+                channel: {key: round(value, 6) if isinstance(value, float) else value
+                          for key, value in metrics.items()}
+                for channel, metrics in self.channels.items()
+            },
+            'sets': sets,
+        }
+
+
+def prometheus_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_prometheus(snapshot):
+    """Снимок метрик в текстовом формате Prometheus (textfile collector)"""
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f"# HELP telegram_monitor_{name} {help_text}")
+        lines.append(f"# TYPE telegram_monitor_{name} {kind}")
+        for labels, value in samples:
+            label_str = ','.join(f'{key}="{prometheus_label(val)}"' for key, val in labels.items())
+            lines.append(f"telegram_monitor_{name}{{{label_str}}} {value}" if label_str
+                         else f"telegram_monitor_{name} {value}")
+
+    metric('last_run_timestamp_seconds', 'gauge', "Время записи метрик (unix)",
+           [({}, round(time.time(), 3))])
+    metric('run_seconds', 'gauge', "Длительность прогона",
+           [({}, snapshot['run_seconds'])])
+    metric('phase_seconds', 'gauge', "Время фаз прогона",
+           [({'phase': name}, value) for name, value in snapshot['phases'].items()])
+    metric('startup_seconds', 'gauge', "Подключение клиентов при старте",
+           [({'client': key[:-len('_seconds')]}, value) for key, value in snapshot['startup'].items()
+            if key.endswith('_seconds')])
+    metric('bot_session_warm', 'gauge', "Бот подключён с сохранённой сессией",
+           [({}, snapshot['startup'].get('bot_warm', 0))])
+    metric('messages_scanned', 'gauge', "Прочитано сообщений из истории",
+           [({}, snapshot['messages_scanned'])])
+    metric('channels_deferred', 'gauge', "Каналы, отложенные расписанием опроса",
+           [({}, snapshot['channels_deferred'])])
+    metric('truncated_scans', 'gauge', "Проходы, упёршиеся в глубину (часть окна не прочитана)",
+           [({}, snapshot['truncated_scans'])])
+    metric('messages_per_second', 'gauge', "Сообщений в секунду за прогон",
+           [({}, snapshot['messages_per_sec'])])
+    metric('matcher_seconds', 'gauge', "Суммарное время матчинга",
+           [({}, snapshot['matcher_seconds'])])
+    metric('messages', 'gauge', "Сообщения по результату",
+           [({'result': name}, value) for name, value in snapshot['messages'].items()])
+    metric('errors', 'gauge', "Ошибки каналов", [({}, snapshot['errors'])])
+    metric('api_calls', 'gauge', "Вызовы Telegram API по методам",
+           [({'method': name}, value) for name, value in snapshot['api_calls'].items()])
+    metric('api_seconds', 'gauge', "Время вызовов Telegram API по методам",
+           [({'method': name}, value) for name, value in snapshot['api_seconds'].items()])
+    metric('flood_waits', 'gauge', "Число FloodWaitError по методам",
+           [({'method': name}, value) for name, value in snapshot['flood_waits'].items()])
+    metric('flood_wait_seconds', 'gauge', "Секунды FloodWait, запрошенные Telegram",
+           [({'method': name}, value) for name, value in snapshot['flood_wait_seconds'].items()])
+    metric('throttle_seconds', 'gauge', "Ожидание в лимитерах",
+           [({'limiter': name}, value) for name, value in snapshot['throttle_seconds'].items()])
+    metric('entity_cache', 'gauge', "Кэш резолва каналов",
+           [({'result': name}, value) for name, value in snapshot['entity_cache'].items()])
+    metric('sent_messages', 'gauge', "Отправлено сообщений ботом",
+           [({}, snapshot['sent_messages'])])
+    metric('queue', 'gauge', "Очереди конвейера: глубина, пик, ожидание места",
+           [({'stage': stage, 'stat': name}, value)
+            for stage, stats in snapshot['queues'].items() for name, value in stats.items()])
+    metric('patterns', 'gauge', "Песочница паттернов: проверки, превышения бюджета, карантин",
+           [({'result': name}, value) for name, value in snapshot['patterns'].items()])
+    metric('channel_phase_seconds', 'gauge', "Время фаз обработки канала",
+           [({'channel': channel, 'phase': phase}, metrics[phase])
+            for channel, metrics in snapshot['channels'].items()
+            for phase in RunMetrics.CHANNEL_PHASES])
+    metric('channel_messages', 'gauge', "Прочитано сообщений канала",
+           [({'channel': channel}, metrics['messages'])
+            for channel, metrics in snapshot['channels'].items()])
+    metric('channel_depth', 'gauge', "Глубина чтения канала",
+           [({'channel': channel}, metrics['depth'])
+            for channel, metrics in snapshot['channels'].items()])
+    metric('channel_truncated', 'gauge', "Проходы канала, упёршиеся в глубину",
+           [({'channel': channel}, metrics['truncated'])
+            for channel, metrics in snapshot['channels'].items()])
+    metric('set_match_seconds', 'gauge', "Время матчинга набора",
+           [({'set': name}, stats['match_seconds']) for name, stats in snapshot['sets'].items()])
+    metric('set_messages', 'gauge', "Сообщения набора по результату",
+           [({'set': name, 'result': key}, value)
+            for name, stats in snapshot['sets'].items()
+            for key, value in stats.items() if key != 'match_seconds'])
+    return "\n".join(lines) + "\n"
+
+
+def write_atomic(path, text):
+    """Запись через временный файл: сборщик не увидит недописанный файл"""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def write_metrics(ctx, json_path=None, prom_path=None):
+    """Пишет метрики прогона в JSON и/или textfile Prometheus"""
+    json_path = json_path if json_path is not None else METRICS_FILE
+    prom_path = prom_path if prom_path is not None else METRICS_PROM_FILE
+    if not json_path and not prom_path:
+        return
+    snapshot = ctx.metrics.snapshot(ctx)
+    try:
+        if json_path:
+            write_atomic(json_path, json.dumps(snapshot, ensure_ascii=False, indent=2))
+        if prom_path:
+            write_atomic(prom_path, format_prometheus(snapshot))
+    except OSError as e:
+        print(f"❌ Не удалось записать метрики: {e}")
+
+
+class MessageRecorder:
+    """
+    Пишет сообщения, полученные из iter_messages (и событиями в режиме
+    демона), в JSONL: по файлу на канал, строка — {channel, id, date, text}.
+    Записи воспроизводятся replay_harness.py без сети и учётных данных.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.records = 0
+        self._files = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def _file(self, channel_username):
+        f = self._files.get(channel_username)
+        if f is None:
+            name = re.sub(r'[^\w.-]', '_', channel_username.lstrip('@')) or 'channel'
+            f = open(os.path.join(self.directory, f"{name}.jsonl"), 'a', encoding='utf-8')
+            self._files[channel_username] = f
+        return f
+
+    def write(self, channel_username, message):
+        record = {
+            'channel': channel_username,
+            'id': message.id,
+            'date': message.date.isoformat() if message.date else None,
+            'text': message.text or "",
+        }
+        self._file(channel_username).write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.records += 1
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files.clear()
+
+
+class RunContext:
+    """Общее состояние прогона, которое делят стадии чтения, матчинга и доставки"""
+
+    def __init__(self, client, monitor_sets, processed, cursors, entity_cache, limiter, delivery,
+                 recorder=None, metrics=None, channel_stats=None, archive=None, near_dups=None,
+                 patterns=None, matching=None):
+        self.client = client
+        self.processed = processed
+        self.cursors = cursors
+        # Оценки объёма каналов для выбора поиск/листание
+        self.channel_stats = channel_stats if channel_stats is not None else {}
+        self.entity_cache = entity_cache
+        self.limiter = limiter
+        self.delivery = delivery
+        # Стадия матчинга между чтением каналов и доставкой
+        self.matching = matching if matching is not None else MatchStage()
+        self.recorder = recorder
+        self.archive = archive
+        # Индекс почти-дублей (NearDuplicateIndex) или None, если выключено
+        self.near_dups = near_dups
+        # Песочница паттернов (PatternSandbox) или None — проверка в процессе
+        self.patterns = patterns
+        self.metrics = metrics or delivery.metrics
+        self.errors = []
+        # Статистика по каналам (каждое сообщение учитывается один раз)
+        self.stats = {'new': 0, 'forwarded': 0, 'skipped': 0}
+        self.set_stats = new_set_stats(monitor_sets)
+        # Полностью пройденные каналы (ChannelScan), чьи курсоры двигаются
+        # после матчинга и доставки
+        self.completed_scans = []
+        # Канал -> ID, по который история прочитана без пропусков в этом
+        # процессе (полный проход и примыкающие к нему события демона)
+        self.caught_up = {}
+        # Ключи сообщений, доставка которых ещё идёт (защита от повторной
+        # постановки в очередь, когда сообщение пришло и событием, и в проходе)
+        self.inflight = set()
+
+
+async def route_message(ctx, subscribed_sets, set_cursors, record):
+    """
+    Проверяет одну запись (MessageRecord) матчерами подписанных наборов и
+    кладёт совпадения в очередь доставки. Общая логика для прохода по
+    истории и для событий NewMessage в режиме демона (стадия MatchStage).
+    Возвращает (PendingMessage или None, если ничего не ушло в доставку;
+    секунды ожидания места в очереди доставки).
+    """
+    channel_username = record.channel
+    # Создаем уникальный ID для сообщения (канал + ID сообщения)
+    unique_id = f"{channel_username}:{record.id}"
+
+    # Пропускаем уже обработанные (проверка на дубли) и ещё доставляемые
+    if unique_id in ctx.processed or unique_id in ctx.inflight:
+        ctx.stats['skipped'] += 1
+        for monitor_set in subscribed_sets:
+            ctx.set_stats[monitor_set['name']]['skipped'] += 1
+        return None, 0.0
+
+    message_text = record.text
+
+    # На время проверки сообщение занято: паттерны проверяются вне цикла
+    # событий, и за это время оно может прийти повторно (событием демона)
+    ctx.inflight.add(unique_id)
+    try:
+        deliveries = await match_message(ctx, unique_id, subscribed_sets, set_cursors,
+                                         record.id, message_text)
+    finally:
+        ctx.inflight.discard(unique_id)
+
+    fingerprint = None
+    if deliveries and ctx.near_dups is not None:
+        deliveries, fingerprint = suppress_near_duplicates(
+            ctx, channel_username, record.id, message_text, deliveries
+        )
+
+    if not deliveries:
+        # Несовпавшие (и отсеянные почти-дубли) помечаем сразу, чтобы не
+        # проверять их повторно
+        ctx.processed[unique_id] = datetime.now(timezone.utc).isoformat()
+        ctx.stats['new'] += 1
+        return None, 0.0
+
+    # Совпавшие — в очередь доставки; отметку поставит PendingMessage
+    pending = PendingMessage(ctx, unique_id, record.id)
+    pending.outstanding = len(deliveries)
+    ctx.inflight.add(unique_id)
+    waited = 0.0
+    for set_name, rule in deliveries:
+        delivery = Delivery(channel_username, record.id, message_text, set_name, rule, pending)
+        if fingerprint is not None:
+            delivery.near_dup_entry = ctx.near_dups.add(set_name, fingerprint, channel_username,
+                                                        record.id, delivery)
+        waited += await ctx.delivery.put(delivery)
+    return pending, waited
+
+
+async def match_message(ctx, unique_id, subscribed_sets, set_cursors, message_id, message_text):
+    """
+    Проверяет сообщение матчером каждого подписанного набора; текст
+    разбирается на слова один раз (при первой проверке) для всех наборов.
+    Паттерны наборов при включённой песочнице проверяются в её процессах
+    (из потока — цикл событий не ждёт медленный regex).
+    Возвращает [(набор, (тип_правила, правило))] для доставки.
+    """
+    deliveries = []
+    index = None
+    for monitor_set in subscribed_sets:
+        set_name = monitor_set['name']
+        # Набор уже проверил это сообщение в прошлый раз
+        if set_cursors.get(set_name, 0) >= message_id:
+            continue
+        ctx.set_stats[set_name]['checked'] += 1
+        started = time.perf_counter()
+        if index is None and MATCH_MODE == 'token':
+            index = TextIndex(message_text)
+        matcher = monitor_set['matcher']
+        if ctx.patterns is not None and matcher.patterns:
+            forward, rule_kind, rule = await asyncio.to_thread(
+                matcher.evaluate, message_text, index, ctx.patterns
+            )
+        else:
+            forward, rule_kind, rule = matcher.evaluate(message_text, index)
+        ctx.metrics.set_match(set_name, time.perf_counter() - started)
+        if not forward:
+            continue
+
+        # Этому набору уже доставлено в прошлый раз (частичный сбой)
+        if f"{unique_id}#{set_name}" in ctx.processed:
+            continue
+
+        deliveries.append((set_name, (rule_kind, rule)))
+    return deliveries
+
+
+def suppress_near_duplicates(ctx, channel_username, message_id, message_text, deliveries):
+    """
+    Отсеивает совпадения, которые набор уже получил из другого канала
+    (почти-дубль по SimHash). В режиме fold ссылка на копию дописывается к
+    оригиналу, если тот ещё не отправлен. Возвращает (оставшиеся
+    совпадения, отпечаток текста или None).
+    """
+    fingerprint = simhash(message_text)
+    if fingerprint is None:
+        return deliveries, None
+
+    kept = []
+    for set_name, rule in deliveries:
+        original = ctx.near_dups.find(set_name, fingerprint, channel_username, message_id)
+        if original is None:
+            kept.append((set_name, rule))
+            continue
+
+        ctx.set_stats[set_name]['near_duplicates'] += 1
+        original_delivery = original[4]
+        if NEAR_DUP_MODE == 'fold' and original_delivery is not None and not original_delivery.dispatched:
+            original_delivery.also.append(match_link(channel_username, message_id))
+            print(f"🔁 [{set_name}] {channel_username}/{message_id} — копия "
+                  f"{original[2]}/{original[3]}, добавлено в уведомление")
+        else:
+            print(f"🔁 [{set_name}] {channel_username}/{message_id} — копия "
+                  f"{original[2]}/{original[3]}, не отправляется")
+    return kept, fingerprint
+
+
+async def monitor_channel(ctx, channel_username, subscribed_sets):
+    """
+    Мониторит один канал для всех подписанных на него наборов.
+    Канал резолвится и листается один раз; каждое сообщение в окне
+    превращается в MessageRecord и уходит в очередь стадии матчинга
+    (MatchStage), оттуда совпадения — в очередь доставки. Чтение не ждёт ни
+    матчинга, ни отправки, пока в очереди есть место.
+    Каждый запрос к API (get_entity и каждая страница iter_messages) проходит
+    через общий лимитер; при FloodWaitError лимитер притормаживает все
+    воркеры, а канал перечитывается (уже обработанное пропускается).
+    Резолв канала берётся из кэша entity; если закэшированный peer
+    не сработал, запись сбрасывается и канал резолвится заново.
+
+    Если у всех подписанных наборов есть курсор, запрашиваются только
+    сообщения новее самого старого из них (min_id). Курсоры двигаются
+    только после полного прохода и доставки (см. advance_cursors).
+
+    Для каналов, где все наборы — только ключевые слова, при
+    SEARCH_PUSHDOWN вместо листания истории может выполняться поиск Telegram
+    по каждому ключевому слову (см. choose_fetch_mode). Найденное проходит
+    ту же локальную проверку (исключения, правила совпадения).
+
+    Глубина чтения — своя у каждого канала (channel_fetch_depth). Если
+    проход упёрся в глубину, не дойдя до окна или курсора, это считается в
+    метрике truncated, курсоры канала не двигаются, а непрочитанный провал
+    запоминается в статистике канала (channel_gap). Следующий проход
+    сначала листает провал от самого старого прочитанного (offset_id) вниз
+    до курсора и, только закрыв его, читает новое выше прочитанного —
+    провал закрывается по частям, даже если новых постов каждый раз больше
+    глубины (новое при этом ждёт своей очереди).
+    """
+    # ID, уже учтённые в этом вызове: при повторе после FloodWait не считаем
+    # их второй раз (ни как новые, ни как дубли)
+    seen_ids = set()
+    set_names = ', '.join(monitor_set['name'] for monitor_set in subscribed_sets)
+
+    set_cursors = dict(ctx.cursors.get(channel_username, {}))
+    # Совпадения прохода (со всех попыток) собирает стадия матчинга
+    scan = ChannelScan(channel_username, subscribed_sets, set_cursors)
+    known_cursors = [set_cursors.get(monitor_set['name']) for monitor_set in subscribed_sets]
+    # Хотя бы у одного набора нет курсора (новый канал/набор) — читаем всё окно
+    min_id = 0 if None in known_cursors else min(known_cursors)
+
+    channel_metrics = ctx.metrics.channel(channel_username)
+
+    # Глубина по статистике канала (см. channel_fetch_depth)
+    depth = channel_fetch_depth(ctx.channel_stats.get(channel_username), min_id > 0)
+    channel_metrics['depth'] = depth
+
+    mode, search_terms = choose_fetch_mode(
+        channel_username, subscribed_sets, ctx.channel_stats, min_id > 0, depth
+    )
+    # Листание — один запрос без search, поиск — по запросу на слово
+    reads = [{'search': term} for term in search_terms] if mode == 'search' else [{}]
+    if mode == 'search':
+        print(f"🔎 [{set_names}] {channel_username}: поиск по {len(search_terms)} ключевым словам")
+    gap = channel_gap(ctx.channel_stats.get(channel_username), min_id) if mode == 'history' else None
+    if gap:
+        # Сначала провал под прочитанным (offset_id отдаёт сообщения старше
+        # себя), и только если он закрыт — новое выше прочитанного. Иначе при
+        # потоке больше глубины до провала не доходила бы очередь никогда.
+        reads = [{'offset_id': gap[0]}, {'min_id': gap[1]}]
+        print(f"🕳️ [{set_names}] {channel_username}: дочитываю провал "
+              f"{min_id}..{gap[0]} после упора в глубину")
+
+    attempt = 0
+    from_cache = False
+    while attempt < FLOOD_RETRIES:
+        attempt += 1
+        try:
+            # Получаем канал (из кэша или через get_entity)
+            method = 'get_entity'
+            started = time.perf_counter()
+            try:
+                channel, from_cache = await resolve_channel(
+                    ctx.client, channel_username, ctx.entity_cache, ctx.limiter, ctx.metrics
+                )
+            finally:
+                channel_metrics['resolve'] += time.perf_counter() - started
+
+            print(f"📡 [{set_names}] Проверяю канал: {channel_username}")
+
+            # Получаем сообщения за заданный период (message.date — aware UTC)
+            time_threshold = datetime.now(timezone.utc) - timedelta(hours=TIME_RANGE_HOURS)
+
+            # Получаем сообщения с учетом глубины поиска. Telethon запрашивает
+            # историю страницами по MESSAGES_PER_REQUEST — перед каждой
+            # страницей берём токен у лимитера.
+            max_seen_id = 0
+            in_window = 0
+            newest_date = None
+            oldest_date = None
+            reached_threshold = False
+            # Упёрлись в глубину, не дойдя ни до окна, ни до курсора
+            truncated = False
+            read_new = False  # читали новое (а не только провал)
+            # Провал, который останется после прохода: (min_id, offset_id, read_max_id)
+            new_gap = None
+            for read in reads:
+                gap_read = 'offset_id' in read
+                if gap and truncated:
+                    break  # провал не дочитан — новое ждёт следующего прохода
+                read_new = read_new or not gap_read
+                method = 'search' if 'search' in read else 'iter_messages'
+                channel_metrics['throttle'] += await ctx.limiter.acquire()
+                pages = 1
+                fetched = 0
+                query_threshold = False
+                # Время чтения = время цикла минус ожидание места в очереди
+                # матчинга и ожидание лимитера
+                loop_started = time.perf_counter()
+                loop_overhead = 0.0
+                oldest_id = None
+                try:
+                    async for message in ctx.client.iter_messages(
+                            channel, limit=depth, **{'min_id': min_id, **read}):
+                        fetched += 1
+                        channel_metrics['messages'] += 1
+                        if fetched % MESSAGES_PER_REQUEST == 0:
+                            waited = await ctx.limiter.acquire()
+                            channel_metrics['throttle'] += waited
+                            loop_overhead += waited
+                            pages += 1
+                        # Дальше по конвейеру идёт компактная запись, а не
+                        # сообщение Telethon
+                        record = MessageRecord.from_message(channel_username, message)
+                        if ctx.recorder is not None:
+                            ctx.recorder.write(channel_username, record)
+
+                        # Сообщения идут от новых к старым; даже сообщение вне окна
+                        # двигает курсор — всё, что старше, тоже вне окна
+                        max_seen_id = max(max_seen_id, record.id)
+                        oldest_id = record.id
+                        if newest_date is None or record.date > newest_date:
+                            newest_date = record.date
+
+                        # Пропускаем старые сообщения
+                        if record.date < time_threshold:
+                            reached_threshold = query_threshold = True
+                            break
+                        if not gap_read:
+                            # Оценка объёма — по новым постам, не по провалу
+                            in_window += 1
+                            oldest_date = record.date
+                        if ctx.archive is not None:
+                            ctx.archive.add(channel_username, record)
+
+                        if record.id in seen_ids:
+                            continue
+                        seen_ids.add(record.id)
+
+                        # В очередь матчинга; ждём, только если она заполнена
+                        waited = await ctx.matching.put(record, scan)
+                        channel_metrics['queue'] += waited
+                        loop_overhead += waited
+                finally:
+                    fetch_seconds = time.perf_counter() - loop_started - loop_overhead
+                    channel_metrics['fetch'] += fetch_seconds
+                    channel_metrics['pages'] += pages
+                    ctx.metrics.api_call(method, fetch_seconds, calls=pages)
+                if fetched >= depth and not query_threshold:
+                    truncated = True
+                    if gap_read:
+                        # Провал сузился: прочитанное выше oldest_id непрерывно
+                        # вместе с прочитанным в прошлые проходы
+                        new_gap = (min_id, oldest_id, gap[1])
+                    elif gap:
+                        # Провал закрыт, но новое выше него не дочитано:
+                        # курсор дойдёт до gap[1], провал — уже над ним
+                        new_gap = (gap[1], oldest_id, max_seen_id)
+                    elif mode == 'history':
+                        new_gap = (min_id, oldest_id, max_seen_id)
+
+            previous = ctx.channel_stats.get(channel_username)
+            now = datetime.now(timezone.utc)
+            if mode == 'history':
+                # Оценка объёма для модели стоимости и глубины: за какой
+                # период прочитаны in_window сообщений окна
+                if not read_new:
+                    span = None  # читали только провал — новое не оценить
+                elif (gap or truncated) and oldest_date:
+                    # Упёрлись в глубину или новое читалось от прочитанного
+                    # в прошлые проходы — период по датам прочитанного
+                    span = now - oldest_date
+                elif min_id and previous and not reached_threshold:
+                    span = min(now - parse_timestamp(previous['scanned_at']),
+                               timedelta(hours=TIME_RANGE_HOURS))
+                else:
+                    span = timedelta(hours=TIME_RANGE_HOURS)
+                posts_per_hour = None
+                if span is not None:
+                    posts_per_hour = estimate_posts_per_hour(
+                        previous, in_window, span.total_seconds() / 3600
+                    )
+                ctx.channel_stats[channel_username] = update_channel_stats(
+                    previous, now, depth, truncated,
+                    posts_per_hour=posts_per_hour,
+                    last_post_at=newest_date,
+                    gap=new_gap,
+                )
+            elif previous:
+                # Поиск видит не все посты — оценка объёма остаётся прежней
+                ctx.channel_stats[channel_username] = update_channel_stats(
+                    previous, now, depth, truncated
+                )
+
+            if truncated:
+                channel_metrics['truncated'] += 1
+                print(f"⚠️ [{set_names}] {channel_username}: упёрлись в глубину {depth}, "
+                      f"окно прочитано не до конца")
+            if truncated and not (gap and read_new):
+                # Часть окна между курсором и самым старым прочитанным не
+                # просмотрена: курсор не двигаем. iter_messages всегда
+                # начинает с новых постов, поэтому при листании провал
+                # запомнен (new_gap) и следующий проход листает его
+                # отдельно с offset_id. Поиск провал не запоминает: он
+                # закроется, только если следующий проход охватит и новое,
+                # и пропущенное. Проход идёт в advance_cursors лишь для
+                # учёта недоставленного в прочитанной части (settle_gap).
+                scan.truncated = True
+                ctx.completed_scans.append(scan)
+                return
+
+            if gap:
+                # Провал дочитан: вместе с прочитанным в прошлые проходы канал
+                # просмотрен от курсора до gap[1], а если и новое уместилось
+                # в глубину — до самого нового
+                max_seen_id = gap[1] if truncated else max(max_seen_id, gap[1])
+
+            # Проход завершён полностью — курсоры можно будет двигать после
+            # доставки. При ошибке посреди прохода сюда не попадаем:
+            # непросмотренные старые сообщения не должны оказаться «за» курсором.
+            if max_seen_id:
+                scan.max_seen_id = max_seen_id
+                ctx.completed_scans.append(scan)
+            if max_seen_id or min_id:
+                ctx.caught_up[channel_username] = max(
+                    ctx.caught_up.get(channel_username, 0), max_seen_id or min_id
+                )
+            return
+
+        except FloodWaitError as flood_error:
+            ctx.metrics.flood_wait(method, flood_error.seconds)
+            channel_metrics['flood_waits'] += 1
+            print(f"⏳ [{set_names}] FloodWait в канале {channel_username}: "
+                  f"{flood_error.seconds} с (попытка {attempt}/{FLOOD_RETRIES})")
+            ctx.limiter.on_flood_wait(flood_error.seconds)
+
+        except Exception as e:
+            if from_cache and isinstance(e, PEER_ERRORS):
+                # Закэшированный peer не работает (см. PEER_ERRORS) —
+                # сбрасываем и резолвим заново.
+                # Эта повторная попытка не расходует лимит попыток FloodWait.
+                print(f"♻️ [{set_names}] Сбрасываю кэш entity {channel_username}: {e}")
+                ctx.entity_cache.invalidate(channel_username)
+                from_cache = False
+                attempt -= 1
+                continue
+
+            # Не шлём уведомление на каждый канал (спам) — накапливаем и шлём сводку
+            print(f"❌ [{set_names}] Ошибка в канале {channel_username}: {e}")
+            ctx.errors.append(f"[{set_names}] {channel_username}: {e}")
+            return
+
+    print(f"❌ [{set_names}] Исчерпаны попытки для канала {channel_username} (FloodWait)")
+    ctx.errors.append(f"[{set_names}] {channel_username}: FloodWait, исчерпаны попытки")
+
+
+def settle_gap(ctx, scan):
+    """
+    Проход упёрся в глубину: прочитанная часть над провалом (channel_gap)
+    не должна включать сообщения, доставка которых не удалась или не
+    подтверждена, — иначе, когда провал дочитают, курсор перескочит через
+    них. Прочитанная часть обрезается до первого недоставленного;
+    если от неё ничего не осталось или матчинг упал — провал забывается и
+    канал читается заново от курсора.
+    """
+    stats = ctx.channel_stats.get(scan.channel_username)
+    if not stats or not stats.get('gap_offset_id'):
+        return
+    undelivered = [pending.message_id for pending in scan.pending_messages
+                   if pending.failed_sets or pending.outstanding]
+    if undelivered:
+        stats['read_max_id'] = min(stats['read_max_id'], min(undelivered) - 1)
+    if scan.failed or stats['read_max_id'] < stats['gap_offset_id']:
+        stats['gap_min_id'] = stats['gap_offset_id'] = stats['read_max_id'] = None
+
+
+def advance_cursors(ctx):
+    """
+    Двигает курсоры полностью пройденных каналов (и сообщений, пришедших
+    событиями), когда доставка их совпадений завершена: до максимального
+    просмотренного ID, но не дальше первого сообщения, которое набору
+    доставить не удалось (или доставка которого ещё не подтверждена).
+
+    Событие двигает курсор, только если примыкает к прочитанной истории
+    канала (ctx.caught_up): его ID не больше отметки или следует сразу за
+    ней. Иначе между историей и событием мог остаться непрочитанный хвост
+    (проход догонки упал, упёрся в глубину или обновления потерялись) —
+    такие события ждут следующего прохода по каналу, а курсор не
+    перескакивает через хвост.
+    """
+    scans, held = [], []
+    live = {}
+    for scan in ctx.completed_scans:
+        if not scan.live:
+            settle_gap(ctx, scan)
+        if scan.truncated or scan.failed:
+            continue
+        if scan.live:
+            live.setdefault(scan.channel_username, []).append(scan)
+        else:
+            scans.append(scan)
+    for channel_username, channel_scans in live.items():
+        channel_scans.sort(key=lambda scan: scan.max_seen_id)
+        through = ctx.caught_up.get(channel_username)
+        for index, scan in enumerate(channel_scans):
+            if through is None or scan.max_seen_id > through + 1:
+                held.extend(channel_scans[index:])
+                break
+            through = max(through, scan.max_seen_id)
+            scans.append(scan)
+        if through is not None:
+            ctx.caught_up[channel_username] = through
+
+    # (канал, набор) -> [максимальный ID, минимальный ID с неудачной доставкой]
+    bounds = {}
+    for scan in scans:
+        for monitor_set in scan.subscribed_sets:
+            set_name = monitor_set['name']
+            bound = bounds.setdefault((scan.channel_username, set_name), [0, None])
+            bound[0] = max(bound[0], scan.max_seen_id)
+            for pending in scan.pending_messages:
+                undelivered = set_name in pending.failed_sets or (
+                    pending.outstanding and set_name not in pending.delivered_sets
+                )
+                if undelivered and (bound[1] is None or pending.message_id < bound[1]):
+                    bound[1] = pending.message_id
+
+    for (channel_username, set_name), (max_seen_id, first_failed_id) in bounds.items():
+        new_cursor = max_seen_id
+        if first_failed_id is not None:
+            # Ретрай неудачной отправки — в следующий раз
+            new_cursor = min(new_cursor, first_failed_id - 1)
+        updated = ctx.cursors.setdefault(channel_username, {})
+        updated[set_name] = max(updated.get(set_name, 0), new_cursor)
+    ctx.completed_scans[:] = held
+
+
+def describe_monitor_set(monitor_set):
+    """Печатает заголовок набора мониторинга перед прогоном"""
+    set_name = monitor_set['name']
+    keywords = monitor_set['keywords']
+    patterns = monitor_set['patterns']
+
+    if not monitor_set['channels']:
+        print(f"⚠️ [{set_name}] Нет каналов для мониторинга")
+        return
+
+    if not keywords and not patterns:
+        print(f"⚠️ [{set_name}] Нет ключевых слов или паттернов!")
+        print(f"   Будут пересылаться ВСЕ сообщения (кроме исключений)")
+
+    print(f"\n{'='*60}")
+    print(f"🔍 Набор: {set_name}")
+    print(f"📺 Каналов: {len(monitor_set['channels'])}")
+    print(f"🔑 Ключевых слов: {len(keywords)}")
+    print(f"🚫 Слов-исключений: {len(monitor_set['exclude'])}")
+    print(f"🔍 Регулярных выражений: {len(patterns)}")
+    print(f"{'='*60}")
+
+
+async def process_monitor_sets(ctx, monitor_sets, scheduler):
+    """
+    Обрабатывает все наборы мониторинга за один проход по уникальным каналам,
+    дожидается доставки совпадений и двигает курсоры.
+    Итоговая статистика — в ctx.stats и ctx.set_stats.
+    """
+    plan = plan_channels(monitor_sets)
+    references = sum(len(monitor_set['channels']) for monitor_set in monitor_sets)
+    print(f"\n🗺️ Уникальных каналов: {len(plan)} (ссылок в наборах: {references})")
+
+    # Расписание опроса: каналы, которым ещё рано, откладываются
+    now = datetime.now(timezone.utc)
+    deferred = []
+    for channel, subscribed in list(plan.items()):
+        stats = ctx.channel_stats.get(channel)
+        set_cursors = ctx.cursors.get(channel, {})
+        has_cursor = all(monitor_set['name'] in set_cursors for monitor_set in subscribed)
+        if not channel_poll_due(stats, has_cursor, now):
+            stats['checked_at'] = now.isoformat()
+            deferred.append(channel)
+            del plan[channel]
+    if deferred:
+        ctx.metrics.deferred_channels += len(deferred)
+        print(f"💤 Отложено по расписанию опроса: {len(deferred)} ({', '.join(deferred)})")
+
+    # Каналы сканируются параллельно (не больше scheduler.workers одновременно);
+    # паузы между запросами выдерживает общий лимитер, а не фиксированный sleep
+    with ctx.metrics.phase('scan'):
+        await asyncio.gather(*(
+            scheduler.run(lambda channel=channel, subscribed=subscribed: monitor_channel(
+                ctx,
+                channel,
+                subscribed
+            ))
+            for channel, subscribed in plan.items()
+        ))
+
+    # Чтение закончено — дожидаемся матчинга и отправки, только потом
+    # двигаем курсоры
+    with ctx.metrics.phase('match'):
+        await ctx.matching.flush()
+    with ctx.metrics.phase('delivery'):
+        await ctx.delivery.flush()
+    advance_cursors(ctx)
+
+    for monitor_set in monitor_sets:
+        stats = ctx.set_stats[monitor_set['name']]
+        print(f"\n📊 [{monitor_set['name']}] Результаты:")
+        print(f"   Проверено новых: {stats['checked']}")
+        print(f"   Переслано: {stats['forwarded']}")
+        print(f"   Пропущено дублей: {stats['skipped']}")
+        if stats['near_duplicates']:
+            print(f"   Почти-дублей из других каналов: {stats['near_duplicates']}")
+
+
+async def run_daemon(ctx, monitor_sets, scheduler, checkpoint):
+    """
+    Режим демона: подписка на events.NewMessage по всем каналам наборов.
+    Каждое новое сообщение проходит те же стадии матчинга (route_message) и
+    доставки, что и при проходе по истории, — задержка совпадения
+    секунды, а не часы. Сначала подписываемся, затем догоняем пропущенное
+    за время простоя проходом от сохранённых курсоров: сообщение, пришедшее
+    и событием, и в проходе, отсекается по processed/inflight. Курсор по
+    событиям двигается, только пока они примыкают к прочитанной истории
+    (см. advance_cursors), — хвост, не дочитанный догонкой, не теряется.
+
+    Telegram присылает обновления только по каналам, в которых состоит
+    аккаунт; остальные добираются страховочным проходом раз в
+    DAEMON_RESYNC_MINUTES (от курсоров — без повторного листания истории).
+    """
+    plan = plan_channels(monitor_sets)
+    peers = {}
+    for channel_username in plan:
+        try:
+            peer, _ = await resolve_channel(
+                ctx.client, channel_username, ctx.entity_cache, ctx.limiter, ctx.metrics
+            )
+            peers[telethon_utils.get_peer_id(peer)] = (channel_username, peer)
+        except Exception as e:
+            print(f"❌ Не удалось подписаться на {channel_username}: {e}")
+            ctx.errors.append(f"[daemon] {channel_username}: {e}")
+
+    async def on_new_message(event):
+        channel_username, _ = peers.get(event.chat_id, (None, None))
+        if channel_username is None:
+            return
+        record = MessageRecord.from_message(channel_username, event.message)
+        if ctx.recorder is not None:
+            ctx.recorder.write(channel_username, record)
+        if ctx.archive is not None:
+            ctx.archive.add(channel_username, record)
+        scan = ChannelScan(channel_username, plan[channel_username],
+                           ctx.cursors.get(channel_username, {}))
+        scan.max_seen_id = record.id
+        scan.live = True
+        await ctx.matching.put(record, scan)
+        # Курсор двигается после проверки и подтверждения доставки
+        # (advance_cursors); в список — только после того, как запись в
+        # очереди, иначе flush может её не дождаться
+        ctx.completed_scans.append(scan)
+
+    if peers:
+        ctx.client.add_event_handler(
+            on_new_message, events.NewMessage(chats=[peer for _, peer in peers.values()])
+        )
+    print(f"👂 Демон: подписка на {len(peers)} из {len(plan)} каналов")
+
+    # Догоняем всё, что пришло за время простоя
+    await process_monitor_sets(ctx, monitor_sets, scheduler)
+    checkpoint()
+
+    last_resync = time.monotonic()
+    while ctx.client.is_connected():
+        await asyncio.sleep(DAEMON_CHECKPOINT_SECONDS)
+
+        if time.monotonic() - last_resync >= DAEMON_RESYNC_MINUTES * 60:
+            await process_monitor_sets(ctx, monitor_sets, scheduler)
+            last_resync = time.monotonic()
+        else:
+            await ctx.matching.flush()
+            await ctx.delivery.flush()
+            advance_cursors(ctx)
+
+        checkpoint()
+
+    print("⚠️ Клиент отключён — демон останавливается")
+
+
+def open_pattern_sandbox(monitor_sets, state=None):
+    """
+    Песочница для паттернов наборов (None, если паттернов нет или
+    PATTERN_SANDBOX=off) с историей таймаутов из базы состояния.
+    """
+    configured = {pattern for monitor_set in monitor_sets for pattern in monitor_set['patterns']}
+    if PATTERN_SANDBOX == 'off' or not configured:
+        return None
+    history = state.load_pattern_quarantine(configured) if state is not None else None
+    sandbox = PatternSandbox(history=history)
+    print(f"🧪 Паттерны: пул из {sandbox.size} процессов, бюджет {PATTERN_TIMEOUT_MS:g} мс")
+    for pattern in sandbox.quarantined:
+        print(f"🚫 Паттерн в карантине (не проверяется): «{pattern}»")
+    return sandbox
+
+
+def bot_session_warm(bot):
+    """Есть ли у бота сохранённый ключ авторизации (тёплый старт)"""
+    session = getattr(bot, 'session', None)
+    return isinstance(session, StringSession) and session.auth_key is not None
+
+
+async def start_bot(bot):
+    """
+    Подключает бота. С сохранённой сессией — без обмена ключами и входа
+    по токену: connect() сам проверяет авторизацию (get_me), вход нужен,
+    только если сессию отозвали. Если сохранённая сессия не подошла совсем,
+    бот пересоздаётся с пустой сессией. Новая сессия сразу входит по
+    токену, без лишнего get_me из start().
+    Возвращает (bot, warm) — бот мог быть пересоздан.
+    """
+    if bot_session_warm(bot):
+        try:
+            await bot.connect()
+            if not await bot.is_user_authorized():
+                await bot.sign_in(bot_token=BOT_TOKEN)
+            return bot, True
+        except FloodWaitError:
+            raise
+        except Exception as e:
+            print(f"⚠️ Сохранённая сессия бота не подошла ({e}), вход заново")
+            await bot.disconnect()
+            bot = TelegramClient(StringSession(), bot.api_id, bot.api_hash, receive_updates=False,
+                                 flood_sleep_threshold=0)
+    await bot.connect()
+    await bot.sign_in(bot_token=BOT_TOKEN)
+    return bot, False
+
+
+async def connect_clients(client, bot, metrics):
+    """
+    Подключает пользовательский клиент и бота параллельно, время каждого —
+    в metrics.startup. Возвращает (bot, авторизован ли пользователь).
+    """
+    async def start_user():
+        started = time.perf_counter()
+        await client.connect()
+        authorized = await client.is_user_authorized()
+        metrics.startup['user_seconds'] = time.perf_counter() - started
+        return authorized
+
+    async def start_bot_timed():
+        started = time.perf_counter()
+        for attempt in range(FLOOD_RETRIES):
+            try:
+                result = await start_bot(bot)
+                break
+            except FloodWaitError as flood_error:
+                # Порог сна Telethon у бота нулевой — ожидание входа тоже
+                # видно в метриках; короткое (как прежний порог Telethon,
+                # 60 с) пережидаем, долгое — ошибка запуска
+                metrics.flood_wait('sign_in', flood_error.seconds)
+                if flood_error.seconds > 60 or attempt == FLOOD_RETRIES - 1:
+                    raise
+                print(f"⏳ FloodWait входа бота: ждём {flood_error.seconds} секунд...")
+                await asyncio.sleep(flood_error.seconds)
+        metrics.startup['bot_seconds'] = time.perf_counter() - started
+        return result
+
+    authorized, (bot, warm) = await asyncio.gather(start_user(), start_bot_timed())
+    metrics.startup['bot_warm'] = int(warm)
+    return bot, authorized
+
+
+async def run_monitor(client, bot, monitor_sets, daemon=False, state_path=None, recorder=None,
+                      archive_path=None):
+    """
+    Прогон мониторинга на готовых клиентах: client — пользовательский
+    (чтение каналов), bot — для отправки совпадений. Клиенты передаются
+    извне, поэтому весь конвейер можно запустить и на подменных клиентах
+    (replay_harness.py) без сети и учётных данных.
+    Возвращает RunContext прогона (None, если сессия недействительна).
+    """
+    # FloodWait любой длины отдаём в код: его обрабатывает общий лимитер
+    # (притормаживает всех воркеров), а не встроенный sleep Telethon. Бот
+    # тоже: иначе ожидания до 60 с Telethon пересыпает молча, мимо
+    # лимитера доставки и метрик
+    client.flood_sleep_threshold = 0
+    bot.flood_sleep_threshold = 0
+
+    metrics = RunMetrics()
+    with metrics.phase('connect'):
+        bot, authorized = await connect_clients(client, bot, metrics)
+    print(f"🔌 Подключение за {metrics.phases['connect']:.2f} с: "
+          f"пользователь {metrics.startup['user_seconds']:.2f} с, "
+          f"бот {metrics.startup['bot_seconds']:.2f} с "
+          f"({'сохранённая сессия' if metrics.startup['bot_warm'] else 'вход по токену'})")
+    
+    if not authorized:
+        print("❌ Session string недействителен!")
+        await bot.send_message(
+            YOUR_USER_ID,
+            "❌ Session string недействителен! Сгенерируйте новый."
+        )
+        return
+    
+    print(f"🚀 Бот запущен: {datetime.now(timezone.utc).isoformat()}")
+    print(f"📦 Всего наборов мониторинга: {len(monitor_sets)}")
+    if ADAPTIVE_DEPTH == 'off':
+        print(f"📊 Глубина поиска: {SEARCH_DEPTH} сообщений")
+    else:
+        print(f"📊 Глубина поиска: по каналу {ADAPTIVE_DEPTH_MIN}–{SEARCH_DEPTH_MAX} "
+              f"(без статистики — {SEARCH_DEPTH}) сообщений")
+    print(f"⏱️ Временной диапазон: {TIME_RANGE_HOURS} часов")
+    print(f"⚙️ Воркеров: {SCAN_WORKERS}, лимит API: {API_RATE_PER_SEC} запр/с (burst {API_BURST})")
+    if SEARCH_PUSHDOWN in ('auto', 'always'):
+        print(f"🔎 Поиск на стороне Telegram: {SEARCH_PUSHDOWN}")
+    if MATCH_MODE == 'token':
+        print("🔤 Ключевые слова сопоставляются по началу слова и основе (MATCH_MODE=token)")
+    
+    # Загружаем состояние: обработанные сообщения и курсоры каналов
+    with metrics.phase('load_state'):
+        state = StateStore(state_path or STATE_DB)
+        # Ключ авторизации (возможно, новый) — для тёплого старта следующего прогона
+        if BOT_SESSION_REUSE != 'off' and isinstance(getattr(bot, 'session', None), StringSession):
+            state.save_session('bot', bot.session.save(), BOT_TOKEN)
+        processed_dict = state.load_processed()
+        initial_processed_count = state.count_processed()
+        print(f"💾 Обработанных сообщений в базе: {initial_processed_count}")
+        cursors = state.load_cursors()
+        print(f"📍 Загружено курсоров каналов: {len(cursors)}")
+        channel_stats = state.load_channel_stats()
+        entity_cache = state.entity_cache()
+        near_dups = state.load_fingerprints() if NEAR_DUP_MODE in ('drop', 'fold') else None
+        if near_dups is not None:
+            print(f"🔁 Почти-дубли: {NEAR_DUP_MODE}, отпечатков в базе: {near_dups.size}")
+        archive = MessageArchive(archive_path) if archive_path else None
+        if archive is not None:
+            print(f"🗄️ Архив сообщений: {archive_path} ({archive.count()} сообщений)")
+        patterns = open_pattern_sandbox(monitor_sets, state)
+
+    # Один планировщик на весь прогон: общий пул воркеров и общий лимитер
+    # для всех наборов, чтобы суммарная нагрузка на API была ограничена
+    scheduler = ScanScheduler(SCAN_WORKERS, TokenBucket(API_RATE_PER_SEC, API_BURST))
+
+    # Отдельная стадия доставки со своим лимитером (лимиты бота свои)
+    delivery = DeliveryQueue(
+        bot,
+        TokenBucket(BOT_RATE_PER_SEC, BOT_BURST),
+        digest=DIGEST_MODE,
+        digest_window=DIGEST_WINDOW_SECONDS,
+        metrics=metrics
+    )
+    matching = MatchStage()
+    ctx = RunContext(client, monitor_sets, processed_dict, cursors, entity_cache,
+                     scheduler.limiter, delivery, recorder, metrics, channel_stats, archive,
+                     near_dups, patterns, matching)
+    errors = ctx.errors
+    print(f"🧵 Конвейер: чтение {SCAN_WORKERS} → матчинг {matching.workers} "
+          f"(очередь {matching.queue.maxsize}) → доставка {delivery.workers} "
+          f"(очередь {delivery.queue.maxsize})")
+    matching.start(ctx)
+    delivery.start()
+
+    def checkpoint():
+        with metrics.phase('save_state'):
+            state.save_processed(processed_dict)
+            state.save_cursors(cursors, monitor_sets)
+            state.save_channel_stats(channel_stats)
+            if near_dups is not None:
+                state.save_fingerprints(near_dups)
+            if patterns is not None:
+                state.save_pattern_quarantine(patterns.history)
+            if archive is not None:
+                archive.flush()
+        write_metrics(ctx)
+
+    try:
+        for monitor_set in monitor_sets:
+            describe_monitor_set(monitor_set)
+
+        if daemon:
+            # Долгоживущий режим: события NewMessage + периодические чекпоинты
+            await run_daemon(ctx, monitor_sets, scheduler, checkpoint)
+        else:
+            # Каждый уникальный канал читается один раз для всех наборов
+            await process_monitor_sets(ctx, monitor_sets, scheduler)
+
+        print(f"\n{'='*60}")
+        print(f"✨ ИТОГО по всем наборам:")
+        print(f"   Обработано новых: {ctx.stats['new']}")
+        print(f"   Переслано: {ctx.stats['forwarded']} (сообщений бота: {delivery.sent_messages})")
+        print(f"   Пропущено дублей: {ctx.stats['skipped']}")
+        print(f"   Кэш каналов: попаданий {entity_cache.hits}, "
+              f"промахов {entity_cache.misses}, сброшено {entity_cache.invalidated}")
+        print(f"   Вызовы API: {dict(metrics.api_calls)}")
+        if metrics.flood_waits:
+            print(f"   FloodWait: {dict(metrics.flood_waits)}, с: {dict(metrics.flood_wait_seconds)}")
+        print(f"   Матчинг: {sum(timing['match'] for timing in metrics.sets.values()):.3f} с")
+        if patterns is not None and (patterns.run_timeouts or patterns.quarantined):
+            print(f"   Паттерны: превышений бюджета {sum(patterns.run_timeouts.values())}, "
+                  f"в карантине {len(patterns.quarantined)}")
+        print(f"{'='*60}")
+
+        # Медленные паттерны и карантин — в ту же сводку ошибок
+        if patterns is not None:
+            errors.extend(patterns.report())
+
+        # Единая сводка об ошибках каналов вместо уведомления на каждый канал
+        if errors:
+            summary = "⚠️ Ошибки при обработке каналов:\n\n" + "\n".join(
+                f"• {e}" for e in errors
+            )
+            await delivery.notify(summary[:4000], "сводка ошибок")
+
+    except Exception as e:
+        print(f"❌ Критическая ошибка: {e}")
+        try:
+            await bot.send_message(YOUR_USER_ID, f"⚠️ Критическая ошибка:\n{e}")
+        except Exception:
+            pass
+
+    finally:
+        # Проверяем и досылаем то, что уже в очередях: отметки ставятся
+        # только после подтверждённой доставки
+        try:
+            await matching.close()
+            await delivery.close()
+        except Exception as e:
+            print(f"❌ Ошибка при завершении доставки: {e}")
+        # Сохраняем состояние В ЛЮБОМ случае, иначе при ошибке в середине
+        # прогона отметки «обработано» теряются и дубли шлются повторно.
+        with metrics.phase('save_state'):
+            removed_count = state.save_processed(processed_dict)
+            print(f"🧹 Удалено старых записей: {removed_count}")
+            state.save_cursors(cursors, monitor_sets)
+            state.save_channel_stats(channel_stats)
+            if near_dups is not None:
+                state.save_fingerprints(near_dups)
+            if patterns is not None:
+                state.save_pattern_quarantine(patterns.history)
+                patterns.close()
+            state.close()
+            if archive is not None:
+                archive.flush()
+                archive.prune()
+                archive.close()
+        await client.disconnect()
+        await bot.disconnect()
+        write_metrics(ctx)
+
+    return ctx
+
+
+def load_bot_session(state_path):
+    """Сохранённая сессия бота из базы состояния ('' — входить по токену)"""
+    if BOT_SESSION_REUSE == 'off' or not os.path.exists(state_path):
+        return ''
+    state = StateStore(state_path)
+    try:
+        return state.load_session('bot', BOT_TOKEN) or ''
+    finally:
+        state.close()
+
+
+async def main(daemon=False, record_dir=None, shard=None):
+    """Основная функция для мониторинга каналов"""
+    
+    # Проверка критичных переменных окружения
+    required_vars = ['TELEGRAM_API_ID', 'TELEGRAM_API_HASH', 'SESSION_STRING', 'BOT_TOKEN', 'YOUR_USER_ID']
+    missing = [var for var in required_vars if not os.getenv(var)]
+    if missing:
+        print(f"❌ Отсутствуют обязательные переменные: {', '.join(missing)}")
+        return
+
+    # Парсим числовые переменные здесь (а не на импорте), чтобы некорректное
+    # значение давало понятное сообщение, а не TypeError/ValueError в трейсбеке.
+    global API_ID, API_HASH, SESSION_STRING, BOT_TOKEN, YOUR_USER_ID, BOT_SESSION_REUSE
+    try:
+        API_ID = int(os.getenv('TELEGRAM_API_ID'))
+        YOUR_USER_ID = int(os.getenv('YOUR_USER_ID'))
+    except (TypeError, ValueError):
+        print("❌ TELEGRAM_API_ID и YOUR_USER_ID должны быть целыми числами")
+        return
+    API_HASH = os.getenv('TELEGRAM_API_HASH')
+    SESSION_STRING = os.getenv('SESSION_STRING')
+    BOT_TOKEN = os.getenv('BOT_TOKEN')
+
+    # Параллельные шарды не делят ключи авторизации (см. SHARD_COUNT)
+    if shard and shard[1] > 1:
+        shard_session = os.getenv('SHARD_SESSION_STRING')
+        if not shard_session or shard_session == SESSION_STRING:
+            print(f"❌ Шардов {shard[1]}: каждому нужна своя сессия пользователя в "
+                  f"SHARD_SESSION_STRING (секрет SESSION_STRING_{shard[0]}), "
+                  f"иначе Telegram отзовёт общую (AUTH_KEY_DUPLICATED)")
+            return
+        SESSION_STRING = shard_session
+        if BOT_SESSION_REUSE != 'off':
+            print("🤖 Шардов несколько: бот входит по токену, без сохранённой сессии")
+            BOT_SESSION_REUSE = 'off'
+
+    # Воркер шарда работает со своим файлом состояния и своей блокировкой
+    state_path = STATE_DB
+    lock_path = LOCK_FILE
+    if shard:
+        state_path = shard_path(STATE_DB, *shard)
+        lock_path = shard_path(LOCK_FILE, *shard)
+    # Архив у каждого шарда свой: SQLite не любит параллельных писателей
+    archive_path = shard_path(ARCHIVE_DB, *shard) if shard and ARCHIVE_DB else ARCHIVE_DB
+
+    # Проверка на параллельный запуск (только для Unix-систем)
+    lock_file = None
+    if sys.platform != 'win32':
+        try:
+            import fcntl
+            lock_file = open(lock_path, 'w')
             fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
             print("🔒 Блокировка установлена")
         except IOError:
@@ -412,6 +4021,17 @@ async def main():
             print("❌ Не указаны наборы для мониторинга!")
             print("Добавьте MONITOR_SETS в JSON формате или используйте старые переменные")
             return
+
+        if shard:
+            shard_index, shard_count = shard
+            total_channels = len(plan_channels(monitor_sets))
+            monitor_sets = shard_monitor_sets(monitor_sets, shard_index, shard_count)
+            print(f"🧩 Шард {shard_index + 1}/{shard_count}: каналов "
+                  f"{len(plan_channels(monitor_sets))} из {total_channels}, состояние {state_path}")
+            # Шард стартует с копии основного состояния (источник правды —
+            # STATE_DB после слияния); файл шарда — промежуточный
+            if os.path.exists(STATE_DB):
+                shutil.copyfile(STATE_DB, state_path)
         
         # Создаем клиент с session string
         client = TelegramClient(
@@ -420,84 +4040,26 @@ async def main():
             API_HASH
         )
         
-        # Создаем клиент бота
+        # Создаем клиент бота: с сохранённой сессией прошлого прогона, если
+        # она есть. Бот только отправляет — обновления ему не нужны.
         bot = TelegramClient(
-            StringSession(), 
+            StringSession(load_bot_session(state_path)),
             API_ID, 
-            API_HASH
+            API_HASH,
+            receive_updates=False,
+            # FloodWait отправки — в DeliveryQueue (лимитер, метрики)
+            flood_sleep_threshold=0
         )
-        
-        await client.connect()
-        await bot.start(bot_token=BOT_TOKEN)
-        
-        if not await client.is_user_authorized():
-            print("❌ Session string недействителен!")
-            await bot.send_message(
-                YOUR_USER_ID,
-                "❌ Session string недействителен! Сгенерируйте новый."
-            )
-            return
-        
-        print(f"🚀 Бот запущен: {datetime.now(timezone.utc).isoformat()}")
-        print(f"📦 Всего наборов мониторинга: {len(monitor_sets)}")
-        print(f"📊 Глубина поиска: {SEARCH_DEPTH} сообщений")
-        print(f"⏱️ Временной диапазон: {TIME_RANGE_HOURS} часов")
-        
-        # Загружаем уже обработанные сообщения
-        processed_dict = load_processed_messages()
-        initial_processed_count = len(processed_dict)
-        print(f"💾 Загружено обработанных сообщений: {initial_processed_count}")
-        
-        total_new = 0
-        total_forwarded = 0
-        total_skipped = 0
-        errors = []
 
+        recorder = MessageRecorder(record_dir) if record_dir else None
         try:
-            # Обрабатываем каждый набор последовательно
-            for monitor_set in monitor_sets:
-                new, forwarded, skipped = await process_monitor_set(
-                    client,
-                    bot,
-                    monitor_set,
-                    processed_dict,
-                    errors
-                )
-                total_new += new
-                total_forwarded += forwarded
-                total_skipped += skipped
-
-            print(f"\n{'='*60}")
-            print(f"✨ ИТОГО по всем наборам:")
-            print(f"   Обработано новых: {total_new}")
-            print(f"   Переслано: {total_forwarded}")
-            print(f"   Пропущено дублей: {total_skipped}")
-            print(f"{'='*60}")
-
-            # Единая сводка об ошибках каналов вместо уведомления на каждый канал
-            if errors:
-                summary = "⚠️ Ошибки при обработке каналов:\n\n" + "\n".join(
-                    f"• {e}" for e in errors
-                )
-                try:
-                    await bot.send_message(YOUR_USER_ID, summary[:4000])
-                except Exception as notify_err:
-                    print(f"❌ Не удалось отправить сводку ошибок: {notify_err}")
-
-        except Exception as e:
-            print(f"❌ Критическая ошибка: {e}")
-            try:
-                await bot.send_message(YOUR_USER_ID, f"⚠️ Критическая ошибка:\n{e}")
-            except Exception:
-                pass
-
+            await run_monitor(client, bot, monitor_sets, daemon=daemon,
+                              state_path=state_path, recorder=recorder,
+                              archive_path=archive_path)
         finally:
-            # Сохраняем состояние В ЛЮБОМ случае, иначе при ошибке в середине
-            # прогона отметки «обработано» теряются и дубли шлются повторно.
-            removed_count = save_processed_messages(processed_dict)
-            print(f"🧹 Удалено старых записей: {removed_count}")
-            await client.disconnect()
-            await bot.disconnect()
+            if recorder is not None:
+                recorder.close()
+                print(f"📼 Записано сообщений: {recorder.records} (в {record_dir})")
     
     finally:
         # Освобождаем блокировку
@@ -506,11 +4068,84 @@ async def main():
                 import fcntl
                 fcntl.flock(lock_file, fcntl.LOCK_UN)
                 lock_file.close()
-                os.remove(LOCK_FILE)
+                os.remove(lock_path)
                 print("🔓 Блокировка снята")
             except Exception:
                 pass
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Мониторинг Telegram-каналов по ключевым словам")
+    parser.add_argument(
+        '--daemon', action='store_true',
+        help="работать постоянно: события NewMessage вместо разового прохода по истории"
+    )
+    parser.add_argument(
+        '--shard', metavar='I/N',
+        default=f"{SHARD_INDEX}/{SHARD_COUNT}" if SHARD_COUNT else None,
+        help="обрабатывать только каналы шарда I из N (с нуля), состояние — в отдельный файл"
+    )
+    parser.add_argument(
+        '--merge-shards', nargs='+', metavar='PATH',
+        help="слить состояния шардов (файлы или каталоги с *.db) в STATE_DB и выйти"
+    )
+    parser.add_argument(
+        '--backtest', metavar='CONFIG',
+        help="проверить наборы из JSON (формат MONITOR_SETS) по архиву сообщений и выйти"
+    )
+    parser.add_argument(
+        '--archive', metavar='FILE', default=ARCHIVE_DB or 'monitor_archive.db',
+        help="архив для --backtest (по умолчанию ARCHIVE_DB)"
+    )
+    parser.add_argument('--backtest-hours', type=float, help="только сообщения за последние N часов")
+    parser.add_argument('--backtest-all-channels', action='store_true',
+                        help="проверять все каналы архива, а не только каналы наборов")
+    parser.add_argument('--backtest-fts', metavar='QUERY',
+                        help="предварительный отбор по FTS5, например 'нефт*'")
+    parser.add_argument('--backtest-output', metavar='FILE', help="все совпадения в JSONL")
+    parser.add_argument(
+        '--profile', metavar='FILE', default=os.getenv('PROFILE_FILE', ''),
+        help="записать cProfile прогона (смотреть: python -m pstats FILE или snakeviz)"
+    )
+    parser.add_argument(
+        '--record', metavar='DIR', default=RECORD_DIR,
+        help="записывать полученные сообщения в JSONL (для replay_harness.py)"
+    )
+    args = parser.parse_args()
+    if args.shard:
+        try:
+            shard_index, shard_count = (int(part) for part in args.shard.split('/'))
+        except ValueError:
+            parser.error("--shard ожидает I/N, например 0/4")
+        if not 0 <= shard_index < shard_count:
+            parser.error("--shard: номер шарда должен быть от 0 до N-1")
+        args.shard = (shard_index, shard_count)
+    return args
+
+
 if __name__ == '__main__':
-    asyncio.run(main())
+    args = parse_args()
+    if args.merge_shards:
+        merge_shards(args.merge_shards)
+        sys.exit(0)
+    if args.backtest:
+        backtest(args.backtest, args.archive, args.backtest_hours, args.backtest_all_channels,
+                 args.backtest_fts, args.backtest_output)
+        sys.exit(0)
+    profiler = None
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        asyncio.run(main(daemon=args.daemon, record_dir=args.record, shard=args.shard))
+    except KeyboardInterrupt:
+        # Состояние уже сохранено в finally внутри main()
+        print("👋 Остановлено")
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            if os.path.dirname(args.profile):
+                os.makedirs(os.path.dirname(args.profile), exist_ok=True)
+            profiler.dump_stats(args.profile)
+            print(f"🔬 Профиль прогона: {args.profile}")